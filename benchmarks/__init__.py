@@ -0,0 +1 @@
+"""离线基准测试，用法见 README「性能基准」一节"""
@@ -0,0 +1,228 @@
+"""
+键值服务替身
+进程内的最小化 RESP 服务，实现共享会话存储用到的命令（列表、字符串、过期时间和 MULTI/EXEC），
+使 KVSessionStore 无需运行 Redis 即可在本地测试和基准测试；不实现持久化和淘汰策略
+
+    server = KVServer()
+    url = await server.start()      # redis://127.0.0.1:<随机端口>/0
+    ...
+    await server.stop()
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+
+class RespError(Exception):
+    """以错误回复返回给客户端"""
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    """读取一条以 RESP 数组编码的命令，连接关闭时返回 None"""
+    line = await reader.readline()
+    if not line.startswith(b"*") or not line.endswith(b"\r\n"):
+        return None
+    args = []
+    for _ in range(int(line[1:-2])):
+        header = await reader.readline()
+        if not header.startswith(b"$"):
+            return None
+        args.append((await reader.readexactly(int(header[1:-2]) + 2))[:-2])
+    return args
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode("utf-8")
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _index(value: bytes, length: int) -> int:
+    index = int(value)
+    return index + length if index < 0 else index
+
+
+class KVServer:
+    """进程内的 RESP 服务替身，所有连接共享同一份数据"""
+
+    def __init__(self, password: Optional[str] = None):
+        self.password = password
+        self.data: Dict[bytes, object] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.commands = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}{host}:{port}/0"
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # 关闭仍未断开的连接，等待其处理协程结束
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def stored_bytes(self) -> int:
+        """当前保存的数据总字节数"""
+        total = 0
+        for key in list(self.data):
+            value = self._get(key)
+            if isinstance(value, list):
+                total += sum(len(item) for item in value)
+            elif value is not None:
+                total += len(value)
+        return total
+
+    # ---------- 数据访问 ----------
+
+    def _get(self, key: bytes):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def _delete(self, key: bytes) -> int:
+        self.expires.pop(key, None)
+        return int(self.data.pop(key, None) is not None)
+
+    # ---------- 连接处理 ----------
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        authed = self.password is None
+        queued: Optional[List[List[bytes]]] = None
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    args = await read_command(reader)
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    break
+                if not args:
+                    break
+                self.commands += 1
+                name = args[0].upper()
+                if name == b"AUTH":
+                    authed = args[-1].decode("utf-8") == self.password
+                    reply = "OK" if authed else RespError("WRONGPASS invalid password")
+                elif not authed:
+                    reply = RespError("NOAUTH Authentication required.")
+                elif name == b"MULTI":
+                    queued, reply = [], "OK"
+                elif name == b"EXEC":
+                    reply = [self._execute(command) for command in queued] if queued is not None else RespError(
+                        "ERR EXEC without MULTI"
+                    )
+                    queued = None
+                elif name == b"DISCARD":
+                    queued, reply = None, "OK"
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    reply = self._execute(args)
+                writer.write(_encode(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    def _execute(self, args: List[bytes]):
+        name, args = args[0].upper().decode("ascii"), args[1:]
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args)
+        except (TypeError, ValueError):
+            return RespError(f"ERR wrong arguments for '{name}' command")
+
+    # ---------- 命令 ----------
+
+    def _cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def _cmd_select(self, db):
+        int(db)
+        return "OK"
+
+    def _cmd_flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    def _cmd_get(self, key):
+        value = self._get(key)
+        return value if not isinstance(value, list) else RespError("WRONGTYPE")
+
+    def _cmd_mget(self, *keys):
+        values = [self._get(key) for key in keys]
+        return [value if not isinstance(value, list) else None for value in values]
+
+    def _cmd_set(self, key, value, *options):
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        ttl = None
+        if b"EX" in options:
+            ttl = int(options[options.index(b"EX") + 1])
+        if b"NX" in options and self._get(key) is not None:
+            return None
+        self.data[key] = value
+        if ttl:
+            self.expires[key] = time.time() + ttl
+        else:
+            self.expires.pop(key, None)
+        return "OK"
+
+    def _cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys)
+
+    def _cmd_expire(self, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def _cmd_rpush(self, key, *values):
+        if not values:
+            raise ValueError
+        items = self._get(key)
+        if items is None:
+            items = self.data[key] = []
+        elif not isinstance(items, list):
+            return RespError("WRONGTYPE")
+        items.extend(values)
+        return len(items)
+
+    def _cmd_lrange(self, key, start, stop):
+        items = self._get(key) or []
+        start, stop = max(0, _index(start, len(items))), _index(stop, len(items))
+        return list(items[start:stop + 1])
+
+    def _cmd_ltrim(self, key, start, stop):
+        items = self._get(key)
+        if isinstance(items, list):
+            start, stop = max(0, _index(start, len(items))), _index(stop, len(items))
+            items[:] = items[start:stop + 1]
+            if not items:
+                self._delete(key)
+        return "OK"
@@ -0,0 +1,220 @@
+"""
+离线基准测试运行器
+
+在插件根目录执行：
+    python -m benchmarks.run                      # 运行全部场景
+    python -m benchmarks.run -s image_heavy -n 500
+    python -m benchmarks.run --compare benchmarks/results/上一次的结果.json
+
+每个场景统计 ingest（on_message + handle_message）和 request（on_req_llm / on_req_llm_private）
+两个阶段的吞吐量（条/秒）、p50/p99/最大延迟（毫秒），场景运行期间 Python 分配的峰值内存，
+以及模拟的服务商前缀缓存命中率（与同一会话上一次请求相同的开头部分占请求内容的比例）；
+结果以 JSON 保存，便于在不同版本之间对比
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from . import stubs
+from .kv_server import KVServer
+from .scenarios import SCENARIOS, Scenario
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PLUGIN_DIR, "benchmarks", "results")
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], elapsed: float) -> dict:
+    """汇总一个阶段的延迟（秒），返回吞吐量和毫秒延迟分位数"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "per_sec": round(len(values) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(_percentile(values, 50) * 1000, 3),
+        "p99_ms": round(_percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def plugin_version() -> str:
+    try:
+        with open(os.path.join(PLUGIN_DIR, "metadata.yaml"), encoding="utf-8") as f:
+            match = re.search(r"^version:\s*(\S+)", f.read(), re.M)
+        return match.group(1) if match else "unknown"
+    except OSError:
+        return "unknown"
+
+
+async def run_scenario(module, scenario: Scenario, scale: int, seed: int, trace_memory: bool) -> dict:
+    steps = scenario.build(random.Random(seed), scale)
+    config = dict(scenario.config)
+    kv_server = None
+    if scenario.instances > 1:
+        kv_server = KVServer()
+        config["session_store_url"] = await kv_server.start()
+    context = stubs.FakeContext()
+    plugins = [module.GroupContextPlugin(context, dict(config)) for _ in range(scenario.instances)]
+    api_calls, downloads = stubs.onebot.calls, stubs.images.downloads
+    cached_chars, total_chars = stubs.prefix_cache.cached_chars, stubs.prefix_cache.total_chars
+
+    latencies = {"ingest": [], "request": []}
+    elapsed = {"ingest": 0.0, "request": 0.0}
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+
+    for index, step in enumerate(steps):
+        plugin = plugins[index % len(plugins)]
+        if step.kind == "ingest":
+            start = time.perf_counter()
+            async for _ in plugin.on_message(step.event):
+                pass
+        else:
+            req = stubs.ProviderRequest(prompt=step.event.message_str, contexts=step.make_contexts())
+            start = time.perf_counter()
+            if step.event.get_message_type() == stubs.MessageType.GROUP_MESSAGE:
+                await plugin.on_req_llm(step.event, req)
+            else:
+                await plugin.on_req_llm_private(step.event, req)
+        cost = time.perf_counter() - start
+        if step.kind == "request":
+            stubs.prefix_cache.request(step.event.unified_msg_origin, req.contexts)
+            if step.on_response:
+                step.on_response(req)
+        latencies[step.kind].append(cost)
+        elapsed[step.kind] += cost
+
+    peak_memory = 0
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    store_stats = {}
+    for plugin in plugins:
+        for key, value in plugin.session_store.stats().items():
+            store_stats[key] = store_stats.get(key, 0) + value
+        await plugin.terminate()
+
+    result = {
+        "description": scenario.description,
+        "scale": scale,
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 2) if trace_memory else None,
+        "onebot_calls": stubs.onebot.calls - api_calls,
+        "image_downloads": stubs.images.downloads - downloads,
+        "provider_calls": context.provider.calls,
+    }
+    if kv_server is not None:
+        result["instances"] = scenario.instances
+        result["kv_commands"] = kv_server.commands
+        result["kv_roundtrips"] = store_stats["roundtrips"]
+        result["kv_blob_bytes"] = store_stats["blob_bytes"]
+        result["kv_messages"] = {"pushed": store_stats["pushed"], "taken": store_stats["taken"]}
+        await kv_server.stop()
+    total_chars = stubs.prefix_cache.total_chars - total_chars
+    if total_chars:
+        result["prefix_cache_hit"] = round((stubs.prefix_cache.cached_chars - cached_chars) / total_chars, 4)
+    for kind in ("ingest", "request"):
+        if latencies[kind]:
+            result[kind] = summarize(latencies[kind], elapsed[kind])
+    return result
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict]):
+    """打印与基线结果的对比（吞吐量和 p99 的变化百分比）"""
+    def delta(new, old):
+        if not old:
+            return "   n/a"
+        return f"{(new - old) / old * 100:+6.1f}%"
+
+    print("\n与基线对比:")
+    for name, result in current.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for kind in ("ingest", "request"):
+            if kind in result and kind in base:
+                print(
+                    f"  {name:16s} {kind:8s} 吞吐量 {delta(result[kind]['per_sec'], base[kind]['per_sec'])}"
+                    f"  p99 {delta(result[kind]['p99_ms'], base[kind]['p99_ms'])}"
+                )
+        if result.get("peak_memory_mb") and base.get("peak_memory_mb"):
+            print(f"  {name:16s} 峰值内存 {delta(result['peak_memory_mb'], base['peak_memory_mb'])}")
+
+
+def print_result(name: str, result: dict):
+    memory = f"{result['peak_memory_mb']} MB" if result["peak_memory_mb"] is not None else "未统计"
+    print(f"[{name}] {result['description']}（规模 {result['scale']}，峰值内存 {memory}）")
+    if "prefix_cache_hit" in result:
+        print(f"  前缀缓存命中率 {result['prefix_cache_hit']:.1%}")
+    if "instances" in result:
+        print(
+            f"  {result['instances']} 个实例共享缓冲：写入 {result['kv_messages']['pushed']} 条，"
+            f"取出 {result['kv_messages']['taken']} 条，{result['kv_commands']} 条命令 / {result['kv_roundtrips']} 次往返，"
+            f"以引用代替的图片数据 {result['kv_blob_bytes'] / 1024 / 1024:.1f} MB"
+        )
+    for kind in ("ingest", "request"):
+        if kind in result:
+            stats = result[kind]
+            print(
+                f"  {kind:8s} {stats['count']:6d} 次  {stats['per_sec']:10.1f} 条/秒"
+                f"  p50 {stats['p50_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms  max {stats['max_ms']:8.3f} ms"
+            )
+
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="群聊上下文插件离线基准测试")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="只运行指定场景，可重复")
+    parser.add_argument("-n", "--scale", type=int, default=0, help="覆盖场景的默认规模")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-memory", action="store_true", help="不统计峰值内存（tracemalloc 会拖慢运行）")
+    parser.add_argument("-o", "--output", help="结果文件路径，默认写入 benchmarks/results/")
+    parser.add_argument("--compare", help="与之前保存的结果文件对比")
+    args = parser.parse_args(argv)
+
+    module = stubs.load_plugin(PLUGIN_DIR)
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        scenario = SCENARIOS[name]
+        results[name] = await run_scenario(module, scenario, args.scale or scenario.scale, args.seed, not args.no_memory)
+        print_result(name, results[name])
+
+    version = plugin_version()
+    report = {
+        "version": version,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "memory_traced": not args.no_memory,
+        "scenarios": results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{version}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f).get("scenarios", {}))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,252 @@
+"""
+合成流量场景
+每个场景构造一份插件配置和一组消息事件，交给运行器依次驱动
+on_message（含 handle_message）与 on_req_llm / on_req_llm_private
+"""
+import base64
+import random
+from typing import Callable, Dict, List, Optional
+
+from . import stubs
+from .stubs import At, Forward, Image, Plain, Reply
+
+WORDS = ["今天", "吃什么", "哈哈哈", "有人吗", "这个", "好像", "不太对", "刚才", "那张图", "笑死", "lol", "ok", "+1"]
+
+
+def _text(rng: random.Random, min_words: int = 3, max_words: int = 30) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+class Step:
+    """一次驱动动作：ingest 表示收到一条群聊消息，request 表示触发一次 LLM 请求"""
+
+    __slots__ = ("kind", "event", "make_contexts", "on_response")
+
+    def __init__(self, kind: str, event, make_contexts: Optional[Callable[[], list]] = None,
+                 on_response: Optional[Callable[[object], None]] = None):
+        self.kind = kind
+        self.event = event
+        self.make_contexts = make_contexts
+        """请求时才构造对话历史，避免预先生成的历史计入峰值内存"""
+        self.on_response = on_response
+        """请求处理完后调用，参数为处理后的 ProviderRequest"""
+
+
+class Scenario:
+    def __init__(self, name: str, description: str, config: dict, build: Callable[[random.Random, int], List[Step]],
+                 scale: int, instances: int = 1):
+        self.name = name
+        self.description = description
+        self.config = config
+        self.build = build
+        self.scale = scale
+        """默认规模（消息数或请求数）"""
+        self.instances = instances
+        """插件实例数，大于 1 时各实例通过本地键值服务替身共享缓冲，消息和请求轮流交给各实例处理"""
+
+
+def _group_event(umo: str, components: list, rng: random.Random) -> stubs.FakeEvent:
+    nickname = f"member{rng.randint(1, 50)}"
+    return stubs.AiocqhttpMessageEvent(umo, components, nickname=nickname, sender_id=nickname)
+
+
+def _history(rounds: int, image_url: Optional[str] = None) -> list:
+    """构造已有的对话历史，image_url 不为空时每轮 user 消息携带一张图片"""
+    contexts = []
+    for i in range(rounds):
+        content = [{"type": "text", "text": f"[member/12:00:{i % 60:02d}]: " + "历史消息" * 20}]
+        if image_url:
+            content.append({"type": "image_url", "image_url": {"url": image_url}})
+        contexts.append({"role": "user", "content": content})
+        contexts.append({"role": "assistant", "content": "好的，" * 30})
+    return contexts
+
+
+def _interleave(rng: random.Random, scale: int, groups: int, batch: int, make: Callable[[str, int], list]) -> List[Step]:
+    """在多个群之间交替产生消息，每个群累计 batch 条消息后触发一次请求"""
+    steps = []
+    pending = {f"group_{g}": 0 for g in range(groups)}
+    for i in range(scale):
+        umo = rng.choice(list(pending))
+        steps.append(Step("ingest", _group_event(umo, make(umo, i), rng)))
+        pending[umo] += 1
+        if pending[umo] >= batch:
+            pending[umo] = 0
+            request_event = _group_event(umo, [Plain(text="@bot 总结一下")], rng)
+            steps.append(Step("request", request_event, lambda: _history(10)))
+    return steps
+
+
+def build_text_flood(rng: random.Random, scale: int) -> List[Step]:
+    def make(umo, i):
+        components = [Plain(text=_text(rng))]
+        if i % 7 == 0:
+            components.insert(0, At(qq="10001", name="bot"))
+        if i % 11 == 0 and i > 0:
+            # 回复之前的消息，由本地消息索引解析
+            components.insert(0, Reply(id=str(max(1, stubs.FakeEvent._seq - 3))))
+        return components
+
+    return _interleave(rng, scale, groups=20, batch=30, make=make)
+
+
+def build_image_heavy(rng: random.Random, scale: int) -> List[Step]:
+    # 表情包等重复图片占多数，少量大图
+    pool = []
+    for i in range(40):
+        url = f"http://img.bench/{i}.png"
+        size = (1920, 1080) if i % 10 == 0 else (240, 240)
+        stubs.images.register(url, *size)
+        pool.append(url)
+
+    def make(umo, i):
+        components = [Plain(text=_text(rng, 1, 8))]
+        for _ in range(rng.randint(1, 3)):
+            components.append(Image(url=rng.choice(pool), file=f"{i}.image"))
+        return components
+
+    return _interleave(rng, scale, groups=5, batch=10, make=make)
+
+
+def build_large_forward(rng: random.Random, scale: int) -> List[Step]:
+    forward_ids = []
+    for f in range(max(1, scale // 20)):
+        nodes = []
+        for n in range(200):
+            segments = [{"type": "text", "data": {"text": _text(rng)}}]
+            if n % 25 == 0:
+                url = f"http://img.bench/forward_{f}_{n}.png"
+                stubs.images.register(url, 800, 600)
+                segments.append({"type": "image", "data": {"url": url, "file": f"forward_{f}_{n}.image"}})
+            nodes.append({"sender": {"nickname": f"member{n % 30}"}, "message": segments})
+        forward_id = f"forward_{f}"
+        stubs.onebot.forwards[forward_id] = {"messages": nodes}
+        forward_ids.append(forward_id)
+
+    def make(umo, i):
+        # 同一合并转发会被多人重复发送
+        return [Forward(id=rng.choice(forward_ids))]
+
+    return _interleave(rng, scale, groups=5, batch=5, make=make)
+
+
+class Conversation:
+    """模拟 AstrBot 保存的对话历史：每次请求后将处理后的上下文和模型回复写回"""
+
+    def __init__(self):
+        self.contexts = []
+        self.rounds = 0
+
+    def load(self) -> list:
+        return [dict(ctx) for ctx in self.contexts]
+
+    def save(self, req):
+        self.rounds += 1
+        self.contexts = list(req.contexts) + [{"role": "assistant", "content": f"第 {self.rounds} 轮回复，" * 10}]
+
+
+def build_long_conversation(rng: random.Random, scale: int) -> List[Step]:
+    url = "http://img.bench/conversation.png"
+    stubs.images.register(url, 320, 320)
+    conversations = {f"group_{g}": Conversation() for g in range(3)}
+    steps = []
+    for i in range(scale):
+        umo = f"group_{i % len(conversations)}"
+        for m in range(5):
+            components = [Plain(text=_text(rng, 3, 10))]
+            if m == 0:
+                components.append(Image(url=url, file="conversation.image"))
+            steps.append(Step("ingest", _group_event(umo, components, rng)))
+        conversation = conversations[umo]
+        request_event = _group_event(umo, [Plain(text="@bot 说说看")], rng)
+        steps.append(Step("request", request_event, conversation.load, conversation.save))
+    return steps
+
+
+def build_shared_buffer(rng: random.Random, scale: int) -> List[Step]:
+    # 同一张 base64 表情图被反复发送，共享存储中只保存一份（PNG 末尾附加随机字节模拟不可压缩的图片数据）
+    stickers = [
+        "base64://" + base64.b64encode(stubs.make_png(160, 160) + rng.randbytes(8192)).decode("ascii")
+        for _ in range(5)
+    ]
+
+    def make(umo, i):
+        components = [Plain(text=_text(rng, 1, 10))]
+        if i % 4 == 0:
+            components.append(Image(file=rng.choice(stickers)))
+        return components
+
+    return _interleave(rng, scale, groups=5, batch=20, make=make)
+
+
+def build_private_history(rng: random.Random, scale: int) -> List[Step]:
+    image_uri = "data:image/png;base64," + base64.b64encode(stubs.make_png(1024, 768)).decode("ascii")
+    steps = []
+    for i in range(scale):
+        event = stubs.AiocqhttpMessageEvent(
+            f"private_{i % 10}",
+            [Plain(text=_text(rng))],
+            message_type=stubs.MessageType.FRIEND_MESSAGE,
+        )
+        steps.append(Step("request", event, lambda: _history(200, image_uri)))
+    return steps
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario(
+            "text_flood",
+            "20 个群的纯文本刷屏，夹带 @ 和引用回复",
+            {"enable_image_recognition": False, "reply_quote_inline": True},
+            build_text_flood,
+            5000,
+        ),
+        Scenario(
+            "image_heavy",
+            "每条消息 1~3 张图片，重复表情包为主，请求时编码注入",
+            {"enable_image_recognition": True, "image_caption": False, "request_image_limit": 8},
+            build_image_heavy,
+            1000,
+        ),
+        Scenario(
+            "large_forward",
+            "每条消息为 200 个节点的合并转发，同一转发被反复发送",
+            {"enable_forward_analysis": True, "enable_image_recognition": False},
+            build_large_forward,
+            200,
+        ),
+        Scenario(
+            "long_conversation",
+            "3 个群持续多轮对话（历史随回复写回），每轮 5 条消息含一张图片，按轮数逐轮裁剪",
+            {"enable_image_recognition": True, "image_caption": False, "conversation_rounds_limit": 8,
+             "image_carry_rounds": 2},
+            build_long_conversation,
+            300,
+        ),
+        Scenario(
+            "long_conversation_stable",
+            "同 long_conversation，启用稳定前缀模式（每 4 轮整块裁剪）",
+            {"enable_image_recognition": True, "image_caption": False, "conversation_rounds_limit": 8,
+             "image_carry_rounds": 2, "enable_stable_prefix": True, "stable_prefix_chunk_rounds": 4},
+            build_long_conversation,
+            300,
+        ),
+        Scenario(
+            "shared_buffer",
+            "2 个实例通过共享会话存储处理 5 个群，每 4 条消息夹带一张重复的 base64 表情图",
+            {"enable_image_recognition": True, "image_caption": False, "session_store": "kv",
+             "session_store_flush_ms": 5},
+            build_shared_buffer,
+            2000,
+            instances=2,
+        ),
+        Scenario(
+            "private_history",
+            "私聊长历史（200 轮，每轮一张图片）的轮数和图片裁剪",
+            {"enable_private_control": True, "private_conversation_rounds_limit": 20, "private_image_carry_rounds": 3},
+            build_private_history,
+            200,
+        ),
+    )
+}
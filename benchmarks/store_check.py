@@ -0,0 +1,118 @@
+"""
+共享会话存储的故障检查
+
+在插件根目录执行：
+    python -m benchmarks.store_check
+
+以键值服务替身模拟存储不可用再恢复的过程，检查每条群聊消息恰好随一次请求发送：
+- outage：存储不可用时消息无法写入，请求退回本实例的消息；存储恢复后这些消息不会再次写入和发送
+- failed_take：消息已写入存储，但读取（MULTI/EXEC）失败，请求退回本实例的消息；之后从存储取出时跳过它们
+- shared：存储正常时，两个实例各自记录的消息由一次请求一并取出
+任一检查失败时以非零状态退出
+"""
+import asyncio
+import sys
+from typing import List
+from urllib.parse import urlsplit
+
+from . import stubs
+from .kv_server import KVServer
+from .run import PLUGIN_DIR
+
+CONFIG = {"session_store": "kv", "session_store_flush_ms": 0}
+
+
+async def say(plugin, text: str):
+    event = stubs.AiocqhttpMessageEvent("group", [stubs.Plain(text=text)], nickname="甲")
+    async for _ in plugin.on_message(event):
+        pass
+    # 等待后台写入完成
+    await asyncio.sleep(0.05)
+
+
+async def ask(plugin) -> List[str]:
+    """发起一次请求，返回其中包含的群聊消息文本"""
+    req = stubs.ProviderRequest(prompt="", contexts=[])
+    await plugin.on_req_llm(stubs.AiocqhttpMessageEvent("group", [stubs.Plain(text="@bot")]), req)
+    return [line.split("]: ", 1)[1] for line in req.prompt.split("\n---\n") if "]: " in line]
+
+
+def expect(problems: List[str], label: str, actual: List[str], expected: List[str]):
+    if actual != expected:
+        problems.append(f"{label} {actual}，期望 {expected}")
+
+
+async def check_outage(module, server: KVServer, url: str) -> List[str]:
+    plugin = module.GroupContextPlugin(stubs.FakeContext(), dict(CONFIG, session_store_url=url))
+    await server.stop()
+    await say(plugin, "hello one")
+    first = await ask(plugin)
+    await server.start(port=urlsplit(url).port)
+    await say(plugin, "hello two")
+    second = await ask(plugin)
+    await plugin.terminate()
+    problems = []
+    expect(problems, "存储不可用时的请求", first, ["hello one"])
+    expect(problems, "存储恢复后的请求", second, ["hello two"])
+    return problems
+
+
+async def check_failed_take(module, url: str) -> List[str]:
+    plugin = module.GroupContextPlugin(stubs.FakeContext(), dict(CONFIG, session_store_url=url))
+    client = plugin.session_store.client
+    pipeline = client.pipeline
+    failures = [ConnectionError("模拟读取失败")]
+
+    async def failing_pipeline(commands):
+        if commands and commands[0][0] == "MULTI" and failures:
+            raise failures.pop()
+        return await pipeline(commands)
+
+    client.pipeline = failing_pipeline
+    await say(plugin, "hello three")
+    first = await ask(plugin)
+    await say(plugin, "hello four")
+    second = await ask(plugin)
+    await plugin.terminate()
+    problems = []
+    expect(problems, "读取失败时的请求", first, ["hello three"])
+    expect(problems, "之后的请求", second, ["hello four"])
+    return problems
+
+
+async def check_shared(module, url: str) -> List[str]:
+    context = stubs.FakeContext()
+    first, second = (module.GroupContextPlugin(context, dict(CONFIG, session_store_url=url)) for _ in range(2))
+    await say(first, "hello five")
+    await say(second, "hello six")
+    taken = await ask(second)
+    again = await ask(first)
+    await first.terminate()
+    await second.terminate()
+    problems = []
+    expect(problems, "第一次请求", taken, ["hello five", "hello six"])
+    expect(problems, "第二次请求", again, [])
+    return problems
+
+
+async def main() -> int:
+    module = stubs.load_plugin(PLUGIN_DIR)
+    server = KVServer()
+    url = await server.start()
+    failed = 0
+    for name, check in (
+        ("outage", lambda: check_outage(module, server, url)),
+        ("failed_take", lambda: check_failed_take(module, url)),
+        ("shared", lambda: check_shared(module, url)),
+    ):
+        problems = await check()
+        failed += bool(problems)
+        print(f"{name:<12} {'失败' if problems else '通过'}")
+        for problem in problems:
+            print(f"  {problem}")
+    await server.stop()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,359 @@
+"""
+基准测试用的本地替身
+在导入插件前注入最小化的 astrbot 模块（事件、消息组件、Provider、aiocqhttp 客户端等），
+使插件无需运行 AstrBot 和 OneBot 实现端即可离线执行；网络调用以固定延迟模拟
+"""
+import asyncio
+import enum
+import importlib.util
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+import types
+import zlib
+
+PLUGIN_PACKAGE = "astrbot_plugin_group_context"
+
+API_LATENCY = 0.002
+"""模拟 OneBot call_action 的网络延迟（秒）"""
+DOWNLOAD_LATENCY = 0.003
+"""模拟图片下载的网络延迟（秒）"""
+PROVIDER_LATENCY = 0.01
+"""模拟大模型调用的延迟（秒）"""
+
+logger = logging.getLogger("astrbot")
+
+
+def _module(name: str) -> types.ModuleType:
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+    return module
+
+
+# ---------- astrbot.api ----------
+
+class _Filter:
+    """装饰器替身：filter.xxx(...) 均返回原函数"""
+
+    class PlatformAdapterType(enum.Enum):
+        ALL = "all"
+        AIOCQHTTP = "aiocqhttp"
+
+    class PermissionType(enum.Enum):
+        ADMIN = "admin"
+        MEMBER = "member"
+
+    def __getattr__(self, name):
+        def decorator(*args, **kwargs):
+            return lambda func: func
+        return decorator
+
+
+class AstrMessageEvent:
+    pass
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+
+class StarTools:
+    data_root = tempfile.mkdtemp(prefix="group_context_bench_")
+
+    @classmethod
+    def get_data_dir(cls, name=None):
+        path = os.path.join(cls.data_root, name or PLUGIN_PACKAGE)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+class ProviderRequest:
+    def __init__(self, prompt: str = "", contexts: list = None, system_prompt: str = ""):
+        self.prompt = prompt
+        self.contexts = contexts if contexts is not None else []
+        self.system_prompt = system_prompt
+
+
+class LLMResponse:
+    def __init__(self, completion_text: str = ""):
+        self.completion_text = completion_text
+
+
+class Provider:
+    """大模型替身，按固定延迟返回结果并记录调用次数"""
+
+    def __init__(self, provider_id: str = "bench"):
+        self.provider_config = {"id": provider_id}
+        self.calls = 0
+
+    def meta(self):
+        return types.SimpleNamespace(id=self.provider_config["id"])
+
+    async def text_chat(self, prompt: str = None, session_id: str = None, image_urls: list = None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(PROVIDER_LATENCY)
+        if image_urls:
+            return LLMResponse(f"一张图片（{len(image_urls)}）")
+        return LLMResponse((prompt or "")[-64:])
+
+
+class MessageType(enum.Enum):
+    GROUP_MESSAGE = "GroupMessage"
+    FRIEND_MESSAGE = "FriendMessage"
+    OTHER_MESSAGE = "OtherMessage"
+
+
+class _Component:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Plain(_Component):
+    text = ""
+
+
+class Image(_Component):
+    url = None
+    file = None
+
+
+class At(_Component):
+    qq = ""
+    name = ""
+
+
+class Forward(_Component):
+    id = ""
+
+
+class Reply(_Component):
+    id = ""
+    sender_nickname = ""
+    message_str = ""
+
+
+class PrefixCache:
+    """模拟服务商的提示词前缀缓存：与同一会话上一次请求逐条相同的开头部分视为命中，按序列化后的字符数统计"""
+
+    def __init__(self):
+        self.last = {}
+        self.cached_chars = 0
+        self.total_chars = 0
+
+    def request(self, session: str, contexts: list):
+        messages = [json.dumps(ctx, ensure_ascii=False, sort_keys=True) for ctx in contexts]
+        previous = self.last.get(session, [])
+        for i, message in enumerate(messages):
+            if i >= len(previous) or previous[i] != message:
+                break
+            self.cached_chars += len(message)
+        self.total_chars += sum(len(message) for message in messages)
+        self.last[session] = messages
+
+
+prefix_cache = PrefixCache()
+
+
+# ---------- 图片下载 ----------
+
+def make_png(width: int, height: int) -> bytes:
+    """生成一张纯色 PNG（不依赖 Pillow）"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    row = b"\x00" + b"\x80\x40\x20" * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+class ImageStore:
+    """按 URL 返回合成图片的本地文件，模拟 download_image_by_url"""
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="group_context_bench_img_")
+        self.sizes = {}
+        self.downloads = 0
+
+    def register(self, url: str, width: int, height: int):
+        self.sizes[url] = (width, height)
+
+    async def download(self, url: str) -> str:
+        self.downloads += 1
+        await asyncio.sleep(DOWNLOAD_LATENCY)
+        path = os.path.join(self.dir, f"{abs(hash(url))}.png")
+        if not os.path.exists(path):
+            width, height = self.sizes.get(url, (640, 480))
+            with open(path, "wb") as f:
+                f.write(make_png(width, height))
+        return path
+
+
+images = ImageStore()
+
+
+# ---------- OneBot (aiocqhttp) ----------
+
+class FakeOneBotApi:
+    """OneBot 客户端替身，get_msg / get_forward_msg 从预置数据返回"""
+
+    def __init__(self):
+        self.messages = {}
+        self.forwards = {}
+        self.calls = 0
+
+    async def call_action(self, action: str, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(API_LATENCY)
+        if action == "get_msg":
+            return self.messages.get(str(kwargs.get("message_id")), {"message": []})
+        if action == "get_forward_msg":
+            return self.forwards.get(kwargs.get("id"), {"messages": []})
+        raise RuntimeError(f"unsupported action: {action}")
+
+
+onebot = FakeOneBotApi()
+
+
+class FakeEvent(AstrMessageEvent):
+    """消息事件替身"""
+
+    _seq = 0
+
+    def __init__(self, umo: str, components: list, nickname: str = "user", sender_id: str = "10000",
+                 message_type: MessageType = MessageType.GROUP_MESSAGE):
+        FakeEvent._seq += 1
+        self.unified_msg_origin = umo
+        self.session_id = umo
+        self.is_at_or_wake_command = False
+        self.message_obj = types.SimpleNamespace(
+            message=components,
+            message_id=str(FakeEvent._seq),
+            sender=types.SimpleNamespace(nickname=nickname, user_id=sender_id),
+            group_id=umo,
+        )
+        self.message_str = "".join(getattr(c, "text", "") for c in components if isinstance(c, Plain))
+        self._message_type = message_type
+        self._extras = {}
+
+    def get_message_type(self):
+        return self._message_type
+
+    def get_group_id(self):
+        return self.unified_msg_origin
+
+    def get_sender_id(self):
+        return self.message_obj.sender.user_id
+
+    def get_self_id(self):
+        return "bench_bot"
+
+    def get_extra(self, key):
+        return self._extras.get(key)
+
+    def set_extra(self, key, value):
+        self._extras[key] = value
+
+    def request_llm(self, **kwargs):
+        return kwargs
+
+
+class AiocqhttpMessageEvent(FakeEvent):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bot = types.SimpleNamespace(api=onebot)
+
+
+# ---------- 插件上下文 ----------
+
+class FakeConversationManager:
+    async def get_curr_conversation_id(self, umo):
+        return "bench"
+
+    async def get_conversation(self, umo, cid):
+        return types.SimpleNamespace(cid=cid, history="[]")
+
+
+class FakeContext:
+    def __init__(self):
+        self.provider = Provider()
+        self.conversation_manager = FakeConversationManager()
+
+    def get_using_provider(self, umo=None):
+        return self.provider
+
+    def get_provider_by_id(self, provider_id):
+        return self.provider
+
+    def get_llm_tool_manager(self):
+        return None
+
+
+def install():
+    """注入 astrbot 替身模块"""
+    if "astrbot.api" in sys.modules and getattr(sys.modules["astrbot.api"], "_bench_stub", False):
+        return
+    logging.basicConfig(level=logging.WARNING)
+
+    api = _module("astrbot.api")
+    api._bench_stub = True
+    api.logger = logger
+    api.AstrBotConfig = dict
+    _module("astrbot")
+
+    event = _module("astrbot.api.event")
+    event.filter = _Filter()
+    event.AstrMessageEvent = AstrMessageEvent
+
+    star = _module("astrbot.api.star")
+    star.Context = object
+    star.Star = Star
+    star.StarTools = StarTools
+    star.register = lambda *args, **kwargs: (lambda cls: cls)
+
+    provider = _module("astrbot.api.provider")
+    provider.ProviderRequest = ProviderRequest
+    provider.LLMResponse = LLMResponse
+    provider.Provider = Provider
+
+    components = _module("astrbot.api.message_components")
+    for cls in (Plain, Image, At, Forward, Reply):
+        setattr(components, cls.__name__, cls)
+
+    _module("astrbot.api.platform").MessageType = MessageType
+
+    for name in ("astrbot.core", "astrbot.core.utils"):
+        _module(name)
+    _module("astrbot.core.utils.io").download_image_by_url = images.download
+
+    for name in (
+        "astrbot.core.platform",
+        "astrbot.core.platform.sources",
+        "astrbot.core.platform.sources.aiocqhttp",
+    ):
+        _module(name)
+    _module("astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event").AiocqhttpMessageEvent = AiocqhttpMessageEvent
+
+
+def load_plugin(plugin_dir: str):
+    """以包的形式导入插件（插件内部使用相对导入），返回 main 模块"""
+    install()
+    if f"{PLUGIN_PACKAGE}.main" in sys.modules:
+        return sys.modules[f"{PLUGIN_PACKAGE}.main"]
+    package = types.ModuleType(PLUGIN_PACKAGE)
+    package.__path__ = [plugin_dir]
+    sys.modules[PLUGIN_PACKAGE] = package
+    spec = importlib.util.spec_from_file_location(f"{PLUGIN_PACKAGE}.main", os.path.join(plugin_dir, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,415 @@
+"""
+群聊消息缓冲区
+按群维护有界的消息缓冲，支持消息数量、总字节数、消息时长上限，以及空闲群的整体淘汰；
+消息到达时即按顺序预留位置，异步构建完成后再填入，取出时只交换已填入的消息，未完成的位置留待下一次请求；
+填入时与紧邻的上一条消息内容相同（复读）的消息会折叠进上一条，只记录发送者；
+同时按群维护消息ID索引，用于在本地解析被回复的消息
+"""
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .records import MessageRecord, estimate_record_bytes
+
+
+class BufferSlot:
+    """缓冲区中按到达顺序预留的一个位置，record 为 None 时表示消息仍在构建中"""
+
+    __slots__ = ("ts", "nbytes", "tokens", "image_tokens", "record", "waiter", "live", "key", "last_ts")
+
+    def __init__(self, ts: float, record: Optional[MessageRecord] = None, waiter: Any = None):
+        self.ts = ts
+        self.nbytes = 0
+        self.tokens = 0
+        self.image_tokens = ()
+        """各图片片段的 token 数，计入 tokens 中"""
+        self.record = record
+        self.waiter = waiter
+        """调用方附加的等待对象（如 asyncio.Future），缓冲区本身不使用"""
+        self.live = True
+        """被淘汰或取消后为 False，此后填入的消息会被丢弃"""
+        self.key = None
+        """判断复读用的内容键"""
+        self.last_ts = ts
+        """最近一次折叠进来的复读时间"""
+
+
+class _GroupBuffer:
+    """单个群的缓冲区"""
+
+    __slots__ = ("entries", "nbytes", "tokens", "last_active")
+
+    def __init__(self, now: float):
+        self.entries: "deque[BufferSlot]" = deque()
+        """按到达顺序排列的位置，包括尚未填入的位置"""
+        self.tokens = 0
+        self.nbytes = 0
+        self.last_active = now
+
+
+class GroupMessageBuffer:
+    """有界的群聊消息缓冲区
+
+    - 每个群的消息数量、总字节数、消息时长超出上限时，从最早的消息开始淘汰
+    - 超过 idle_ttl 秒没有任何活动的群会被整体淘汰
+    - 所有上限为 0 时表示不限制，此时行为与"保留上一次请求之后的全部消息"一致
+    - dedupe_window 大于 0 时，与紧邻的上一条消息内容键相同、且距其最近一次出现不超过 dedupe_window 秒的消息
+      折叠进上一条（不占用新位置）
+    """
+
+    def __init__(
+        self,
+        max_messages: int = 0,
+        max_bytes: int = 0,
+        max_age: float = 0,
+        idle_ttl: float = 0,
+        sweep_interval: float = 60,
+        token_estimator: Optional[Callable[[MessageRecord], Tuple[int, Tuple[int, ...]]]] = None,
+        on_group_evicted: Optional[Callable[[str], None]] = None,
+        dedupe_window: float = 0,
+        dedupe_key: Optional[Callable[[MessageRecord], Any]] = None,
+    ):
+        self.max_messages = max(0, int(max_messages))
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_age = max(0.0, float(max_age))
+        self.idle_ttl = max(0.0, float(idle_ttl))
+        self.sweep_interval = sweep_interval
+        self.token_estimator = token_estimator
+        """消息追加时即计算 token 数（总数和各图片的份额），按 token 预算组装请求时无需重新扫描"""
+        self.on_group_evicted = on_group_evicted
+        """空闲群被整体淘汰时的回调"""
+        self.dedupe_window = max(0.0, float(dedupe_window)) if dedupe_key else 0.0
+        self.dedupe_key = dedupe_key
+
+        self._groups: "OrderedDict[str, _GroupBuffer]" = OrderedDict()
+        """按最近活动时间排序，最久未活动的群在最前面"""
+        self._total_messages = 0
+        self._total_bytes = 0
+        self._last_sweep = time.time()
+
+        # 淘汰计数
+        self.evicted_messages = 0
+        self.evicted_bytes = 0
+        self.evicted_groups = 0
+        self.collapsed_messages = 0
+
+    def __contains__(self, umo: str) -> bool:
+        return umo in self._groups
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def _touch(self, umo: str, now: float) -> _GroupBuffer:
+        group = self._groups.get(umo)
+        if group is None:
+            group = _GroupBuffer(now)
+            self._groups[umo] = group
+        else:
+            group.last_active = now
+            self._groups.move_to_end(umo)
+        return group
+
+    def _pop_oldest(self, group: _GroupBuffer):
+        slot = group.entries.popleft()
+        slot.live = False
+        group.nbytes -= slot.nbytes
+        group.tokens -= slot.tokens
+        self._total_messages -= 1
+        self._total_bytes -= slot.nbytes
+        self.evicted_messages += 1
+        self.evicted_bytes += slot.nbytes
+
+    def _expire(self, group: _GroupBuffer, now: float):
+        """淘汰超出时长上限的消息"""
+        if not self.max_age:
+            return
+        deadline = now - self.max_age
+        while group.entries and group.entries[0].ts < deadline:
+            self._pop_oldest(group)
+
+    def _enforce_caps(self, group: _GroupBuffer):
+        """淘汰超出数量和字节上限的消息（至少保留最新的一条）"""
+        while len(group.entries) > 1 and (
+            (self.max_messages and len(group.entries) > self.max_messages)
+            or (self.max_bytes and group.nbytes > self.max_bytes)
+        ):
+            self._pop_oldest(group)
+
+    def _set_record(self, group: _GroupBuffer, slot: BufferSlot, record: MessageRecord):
+        slot.record = record
+        slot.nbytes = estimate_record_bytes(record)
+        slot.tokens, slot.image_tokens = self.token_estimator(record) if self.token_estimator else (0, ())
+        group.nbytes += slot.nbytes
+        group.tokens += slot.tokens
+        self._total_bytes += slot.nbytes
+
+    def _try_collapse(
+        self, group: _GroupBuffer, previous: Optional[BufferSlot], slot: BufferSlot, record: MessageRecord
+    ) -> bool:
+        """与上一条消息内容相同且在时间窗口内时，将 record 折叠进上一条并返回 True"""
+        if (
+            previous is None
+            or previous.record is None
+            or slot.key is None
+            or previous.key != slot.key
+            or record.ts - previous.last_ts > self.dedupe_window
+        ):
+            return False
+        nbytes, tokens = previous.nbytes, previous.tokens
+        group.nbytes -= nbytes
+        group.tokens -= tokens
+        self._total_bytes -= nbytes
+        self._set_record(group, previous, previous.record.with_repeat(record.nickname))
+        previous.last_ts = record.ts
+        self.collapsed_messages += 1
+        return True
+
+    def _previous_slot(self, group: _GroupBuffer, slot: BufferSlot) -> Optional[BufferSlot]:
+        """返回紧邻 slot 之前的位置（新位置通常在队尾附近，从后往前查找）"""
+        entries = reversed(group.entries)
+        for candidate in entries:
+            if candidate is slot:
+                return next(entries, None)
+        return None
+
+    def reserve(self, umo: str, waiter: Any = None) -> BufferSlot:
+        """消息到达时按顺序预留一个位置，构建完成后调用 fill 填入，放弃时调用 cancel"""
+        now = time.time()
+        group = self._touch(umo, now)
+        slot = BufferSlot(now, waiter=waiter)
+        group.entries.append(slot)
+        self._total_messages += 1
+
+        self._expire(group, now)
+        self._enforce_caps(group)
+
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep(now)
+        return slot
+
+    def fill(self, umo: str, slot: BufferSlot, record: MessageRecord) -> bool:
+        """填入预留位置的消息；位置已被淘汰时丢弃并返回 False
+
+        消息作为复读折叠进上一条时，释放预留的位置并返回 True
+        """
+        if not slot.live:
+            return False
+        group = self._groups[umo]
+        if self.dedupe_window:
+            slot.key = self.dedupe_key(record)
+            if self._try_collapse(group, self._previous_slot(group, slot), slot, record):
+                self.cancel(umo, slot)
+                return True
+        self._set_record(group, slot, record)
+        self._enforce_caps(group)
+        return slot.live
+
+    def cancel(self, umo: str, slot: BufferSlot):
+        """放弃尚未填入的位置（消息没有可记录的内容或构建失败）"""
+        if not slot.live or slot.record is not None:
+            return
+        slot.live = False
+        group = self._groups[umo]
+        group.entries.remove(slot)
+        group.nbytes -= slot.nbytes
+        group.tokens -= slot.tokens
+        self._total_messages -= 1
+        self._total_bytes -= slot.nbytes
+
+    def append(self, umo: str, record: MessageRecord):
+        """向群缓冲区追加一条已构建完成的消息"""
+        self.fill(umo, self.reserve(umo), record)
+
+    def _build_slots(self, group: _GroupBuffer, records: Iterable[MessageRecord]) -> List[BufferSlot]:
+        """为已构建完成的一组消息创建位置（计入 group 的字节数和 token 数），连续的复读折叠进上一条"""
+        slots = []
+        for record in records:
+            slot = BufferSlot(record.ts)
+            if self.dedupe_window:
+                slot.key = self.dedupe_key(record)
+                if self._try_collapse(group, slots[-1] if slots else None, slot, record):
+                    continue
+            self._set_record(group, slot, record)
+            slots.append(slot)
+        return slots
+
+    def restore(self, umo: str, records: Iterable[MessageRecord]):
+        """将从持久化记录恢复的消息放到缓冲区最前面（早于恢复前已到达的消息），按消息时间判断是否过期"""
+        now = time.time()
+        group = self._touch(umo, now)
+        restored = self._build_slots(group, records)
+        group.entries.extendleft(reversed(restored))
+        self._total_messages += len(restored)
+        self._expire(group, now)
+        self._enforce_caps(group)
+
+    def collate(self, records: Iterable[MessageRecord], with_tokens: bool = False) -> list:
+        """按缓冲区的规则处理一组在外部取出的消息（过期、复读折叠、数量和字节上限、token 计算），
+        返回值同 take_all；不影响缓冲区中的任何群
+        """
+        now = time.time()
+        group = _GroupBuffer(now)
+        group.entries.extend(self._build_slots(group, records))
+        self._total_messages += len(group.entries)
+        self._expire(group, now)
+        self._enforce_caps(group)
+        self._total_messages -= len(group.entries)
+        self._total_bytes -= group.nbytes
+        if with_tokens:
+            return [(slot.record, slot.tokens, slot.image_tokens) for slot in group.entries]
+        return [slot.record for slot in group.entries]
+
+    def count(self, umo: str) -> int:
+        """返回该群缓冲区中的消息条数（含尚未填入的位置）"""
+        group = self._groups.get(umo)
+        return len(group.entries) if group is not None else 0
+
+    def take_oldest(self, umo: str, count: int) -> List[MessageRecord]:
+        """取出该群最早的至多 count 条已填入的消息，遇到尚未填入的位置即停止，保证取出的消息早于剩余消息"""
+        group = self._groups.get(umo)
+        taken = []
+        while group is not None and group.entries and len(taken) < count and group.entries[0].record is not None:
+            slot = group.entries.popleft()
+            slot.live = False
+            group.nbytes -= slot.nbytes
+            group.tokens -= slot.tokens
+            self._total_messages -= 1
+            self._total_bytes -= slot.nbytes
+            taken.append(slot.record)
+        return taken
+
+    def pending_waiters(self, umo: str) -> List[Any]:
+        """返回该群尚未填入的位置上附加的等待对象"""
+        group = self._groups.get(umo)
+        if group is None:
+            return []
+        return [slot.waiter for slot in group.entries if slot.record is None and slot.waiter is not None]
+
+    def take_all(self, umo: str, with_tokens: bool = False) -> list:
+        """取出该群缓冲区中已填入的全部消息（按到达顺序），尚未填入的位置保留在缓冲区中
+
+        with_tokens 为 True 时返回 (消息记录, token数, 各图片的token数) 列表
+        """
+        now = time.time()
+        group = self._touch(umo, now)
+        self._expire(group, now)
+        taken = [slot for slot in group.entries if slot.record is not None]
+        if with_tokens:
+            messages = [(slot.record, slot.tokens, slot.image_tokens) for slot in taken]
+        else:
+            messages = [slot.record for slot in taken]
+        for slot in taken:
+            slot.live = False
+        # 整体交换为只包含未填入位置的新队列
+        group.entries = deque(slot for slot in group.entries if slot.record is None)
+        self._total_messages -= len(taken)
+        self._total_bytes -= group.nbytes
+        group.nbytes = 0
+        group.tokens = 0
+        return messages
+
+    def sweep(self, now: float = None):
+        """淘汰空闲的群"""
+        now = now or time.time()
+        self._last_sweep = now
+        if not self.idle_ttl:
+            return
+        deadline = now - self.idle_ttl
+        while self._groups:
+            umo, group = next(iter(self._groups.items()))
+            if group.last_active >= deadline:
+                break
+            self._groups.popitem(last=False)
+            for slot in group.entries:
+                slot.live = False
+            self._total_messages -= len(group.entries)
+            self._total_bytes -= group.nbytes
+            self.evicted_messages += len(group.entries)
+            self.evicted_bytes += group.nbytes
+            self.evicted_groups += 1
+            if self.on_group_evicted:
+                self.on_group_evicted(umo)
+
+    def group_stats(self) -> Dict[str, Dict[str, int]]:
+        """返回每个群当前缓冲的消息条数、字节数和 token 数"""
+        return {
+            umo: {
+                "messages": len(group.entries),
+                "pending": sum(1 for slot in group.entries if slot.record is None),
+                "bytes": group.nbytes,
+                "tokens": group.tokens,
+            }
+            for umo, group in self._groups.items()
+        }
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓冲区当前大小以及淘汰计数"""
+        return {
+            "groups": len(self._groups),
+            "messages": self._total_messages,
+            "bytes": self._total_bytes,
+            "evicted_messages": self.evicted_messages,
+            "evicted_bytes": self.evicted_bytes,
+            "evicted_groups": self.evicted_groups,
+            "collapsed_messages": self.collapsed_messages,
+        }
+
+
+class IndexedMessage:
+    """消息索引条目"""
+
+    __slots__ = ("nickname", "text", "forward_id")
+
+    def __init__(self, nickname: str, text: str, forward_id: Optional[str] = None):
+        self.nickname = nickname
+        self.text = text
+        self.forward_id = forward_id
+
+
+class MessageIndex:
+    """按群维护的消息ID索引，用于在本地解析被回复的消息，避免调用平台接口
+
+    每个群最多保留 max_messages 条，最多保留 max_groups 个群，均按最近使用淘汰
+    """
+
+    def __init__(self, max_messages: int = 500, max_groups: int = 1024):
+        self.max_messages = max(1, int(max_messages))
+        self.max_groups = max(1, int(max_groups))
+        self._groups: "OrderedDict[str, OrderedDict[str, IndexedMessage]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, umo: str, message_id, entry: IndexedMessage):
+        """记录一条消息"""
+        if message_id is None or message_id == "":
+            return
+        group = self._groups.get(umo)
+        if group is None:
+            group = self._groups[umo] = OrderedDict()
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        else:
+            self._groups.move_to_end(umo)
+        group[str(message_id)] = entry
+        group.move_to_end(str(message_id))
+        while len(group) > self.max_messages:
+            group.popitem(last=False)
+
+    def get(self, umo: str, message_id) -> Optional[IndexedMessage]:
+        """查找一条消息，未记录时返回 None"""
+        group = self._groups.get(umo)
+        entry = group.get(str(message_id)) if group is not None else None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "groups": len(self._groups),
+            "messages": sum(len(group) for group in self._groups.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
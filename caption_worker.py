@@ -0,0 +1,138 @@
+"""
+图片描述后台队列
+消息记录时只提交描述任务并立即返回，描述由后台工作协程获取，请求时再按任务ID取回结果
+"""
+import asyncio
+import itertools
+import time
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from astrbot.api import logger
+
+from .cache import TTLCache
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+class CaptionWorkerPool:
+    """有界队列 + 固定数量工作协程的图片描述任务池"""
+
+    def __init__(
+        self,
+        caption_func: Callable[[str], Awaitable[str]],
+        workers: int = 2,
+        queue_size: int = 256,
+        timeout: float = 30,
+        result_ttl: float = 86400,
+    ):
+        self.caption_func = caption_func
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self._queue: asyncio.Queue = None
+        self._queue_size = max(1, int(queue_size))
+        self._tasks = []
+        self._ids = itertools.count(1)
+        self._id_prefix = f"cap-{uuid.uuid4().hex[:8]}-"
+        """任务ID带有进程内唯一的前缀，重启后恢复的旧任务ID不会与新任务冲突"""
+        self._jobs = TTLCache(maxsize=max(1024, self._queue_size * 8), ttl=result_ttl)
+        """任务ID -> Future，结果在缓冲消息被淘汰后随过期时间一起清除"""
+
+        # 统计
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._latencies = deque(maxlen=512)
+        """最近任务从提交到完成的耗时（秒）"""
+
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, url: str) -> Optional[str]:
+        """提交描述任务，返回任务ID；队列已满时返回 None"""
+        self._ensure_started()
+        job_id = f"{self._id_prefix}{next(self._ids)}"
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((job_id, url, future, time.time()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"图片描述队列已满（{self._queue_size}），该图片使用[图片]占位符")
+            return None
+        self._jobs.set(job_id, future)
+        self.submitted += 1
+        return job_id
+
+    async def _worker(self):
+        while True:
+            job_id, url, future, enqueued_at = await self._queue.get()
+            try:
+                caption = await asyncio.wait_for(self.caption_func(url), self.timeout or None)
+                if not future.done():
+                    future.set_result(caption or None)
+                self.completed += 1
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"获取图片描述失败: {url}, 错误: {e}")
+                if not future.done():
+                    future.set_result(None)
+                self.failed += 1
+            finally:
+                self._latencies.append(time.time() - enqueued_at)
+                self._queue.task_done()
+
+    def has_job(self, job_id: str) -> bool:
+        """任务是否仍可查询（未知或结果已过期时返回 False）"""
+        return job_id in self._jobs
+
+    def result(self, job_id: str) -> Optional[str]:
+        """返回已完成任务的描述（未完成、失败或未知任务返回 None）"""
+        future = self._jobs.get(job_id, count=False)
+        if future is None or not future.done() or future.cancelled():
+            return None
+        return future.result()
+
+    async def wait(self, job_ids: Iterable[str], timeout: float) -> Dict[str, Optional[str]]:
+        """等待一组任务完成，最多等待 timeout 秒，返回任务ID到描述的映射"""
+        job_ids = list(job_ids)
+        futures = [self._jobs.get(job_id, count=False) for job_id in job_ids]
+        pending = [future for future in futures if future is not None and not future.done()]
+        if pending and timeout > 0:
+            await asyncio.wait(pending, timeout=timeout)
+        return {job_id: self.result(job_id) for job_id in job_ids}
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except BaseException:
+                pass
+        self._tasks = []
+
+    def stats(self) -> Dict[str, float]:
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "latency_p50": round(_percentile(latencies, 0.5), 3),
+            "latency_p95": round(_percentile(latencies, 0.95), 3),
+            "latency_max": round(latencies[-1], 3) if latencies else 0.0,
+        }
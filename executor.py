@@ -0,0 +1,93 @@
+"""
+阻塞任务执行器
+将图片路径中的磁盘读写、base64 编码、图片规范化等阻塞操作放到有界的线程池/进程池中执行，
+避免阻塞 asyncio 事件循环，并统计任务排队等待时间
+"""
+import asyncio
+import functools
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from astrbot.api import logger
+
+
+def _timed_call(submitted_at: float, func: Callable, *args, **kwargs):
+    """在工作线程/进程中执行，返回 (开始执行时间, 结果)，用于计算排队等待时间"""
+    return time.time(), func(*args, **kwargs)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class BlockingExecutor:
+    """有界的阻塞任务执行器
+
+    - io 任务（文件读写、base64 编码）始终在线程池中执行
+    - cpu 任务（图片规范化）在 kind="process" 时放到进程池中执行，否则与 io 任务共用线程池
+    """
+
+    def __init__(self, max_workers: int = 4, kind: str = "thread"):
+        self.max_workers = max(1, int(max_workers))
+        self.kind = kind if kind in ("thread", "process") else "thread"
+        self._thread_pool: Executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="group_context"
+        )
+        self._process_pool: Executor = None
+        if self.kind == "process":
+            try:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            except Exception as e:
+                logger.warning(f"创建进程池失败，改用线程池: {e}")
+                self.kind = "thread"
+
+        self._inflight = 0
+        self.submitted = 0
+        self._waits = deque(maxlen=512)
+        """最近任务的排队等待时间（秒）"""
+        self._runs = deque(maxlen=512)
+        """最近任务的执行时间（秒）"""
+
+    async def _run(self, pool: Executor, func: Callable, *args, **kwargs) -> Any:
+        submitted_at = time.time()
+        self._inflight += 1
+        self.submitted += 1
+        try:
+            started_at, result = await asyncio.get_running_loop().run_in_executor(
+                pool, functools.partial(_timed_call, submitted_at, func, *args, **kwargs)
+            )
+        finally:
+            self._inflight -= 1
+        finished_at = time.time()
+        self._waits.append(max(0.0, started_at - submitted_at))
+        self._runs.append(max(0.0, finished_at - started_at))
+        return result
+
+    async def run_io(self, func: Callable, *args, **kwargs) -> Any:
+        """在线程池中执行阻塞的 IO 操作"""
+        return await self._run(self._thread_pool, func, *args, **kwargs)
+
+    async def run_cpu(self, func: Callable, *args, **kwargs) -> Any:
+        """执行 CPU 密集操作，func 及参数需可被 pickle（进程池模式下）"""
+        return await self._run(self._process_pool or self._thread_pool, func, *args, **kwargs)
+
+    def shutdown(self):
+        self._thread_pool.shutdown(wait=False)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, float]:
+        waits = sorted(self._waits)
+        runs = sorted(self._runs)
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "inflight": self._inflight,
+            "submitted": self.submitted,
+            "wait_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+            "wait_max": round(waits[-1], 4) if waits else 0.0,
+            "run_avg": round(sum(runs) / len(runs), 4) if runs else 0.0,
+        }
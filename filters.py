@@ -0,0 +1,101 @@
+"""
+消息过滤规则
+由插件配置一次性编译：指令前缀合并为一个正则，群白名单/黑名单和忽略的发送者使用集合，
+忽略规则的正则合并为一个；每条消息只需一次按消息长度线性的匹配，无需反复读取配置和遍历列表
+"""
+import re
+from typing import Callable, Iterable, Optional, Pattern, Tuple
+
+from astrbot.api import logger
+
+_BACKREF = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def _id_set(values: Optional[Iterable]) -> frozenset:
+    return frozenset(str(value).strip() for value in values or () if str(value).strip())
+
+
+def compile_prefixes(prefixes: Iterable[str]) -> Optional[Pattern]:
+    """将指令前缀合并为一个锚定在开头的正则（忽略开头空白），没有前缀时返回 None"""
+    prefixes = sorted({p for p in prefixes or () if p}, key=len, reverse=True)
+    if not prefixes:
+        return None
+    return re.compile(r"\s*(?:" + "|".join(map(re.escape, prefixes)) + ")")
+
+
+def compile_patterns(patterns: Iterable[str]) -> Tuple[Pattern, ...]:
+    """将忽略规则的正则合并为一个；无效的正则记录警告后跳过，使用了反向引用（合并后编号会错位）时逐个匹配"""
+    valid = []
+    for pattern in patterns or ():
+        if not pattern:
+            continue
+        try:
+            valid.append(re.compile(pattern))
+        except re.error as e:
+            logger.warning(f"忽略规则中的正则无效，已跳过: {pattern!r} ({e})")
+    if len(valid) <= 1 or any(_BACKREF.search(regex.pattern) for regex in valid):
+        return tuple(valid)
+    try:
+        return (re.compile("|".join(f"(?:{regex.pattern})" for regex in valid)),)
+    except re.error:
+        return tuple(valid)
+
+
+class MessageFilter:
+    """编译后的消息过滤规则"""
+
+    def __init__(
+        self,
+        enable_command_filter: bool = True,
+        command_prefixes: Iterable[str] = ("/",),
+        ignore_groups: Iterable = (),
+        ignore_senders: Iterable = (),
+        ignore_patterns: Iterable[str] = (),
+        enable_active_reply: bool = False,
+        ar_whitelist: Iterable = (),
+        ar_possibility: float = 0.1,
+    ):
+        self.command_regex = compile_prefixes(command_prefixes) if enable_command_filter else None
+        self.ignore_groups = _id_set(ignore_groups)
+        self.ignore_senders = _id_set(ignore_senders)
+        self.ignore_regexes = compile_patterns(ignore_patterns)
+        self.enable_active_reply = bool(enable_active_reply)
+        self.ar_whitelist = _id_set(ar_whitelist)
+        self.ar_possibility = float(ar_possibility)
+
+    @classmethod
+    def from_config(cls, get_cfg: Callable) -> "MessageFilter":
+        return cls(
+            enable_command_filter=bool(get_cfg("enable_command_filter", True)),
+            command_prefixes=get_cfg("command_prefixes", ["/"]),
+            ignore_groups=get_cfg("ignore_groups", []),
+            ignore_senders=get_cfg("ignore_senders", []),
+            ignore_patterns=get_cfg("ignore_patterns", []),
+            enable_active_reply=bool(get_cfg("enable_active_reply", False)),
+            ar_whitelist=get_cfg("ar_whitelist", []),
+            ar_possibility=float(get_cfg("ar_possibility", 0.1)),
+        )
+
+    def is_command(self, text: str) -> bool:
+        """是否为指令消息"""
+        return bool(text) and self.command_regex is not None and self.command_regex.match(text) is not None
+
+    def ignore_reason(self, umo: str, group_id, sender_id, text: str) -> Optional[str]:
+        """返回消息被忽略的原因，不忽略时返回 None"""
+        if self.ignore_groups and (umo in self.ignore_groups or str(group_id) in self.ignore_groups):
+            return "group"
+        if self.ignore_senders and str(sender_id) in self.ignore_senders:
+            return "sender"
+        if text and any(regex.search(text) for regex in self.ignore_regexes):
+            return "pattern"
+        if self.is_command(text):
+            return "command"
+        return None
+
+    def active_reply_allowed(self, umo: str, group_id) -> bool:
+        """群是否在主动回复白名单中（白名单为空时不限制）"""
+        if not self.enable_active_reply:
+            return False
+        if not self.ar_whitelist or umo in self.ar_whitelist:
+            return True
+        return not group_id or str(group_id) in self.ar_whitelist
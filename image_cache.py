@@ -0,0 +1,220 @@
+"""
+图片编码缓存
+以内容哈希为主键缓存 base64 编码结果，并维护 URL 到内容哈希的索引；
+相同内容的图片（无论来自哪个群、哪个URL）共享同一个编码字符串
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from astrbot.api import logger
+
+
+def content_hash(data: bytes) -> str:
+    """计算图片内容哈希"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def base64_hash(payload: str) -> str:
+    """计算 base64 图片数据的哈希（不解码，直接对 base64 文本计算）"""
+    return content_hash(payload.encode("ascii"))
+
+
+class ImageCache:
+    """按字节数限制的 LRU 图片编码缓存，可选磁盘二级缓存"""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_urls: int = 4096,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_urls = max(1, int(max_urls))
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        """内容哈希 -> data URI"""
+        self._urls: "OrderedDict[str, str]" = OrderedDict()
+        """URL -> 内容哈希"""
+        self._bytes = 0
+
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = max(0, int(disk_max_bytes))
+        self._disk_entries: "OrderedDict[str, int]" = OrderedDict()
+        """内容哈希 -> 文件大小，按最近使用排序"""
+        self._disk_bytes = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+        # 统计
+        self.url_hits = 0
+        self.hash_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- 内存层 ----------
+
+    def get_by_url(self, url: str) -> Optional[str]:
+        """按URL在内存中查找已编码的图片"""
+        key = self._urls.get(url)
+        if key is None:
+            return None
+        self._urls.move_to_end(url)
+        data_uri = self._entries.get(key)
+        if data_uri is None:
+            return None
+        self._entries.move_to_end(key)
+        self.url_hits += 1
+        return data_uri
+
+    def key_for_url(self, url: str) -> Optional[str]:
+        """返回URL对应图片的内容哈希（未缓存时返回 None）"""
+        return self._urls.get(url)
+
+    def get_by_hash(self, url: str, key: str) -> Optional[str]:
+        """按内容哈希在内存中查找已编码的图片，命中时建立URL索引"""
+        data_uri = self._entries.get(key)
+        if data_uri is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hash_hits += 1
+        self._link(url, key)
+        return data_uri
+
+    def put(self, url: str, key: str, data_uri: str) -> str:
+        """写入内存缓存，返回共享的 data URI 字符串"""
+        existing = self._entries.get(key)
+        if existing is not None:
+            self._link(url, key)
+            return existing
+        self.misses += 1
+        self._store_memory(key, data_uri)
+        self._link(url, key)
+        return data_uri
+
+    def promote(self, url: str, key: str, data_uri: str) -> str:
+        """将从磁盘读取的图片放入内存缓存；并发读取同一图片时，后到的结果复用已放入的字符串"""
+        self.disk_hits += 1
+        self._disk_entries.move_to_end(key)
+        existing = self._entries.get(key)
+        if existing is not None:
+            self._entries.move_to_end(key)
+            self._link(url, key)
+            return existing
+        self._store_memory(key, data_uri)
+        self._link(url, key)
+        return data_uri
+
+    def _link(self, url: str, key: str):
+        self._urls[url] = key
+        self._urls.move_to_end(url)
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+
+    def _store_memory(self, key: str, data_uri: str):
+        if self.max_bytes and len(data_uri) > self.max_bytes:
+            # 单张图片超过缓存上限时不进入内存层
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous)
+        self._entries[key] = data_uri
+        self._bytes += len(data_uri)
+        while self.max_bytes and self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    # ---------- 磁盘层 ----------
+    # 索引只在事件循环中维护；read_disk_file / write_disk_file / remove_disk_files
+    # 只做文件读写，可以放到线程池中执行
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.b64")
+
+    def _load_disk_index(self):
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            files = []
+            for name in os.listdir(self.disk_dir):
+                if not name.endswith(".b64"):
+                    continue
+                path = os.path.join(self.disk_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(files):
+                self._disk_entries[key] = size
+                self._disk_bytes += size
+        except OSError as e:
+            logger.error(f"加载图片磁盘缓存失败: {e}")
+            self.disk_dir = None
+
+    def on_disk(self, key: str) -> bool:
+        """磁盘层中是否存在该图片"""
+        return bool(self.disk_dir) and key in self._disk_entries
+
+    def read_disk_file(self, key: str) -> Optional[str]:
+        """读取磁盘缓存文件（阻塞）"""
+        try:
+            with open(self._disk_path(key), "r", encoding="ascii") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_disk_file(self, key: str, data_uri: str) -> bool:
+        """写入磁盘缓存文件（阻塞）"""
+        try:
+            # 临时文件名区分线程，避免并发写入同一图片时互相覆盖
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="ascii") as f:
+                f.write(data_uri)
+            os.replace(tmp_path, self._disk_path(key))
+            return True
+        except OSError as e:
+            logger.error(f"写入图片磁盘缓存失败: {e}")
+            return False
+
+    def remove_disk_files(self, keys: List[str]):
+        """删除磁盘缓存文件（阻塞）"""
+        for key in keys:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def record_disk(self, key: str, size: int) -> List[str]:
+        """记录新写入的磁盘缓存，返回因超出容量需要删除的文件"""
+        if key in self._disk_entries:
+            return []
+        self._disk_entries[key] = size
+        self._disk_bytes += size
+        evicted = []
+        while self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes and len(self._disk_entries) > 1:
+            evicted_key = next(iter(self._disk_entries))
+            self.forget_disk(evicted_key)
+            evicted.append(evicted_key)
+        return evicted
+
+    def forget_disk(self, key: str):
+        """从磁盘索引中移除（文件读取失败或被淘汰时）"""
+        size = self._disk_entries.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存命中统计"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "urls": len(self._urls),
+            "disk_entries": len(self._disk_entries),
+            "disk_bytes": self._disk_bytes,
+            "url_hits": self.url_hits,
+            "hash_hits": self.hash_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
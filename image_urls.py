@@ -0,0 +1,72 @@
+"""
+图片 URL 直传
+支持自行拉取 HTTP 图片的大模型服务商可以直接发送原始 URL，无需下载和 base64 编码；
+本地文件、base64 数据、已知短时有效的 URL 以及即将过期的签名 URL 仍需下载编码后内联
+"""
+import calendar
+import re
+import time
+from typing import Iterable, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+_UNIX_EXPIRY_PARAMS = ("expires", "x-expires", "x-oss-expires")
+"""以 Unix 时间戳表示过期时间的查询参数（小写）"""
+
+
+def _parse_amz_date(value: str) -> Optional[float]:
+    try:
+        return float(calendar.timegm(time.strptime(value, "%Y%m%dT%H%M%SZ")))
+    except (TypeError, ValueError):
+        return None
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """从签名 URL 的查询参数中解析过期时间（Unix 时间戳），无法识别时返回 None
+
+    支持 Expires / x-oss-expires 形式的时间戳、AWS/GCS 的 X-Amz-Date + X-Amz-Expires 以及 COS 的 q-sign-time
+    """
+    query = urlsplit(url).query
+    if not query:
+        return None
+    params = {key.lower(): value for key, value in parse_qsl(query)}
+    for key in _UNIX_EXPIRY_PARAMS:
+        if params.get(key, "").isdigit():
+            return float(params[key])
+    for prefix in ("x-amz-", "x-goog-"):
+        start = _parse_amz_date(params.get(f"{prefix}date"))
+        if start is not None and params.get(f"{prefix}expires", "").isdigit():
+            return start + int(params[f"{prefix}expires"])
+    sign_time = params.get("q-sign-time", "").split(";")
+    if len(sign_time) == 2 and sign_time[1].isdigit():
+        return float(sign_time[1])
+    return None
+
+
+class UrlPassthroughPolicy:
+    """按服务商决定图片是否以原始 URL 发送
+
+    - providers 为启用直传的服务商 ID，包含 "*" 时对所有服务商启用
+    - 匹配 short_lived_patterns 中任一子串的 URL 视为短时有效，总是内联
+    - 解析出过期时间且距过期不足 expiry_margin 秒的 URL 内联（此时仍可下载）
+    """
+
+    def __init__(self, providers: Iterable[str] = (), short_lived_patterns: Iterable[str] = (),
+                 expiry_margin: float = 300):
+        self.providers = frozenset(str(p).strip() for p in providers or () if str(p).strip())
+        patterns = [re.escape(p) for p in short_lived_patterns or () if p]
+        self.short_lived = re.compile("|".join(patterns)) if patterns else None
+        self.expiry_margin = max(0.0, float(expiry_margin))
+
+    def enabled_for(self, provider_id: str) -> bool:
+        return bool(self.providers) and ("*" in self.providers or provider_id in self.providers)
+
+    def inline_reason(self, url: str, now: Optional[float] = None) -> Optional[str]:
+        """返回需要内联的原因，可以直接发送 URL 时返回 None"""
+        if not url.startswith(("http://", "https://")):
+            return "not_http"
+        if self.short_lived is not None and self.short_lived.search(url):
+            return "short_lived"
+        expires_at = url_expiry(url)
+        if expires_at is not None and expires_at - (now or time.time()) < self.expiry_margin:
+            return "expiring"
+        return None
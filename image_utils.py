@@ -0,0 +1,173 @@
+"""
+图片规范化工具
+识别图片真实格式，按最长边缩放并重新压缩到目标质量/字节预算，GIF 取第一帧；
+均为同步的 CPU 密集操作，应在执行器（线程池或进程池）中执行
+"""
+import base64
+import io
+import struct
+from typing import Optional, Tuple
+
+try:
+    from PIL import Image as PILImage
+    HAS_PIL = True
+except ImportError:
+    PILImage = None
+    HAS_PIL = False
+
+_PASSTHROUGH_MIMES = {"image/jpeg", "image/png", "image/webp"}
+"""无需转换格式即可直接发送给大模型的图片格式"""
+
+_MIN_EDGE = 256
+_MIN_QUALITY = 40
+
+
+def sniff_mime(data: bytes) -> str:
+    """根据文件头识别图片格式，无法识别时按 image/jpeg 处理"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    return "image/jpeg"
+
+
+def _flatten(img):
+    """取第一帧并转换为不带透明通道的 RGB 图像（透明部分填充白色）"""
+    if getattr(img, "is_animated", False):
+        img.seek(0)
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = PILImage.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert("RGB")
+
+
+def _encode_jpeg(img, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def normalize_image(
+    data: bytes,
+    max_edge: int = 0,
+    quality: int = 85,
+    max_bytes: int = 0,
+) -> Tuple[bytes, str, Optional[Tuple[int, int]]]:
+    """规范化图片，返回 (图片数据, MIME类型, (宽, 高))
+
+    - 格式为 JPEG/PNG/WEBP、尺寸和大小均未超出限制的图片原样返回
+    - 其余图片（超出限制、GIF、BMP 等）缩放到 max_edge 以内并重新编码为 JPEG，
+      超出 max_bytes 时逐步降低质量，仍超出时继续缩小尺寸
+    - 未安装 Pillow 或解码失败时只识别格式，原样返回
+    """
+    mime = sniff_mime(data)
+    if not HAS_PIL:
+        return data, mime, None
+
+    try:
+        img = PILImage.open(io.BytesIO(data))
+        size = img.size
+        needs_reencode = (
+            mime not in _PASSTHROUGH_MIMES
+            or (max_edge and max(size) > max_edge)
+            or (max_bytes and len(data) > max_bytes)
+        )
+        if not needs_reencode:
+            return data, mime, size
+
+        img = _flatten(img)
+        if max_edge and max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+
+        output = _encode_jpeg(img, quality)
+        while max_bytes and len(output) > max_bytes and quality > _MIN_QUALITY:
+            quality = max(_MIN_QUALITY, quality - 10)
+            output = _encode_jpeg(img, quality)
+        while max_bytes and len(output) > max_bytes and min(img.size) > _MIN_EDGE:
+            img = img.resize((int(img.width * 0.75), int(img.height * 0.75)), PILImage.LANCZOS)
+            output = _encode_jpeg(img, quality)
+
+        # 原图格式可直接发送且比重新编码的结果更小时，保留原图
+        if mime in _PASSTHROUGH_MIMES and len(data) <= len(output) and img.size == size:
+            return data, mime, size
+        return output, "image/jpeg", img.size
+    except Exception:
+        return data, mime, None
+
+
+def encode_data_uri(
+    data: bytes,
+    normalize: bool = True,
+    max_edge: int = 0,
+    quality: int = 85,
+    max_bytes: int = 0,
+) -> str:
+    """（可选地）规范化图片并编码为 data URI"""
+    if normalize:
+        data, mime, _ = normalize_image(data, max_edge=max_edge, quality=quality, max_bytes=max_bytes)
+    else:
+        mime = sniff_mime(data)
+    return f"data:{mime};base64," + base64.b64encode(data).decode("utf-8")
+
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """只解析文件头获取图片尺寸 (宽, 高)，支持 PNG/GIF/WEBP/JPEG，无法解析时返回 None"""
+    try:
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return struct.unpack(">II", data[16:24])
+        if data[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", data[6:10])
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8X":
+                return (
+                    int.from_bytes(data[24:27], "little") + 1,
+                    int.from_bytes(data[27:30], "little") + 1,
+                )
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            return None
+        if data.startswith(b"\xff\xd8"):
+            i = 2
+            while i + 9 <= len(data):
+                if data[i] != 0xFF:
+                    i += 1
+                    continue
+                marker = data[i + 1]
+                if marker in _JPEG_SOF_MARKERS:
+                    height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                    return width, height
+                if marker == 0xFF or 0xD0 <= marker <= 0xD9:
+                    i += 2 if marker != 0xFF else 1
+                    continue
+                i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    except struct.error:
+        pass
+    return None
+
+
+def data_uri_image_size(data_uri: str, head_chars: int = 65536) -> Optional[Tuple[int, int]]:
+    """从 data URI 的开头部分解析图片尺寸，不解码整张图片"""
+    _, sep, payload = data_uri.partition(";base64,")
+    if not sep:
+        return None
+    head = payload[:head_chars]
+    try:
+        return image_size(base64.b64decode(head[:len(head) - len(head) % 4]))
+    except ValueError:
+        return None
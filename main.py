@@ -1,9 +1,12 @@
-import datetime
+import asyncio
+import base64
+import json
+import os
 import random
+import time
 import traceback
 import uuid
-from collections import defaultdict
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
@@ -14,6 +17,42 @@ from astrbot.api.platform import MessageType
 import astrbot.api.message_components as Comp
 from astrbot.core.utils.io import download_image_by_url
 
+from .buffer import BufferSlot, GroupMessageBuffer, IndexedMessage, MessageIndex
+from .cache import SingleFlight, TTLCache
+from .caption_worker import CaptionWorkerPool
+from .image_cache import ImageCache, base64_hash, content_hash
+from .executor import BlockingExecutor, read_file
+from .filters import MessageFilter
+from .image_urls import UrlPassthroughPolicy
+from .image_utils import HAS_PIL, data_uri_image_size, encode_data_uri, sniff_mime
+from .metrics import Metrics, timed
+from .persistence import BufferJournal
+from .records import CaptionRef, ImageRef, MessageRecord, Text, dedupe_key
+from .rounds import (
+    common_prefix,
+    compact_contexts,
+    compact_history_json,
+    find_round_ends,
+    has_images,
+    message_fingerprint,
+    strip_message_images,
+)
+from .scheduler import ActiveReplyScheduler
+from .store import KVSessionStore, MemorySessionStore, SessionStore
+from .tokens import (
+    DEFAULT_IMAGE_TOKENS,
+    PLACEHOLDER_TOKENS,
+    estimate_content_tokens,
+    estimate_image_tokens,
+    estimate_record_tokens,
+    estimate_text_tokens,
+)
+
+try:
+    from astrbot.api.star import StarTools
+except ImportError:
+    StarTools = None
+
 try:
     from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import AiocqhttpMessageEvent
     IS_AIOCQHTTP = True
@@ -21,6 +60,19 @@ except ImportError:
     IS_AIOCQHTTP = False
 
 
+QUOTE_MAX_CHARS = 100
+"""引用回复时被回复消息的最大预览长度"""
+JOURNAL_PRUNE_INTERVAL = 600
+"""清理持久化记录的间隔（秒）"""
+METRICS_FILE_NAME = "metrics.prom"
+ACTIVE_REPLY_EXTRA = "group_context_active_reply"
+"""标记主动回复请求的事件附加数据键，收到该事件的回复时才释放调度状态"""
+SUMMARY_PREFIX = "【较早的群聊消息摘要】"
+DEFAULT_SUMMARY_PROMPT = (
+    "请将群聊记录整合为一段简洁的摘要，保留主要话题、各参与者的关键观点、提到的重要信息和尚未解决的问题，"
+    "不要逐条复述，不超过 {max_chars} 字。只输出摘要内容。"
+)
+
 """
 群聊上下文感知插件
 优化群聊上下文增强功能,提供群聊记录追踪、主动回复、图片描述等功能
@@ -31,32 +83,184 @@ class GroupContextPlugin(Star):
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config  # AstrBotConfig继承自Dict,可以直接使用字典方法访问
-        self.session_chats = defaultdict(list)
-        """记录群成员的群聊记录，每个元素是包含多模态内容的列表"""
+        # token 预算配置（启用后替代按轮数的裁剪）
+        self.token_budget = int(self.get_cfg("token_budget", 0))
+        self.default_image_tokens = int(self.get_cfg("default_image_tokens", DEFAULT_IMAGE_TOKENS))
+        self.image_size_memo = TTLCache(maxsize=4096, ttl=0)
+        """图片尺寸缓存，键为 data URI 的指纹"""
+
+        # 群聊消息缓冲区配置
+        self.buffer_max_messages = int(self.get_cfg("buffer_max_messages", 300))
+        self.buffer_max_mb = float(self.get_cfg("buffer_max_mb", 32))
+        self.buffer_max_age_minutes = float(self.get_cfg("buffer_max_age_minutes", 0))
+        self.buffer_idle_group_minutes = float(self.get_cfg("buffer_idle_group_minutes", 1440))
+        self.dedupe_window_seconds = float(self.get_cfg("dedupe_window_seconds", 60))
+        """连续的相同消息（复读）在该时间窗口内折叠为一条，0 表示不折叠"""
+        self.session_chats = GroupMessageBuffer(
+            max_messages=self.buffer_max_messages,
+            max_bytes=int(self.buffer_max_mb * 1024 * 1024),
+            max_age=self.buffer_max_age_minutes * 60,
+            idle_ttl=self.buffer_idle_group_minutes * 60,
+            token_estimator=self._estimate_record_tokens if self.token_budget > 0 else None,
+            on_group_evicted=self._on_group_evicted,
+            dedupe_window=self.dedupe_window_seconds,
+            dedupe_key=dedupe_key,
+        )
+        """记录群成员的群聊记录，每个元素是一条消息记录"""
         self.active_reply_sessions = set()
         """记录当前是主动回复的会话"""
 
+        self.ingest_wait_timeout = float(self.get_cfg("ingest_wait_timeout", 3))
+        """请求时等待仍在构建中的消息的最长时间（秒）"""
+
+        # 缓冲溢出摘要配置
+        self.enable_overflow_summary = bool(self.get_cfg("enable_overflow_summary", False))
+        self.overflow_threshold = int(self.get_cfg("overflow_threshold", 100))
+        self.overflow_keep_recent = int(self.get_cfg("overflow_keep_recent", 30))
+        self.summary_provider_id = self.get_cfg("summary_provider_id", "")
+        self.summary_max_chars = int(self.get_cfg("summary_max_chars", 500))
+        self.summary_prompt = self.get_cfg("summary_prompt", "") or DEFAULT_SUMMARY_PROMPT
+        self.summary_wait_timeout = float(self.get_cfg("summary_wait_timeout", 30))
+        """请求时等待正在进行的摘要的最长时间（秒），超时则取消摘要，改为发送这些消息的原文"""
+        self.group_summaries = {}
+        """每个群自上一次请求以来较早消息的滚动摘要"""
+        self._summary_tasks = {}
+        self._summary_records: Dict[str, List[MessageRecord]] = {}
+        """正在摘要的消息，摘要未能及时完成时放回缓冲区"""
+        self.summary_backoff = TTLCache(maxsize=1024, ttl=60)
+        """摘要失败的群，一段时间内不再重试"""
+
+        # 会话存储配置（多个实例共享群聊缓冲）
+        self.session_store = self._create_session_store()
+        """群聊缓冲的存储，共享存储时各实例写入的消息在请求时统一取出"""
+
+        # 群聊缓冲持久化配置（共享存储本身即保存了缓冲消息，此时不再使用本地持久化）
+        self.enable_persistence = bool(self.get_cfg("enable_persistence", False)) and not self.session_store.shared
+        self.journal = BufferJournal(os.path.join(self.get_data_dir(), "buffer.db")) if self.enable_persistence else None
+        """群聊缓冲的持久化日志，重启后按群懒加载恢复"""
+        self._restored_groups = set()
+        self.restore_flight = SingleFlight()
+        self._background_tasks = []
+
         # 合并转发相关配置
         self.enable_forward_analysis = bool(self.get_cfg("enable_forward_analysis", True))
         self.forward_prefix = "【合并转发内容】"
+        self.forward_cache = TTLCache(
+            maxsize=1024,
+            ttl=float(self.get_cfg("forward_cache_ttl_minutes", 30)) * 60,
+        )
+        """合并转发内容缓存，键为 forward_id"""
+        self.reply_cache = TTLCache(
+            maxsize=4096,
+            ttl=float(self.get_cfg("reply_cache_ttl_minutes", 10)) * 60,
+        )
+        """被回复消息缓存，键为 message_id"""
+        self.onebot_flight = SingleFlight()
+        self.message_index = MessageIndex(max_messages=int(self.get_cfg("message_index_size", 500)))
+        """按群记录的消息ID索引，回复已记录的消息时无需调用平台接口"""
+        self.reply_quote_inline = bool(self.get_cfg("reply_quote_inline", False))
 
         # 图片处理相关配置
         self.enable_image_recognition = bool(self.get_cfg("enable_image_recognition", True))
         self.image_caption = bool(self.get_cfg("image_caption", False))
         self.image_caption_provider_id = self.get_cfg("image_caption_provider_id", "")
         self.image_carry_rounds = int(self.get_cfg("image_carry_rounds", 1))
+        self.request_image_limit = int(self.get_cfg("request_image_limit", 0))
+        self.image_concurrency = int(self.get_cfg("image_concurrency", 4))
+        self.image_timeout = float(self.get_cfg("image_timeout", 30))
+        self.url_policy = UrlPassthroughPolicy(
+            providers=self.get_cfg("image_url_passthrough_providers", []),
+            short_lived_patterns=self.get_cfg("image_url_short_lived_patterns", ["rkey="]),
+            expiry_margin=float(self.get_cfg("image_url_expiry_margin_seconds", 300)),
+        )
+        """按服务商直接发送图片原始 URL 的策略"""
+
+        # 图片描述缓存与后台队列配置
+        self.caption_cache = TTLCache(
+            maxsize=int(self.get_cfg("caption_cache_size", 2048)),
+            ttl=float(self.get_cfg("caption_cache_ttl_minutes", 1440)) * 60,
+        )
+        """图片描述缓存，键为 (图片内容哈希, 提供商ID, 提示词)"""
+        self.caption_flight = SingleFlight()
+        self.caption_workers = CaptionWorkerPool(
+            lambda url: self.get_image_caption(url, self.image_caption_provider_id),
+            workers=int(self.get_cfg("caption_workers", 2)),
+            queue_size=int(self.get_cfg("caption_queue_size", 256)),
+            timeout=self.image_timeout,
+        )
+        """后台图片描述任务池，消息记录不再等待描述完成"""
+        self.caption_jobs_by_file = TTLCache(maxsize=1024, ttl=3600)
+        """图片文件标识 -> 描述任务ID，重复发送的同一张图片（如复读的表情包）共用一个任务"""
+        self.caption_keys_by_url = TTLCache(maxsize=1024, ttl=3600)
+        """图片URL -> 内容哈希，已描述过的图片再次查询描述时无需重新读取"""
+        self.caption_wait_timeout = float(self.get_cfg("caption_wait_timeout", 10))
+
+        # 图片规范化配置
+        self.image_normalize = bool(self.get_cfg("image_normalize", True))
+        self.image_max_edge = int(self.get_cfg("image_max_edge", 1568))
+        self.image_jpeg_quality = int(self.get_cfg("image_jpeg_quality", 85))
+        self.image_max_kb = int(self.get_cfg("image_max_kb", 1024))
+        self.image_variant = (
+            f"-e{self.image_max_edge}q{self.image_jpeg_quality}b{self.image_max_kb}" if self.image_normalize else ""
+        )
+        """规范化参数标识，参数变化后不会命中旧的磁盘缓存"""
+
+        # 阻塞任务执行器配置
+        self.executor = BlockingExecutor(
+            max_workers=int(self.get_cfg("io_pool_size", 4)),
+            kind=self.get_cfg("io_pool_type", "thread"),
+        )
+        """图片路径中的文件读写、哈希、规范化和编码都在该执行器中进行"""
+
+        # 图片编码缓存配置
+        self.image_cache_max_mb = float(self.get_cfg("image_cache_max_mb", 64))
+        self.image_cache_disk = bool(self.get_cfg("image_cache_disk", False))
+        self.image_cache_disk_max_mb = float(self.get_cfg("image_cache_disk_max_mb", 256))
+        self.image_cache = ImageCache(
+            max_bytes=int(self.image_cache_max_mb * 1024 * 1024),
+            disk_dir=os.path.join(self.get_data_dir(), "image_cache") if self.image_cache_disk else None,
+            disk_max_bytes=int(self.image_cache_disk_max_mb * 1024 * 1024),
+        )
 
         self.active_reply_prompt = self.get_cfg("active_reply_prompt", "You are now in a chatroom. The chat history is as above. Now, new messages are coming. Please react to it. Only output your response and do not output any other information.")
         self.normal_reply_prompt = self.get_cfg("normal_reply_prompt", "You are now in a chatroom. The chat history is as above. Now, new messages are coming. Please react to it.")
 
+        # 主动回复调度：按群限流，刷屏时防抖合并为一次回复
+        self.reply_scheduler = ActiveReplyScheduler(
+            capacity=int(self.get_cfg("ar_max_replies", 3)),
+            refill_seconds=float(self.get_cfg("ar_refill_seconds", 600)),
+            debounce=float(self.get_cfg("ar_debounce_seconds", 5)),
+            max_delay=float(self.get_cfg("ar_max_delay_seconds", 30)),
+        )
+
         # 私聊场景控制配置
         self.enable_private_control = bool(self.get_cfg("enable_private_control", False))
         self.private_conversation_rounds_limit = int(self.get_cfg("private_conversation_rounds_limit", 10))
         self.private_image_carry_rounds = int(self.get_cfg("private_image_carry_rounds", 5))
 
-        # 指令消息过滤配置
-        self.enable_command_filter = bool(self.get_cfg("enable_command_filter", True))
-        self.command_prefixes = self.get_cfg("command_prefixes", ["/"])
+        # 消息过滤规则（指令前缀、忽略规则、主动回复白名单），插件重载时重新编译
+        self.message_filter = MessageFilter.from_config(self.get_cfg)
+        self.conversation_rounds_limit = int(self.get_cfg("conversation_rounds_limit", 10))
+
+        # 稳定前缀模式：历史按整块裁剪且不再改写，便于服务商的提示词前缀缓存命中
+        self.enable_stable_prefix = bool(self.get_cfg("enable_stable_prefix", False))
+        self.stable_prefix_chunk = max(1, int(self.get_cfg("stable_prefix_chunk_rounds", 4)))
+        self.sent_fingerprints = TTLCache(maxsize=1024, ttl=86400)
+        """每个群上一次请求的消息指纹，用于统计与本次请求相同的前缀长度"""
+        self.image_caption_prompt = self.get_cfg("image_caption_prompt", "请描述这张图片的内容")
+
+        # 运行指标配置
+        self.metrics = Metrics()
+        """各阶段耗时、API 调用和占位回退计数"""
+        self.metrics.add_collector(self._collect_metrics)
+        self.metrics_file_interval = float(self.get_cfg("metrics_file_interval", 0))
+        self.metrics_file = os.path.join(self.get_data_dir(), METRICS_FILE_NAME)
+
+        # 已保存对话历史的后台压缩配置
+        self.history_compaction_interval = float(self.get_cfg("history_compaction_interval_minutes", 0)) * 60
+        self.history_compaction_idle = float(self.get_cfg("history_compaction_idle_minutes", 10)) * 60
+        self._history_sessions: Dict[str, Tuple[bool, float]] = {}
+        """上次压缩后发生过请求的会话：umo -> (是否私聊, 最近一次请求时间)"""
 
         logger.info("群聊上下文感知插件已初始化")
         logger.info(f"合并转发分析: {'已启用' if self.enable_forward_analysis else '已禁用'}")
@@ -64,6 +268,23 @@ class GroupContextPlugin(Star):
         if self.enable_image_recognition:
             logger.info(f"图片处理模式: {'转述描述' if self.image_caption else 'URL注入'}")
             logger.info(f"图片携带轮数: {self.image_carry_rounds}")
+            if self.image_normalize and not HAS_PIL:
+                logger.warning("未安装 Pillow，图片规范化仅识别格式，不进行缩放和压缩")
+            logger.info(f"图片缓存: 内存 {self.image_cache_max_mb} MB, 磁盘缓存{'已启用' if self.image_cache_disk else '已禁用'}")
+        logger.info(f"群聊缓冲上限: {self.buffer_max_messages} 条 / {self.buffer_max_mb} MB")
+        logger.info(f"群聊缓冲持久化: {'已启用' if self.enable_persistence else '已禁用'}")
+        if self.session_store.shared:
+            logger.info(f"共享会话存储: {self.session_store.client.host}:{self.session_store.client.port}，键前缀 {self.session_store.prefix}")
+        if self.enable_overflow_summary:
+            logger.info(f"缓冲溢出摘要: 超过 {self.overflow_threshold} 条时摘要较早消息，保留最近 {self.overflow_keep_recent} 条原文")
+        if self.token_budget > 0:
+            logger.info(f"token 预算模式: 已启用，预算 {self.token_budget}")
+        if self.enable_stable_prefix:
+            logger.info(f"稳定前缀模式: 已启用，每 {self.stable_prefix_chunk} 轮整块裁剪")
+            if self.token_budget > 0:
+                logger.warning("token 预算模式下历史按预算裁剪，稳定前缀模式只保留历史中的提示词并统计前缀长度")
+        if self.metrics_file_interval > 0:
+            logger.info(f"运行指标文件: {self.metrics_file}，每 {self.metrics_file_interval:g} 秒更新")
         logger.info(f"私聊控制: {'已启用' if self.enable_private_control else '已禁用'}")
         if self.enable_private_control:
             logger.info(f"私聊对话轮数: {self.private_conversation_rounds_limit}")
@@ -73,15 +294,231 @@ class GroupContextPlugin(Star):
         """从插件配置中获取配置项"""
         return self.config.get(key, default)
 
+    def _ensure_background_tasks(self):
+        """在事件循环中首次收到消息时启动后台任务"""
+        if self._background_tasks:
+            return
+        if self.journal:
+            self._background_tasks.append(asyncio.create_task(self._journal_prune_loop()))
+        if self.metrics_file_interval > 0:
+            self._background_tasks.append(asyncio.create_task(self._metrics_file_loop()))
+        if self.history_compaction_interval > 0:
+            self._background_tasks.append(asyncio.create_task(self._history_compaction_loop()))
+
+    async def _metrics_file_loop(self):
+        """定期将运行指标以 Prometheus 文本格式写入本地文件"""
+        while True:
+            await asyncio.sleep(self.metrics_file_interval)
+            try:
+                await self.executor.run_io(self.metrics.write_prometheus, self.metrics_file)
+            except Exception as e:
+                logger.error(f"写入运行指标文件失败: {e}")
+
+    async def _history_compaction_loop(self):
+        """定期压缩已保存的对话历史"""
+        while True:
+            await asyncio.sleep(self.history_compaction_interval)
+            try:
+                await self.compact_histories()
+            except Exception as e:
+                logger.error(f"压缩对话历史失败: {e}")
+
+    def _note_history_session(self, umo: str, private: bool):
+        """记录发生过请求的会话，供后台压缩其对话历史"""
+        if self.history_compaction_interval > 0:
+            self._history_sessions[umo] = (private, time.time())
+
+    async def compact_histories(self) -> int:
+        """压缩空闲会话已保存的对话历史，返回回收的字节数
+
+        只处理上次压缩后发生过请求、且已空闲 history_compaction_idle 秒的会话，
+        避免与正在进行的请求同时写入对话历史
+        """
+        deadline = time.time() - self.history_compaction_idle
+        reclaimed = 0
+        sessions = 0
+        for umo, (private, last_request) in list(self._history_sessions.items()):
+            if last_request > deadline:
+                continue
+            self._history_sessions.pop(umo, None)
+            try:
+                saved = await self._compact_history(umo, private)
+            except Exception as e:
+                logger.error(f"压缩对话历史失败 {umo}: {e}")
+                continue
+            if saved:
+                reclaimed += saved
+                sessions += 1
+        if reclaimed:
+            logger.info(f"已压缩 {sessions} 个会话的对话历史，回收 {reclaimed / 1024:.1f} KB")
+        return reclaimed
+
+    async def _compact_history(self, umo: str, private: bool) -> int:
+        """按轮数上限和图片携带轮数重写一个会话当前的对话历史，返回回收的字节数
+
+        token 预算模式下群聊请求不按轮数裁剪（由预算决定保留多少历史），此时不压缩群聊历史
+        """
+        if not private and self.token_budget > 0:
+            return 0
+        manager = self.context.conversation_manager
+        cid = await manager.get_curr_conversation_id(umo)
+        if not cid:
+            return 0
+        history = await self._read_history(umo, cid)
+        if not history:
+            return 0
+
+        if private:
+            limits = (self.private_conversation_rounds_limit, self.private_image_carry_rounds, 1)
+        else:
+            chunk = self.stable_prefix_chunk if self.enable_stable_prefix else 1
+            limits = (self.conversation_rounds_limit, self.image_carry_rounds, chunk)
+        # 与请求时相同的规则，压缩不会改变下一次请求实际发送的内容
+        compacted, before, after = await self.executor.run_cpu(compact_history_json, history, *limits)
+        if after >= before:
+            return 0
+        # 压缩期间会话可能已被新的请求或回复更新，写回前重新读取，有变化则放弃本次压缩，下一轮再处理
+        if umo in self._history_sessions or await self._read_history(umo, cid) != history:
+            self.metrics.inc("history_compactions_aborted")
+            return 0
+        await manager.update_conversation(umo, cid, compacted)
+        self.metrics.inc("history_bytes_reclaimed", before - after, kind="private" if private else "group")
+        self.metrics.inc("history_compactions", kind="private" if private else "group")
+        return before - after
+
+    async def _read_history(self, umo: str, cid: str) -> Optional[str]:
+        """读取会话当前的对话历史，统一为 JSON 字符串"""
+        conv = await self.context.conversation_manager.get_conversation(umo, cid)
+        history = getattr(conv, "history", None) if conv else None
+        if not history:
+            return None
+        if not isinstance(history, str):
+            history = json.dumps(history, ensure_ascii=False)
+        return history
+
+    def _create_session_store(self) -> SessionStore:
+        """按配置创建会话存储，共享存储配置有误时回退到内存存储"""
+        kind = self.get_cfg("session_store", "memory")
+        if kind != "kv":
+            return MemorySessionStore()
+        try:
+            store = KVSessionStore(
+                self.get_cfg("session_store_url", "redis://127.0.0.1:6379/0"),
+                prefix=self.get_cfg("session_store_prefix", "group_context"),
+                max_messages=self.buffer_max_messages,
+                idle_ttl=self.buffer_idle_group_minutes * 60,
+                flush_interval=float(self.get_cfg("session_store_flush_ms", 50)) / 1000,
+                caption_ttl=float(self.get_cfg("caption_cache_ttl_minutes", 1440)) * 60,
+            )
+        except ValueError as e:
+            logger.error(f"共享会话存储配置有误，使用内存存储: {e}")
+            return MemorySessionStore()
+        if self.enable_overflow_summary:
+            logger.warning("使用共享会话存储时不支持缓冲溢出摘要，已忽略该配置")
+            self.enable_overflow_summary = False
+        return store
+
+    def _collect_metrics(self):
+        """采集缓冲区、缓存和队列的当前状态"""
+        for umo, stats in self.session_chats.group_stats().items():
+            for key, value in stats.items():
+                yield f"buffer_{key}", {"group": umo}, value
+        for name, stats in (
+            ("image", self.image_cache.stats()),
+            ("caption", self.caption_cache.stats()),
+            ("forward", self.forward_cache.stats()),
+            ("reply", self.reply_cache.stats()),
+            ("message_index", self.message_index.stats()),
+        ):
+            for key in ("hits", "url_hits", "hash_hits", "disk_hits", "misses", "evictions"):
+                if key in stats:
+                    yield f"cache_{key}", {"cache": name}, stats[key]
+        caption_stats = self.caption_workers.stats()
+        yield "caption_queue_depth", {}, caption_stats["queue_depth"]
+        yield "caption_dropped", {}, caption_stats["dropped"]
+        yield "executor_inflight", {}, self.executor.stats()["inflight"]
+        buffer_stats = self.session_chats.stats()
+        yield "buffer_evicted_messages", {}, buffer_stats["evicted_messages"]
+        yield "buffer_evicted_groups", {}, buffer_stats["evicted_groups"]
+        yield "buffer_collapsed_messages", {}, buffer_stats["collapsed_messages"]
+        for key, value in self.reply_scheduler.stats().items():
+            yield f"active_reply_{key}", {}, value
+        for key, value in self.session_store.stats().items():
+            yield f"session_store_{key}", {}, value
+
+    async def _journal_prune_loop(self):
+        """定期清除持久化记录中已超出缓冲区上限的消息"""
+        while True:
+            await asyncio.sleep(JOURNAL_PRUNE_INTERVAL)
+            try:
+                removed = await self.journal.prune(self.buffer_max_messages, self.buffer_max_age_minutes * 60)
+                if removed:
+                    logger.debug(f"群聊缓冲持久化 | 清除了 {removed} 条过期记录")
+            except Exception as e:
+                logger.error(f"清理群聊缓冲持久化记录失败: {e}")
+
+    async def _ensure_restored(self, umo: str):
+        """首次访问某个群时，从持久化记录中恢复其缓冲消息和主动回复标记"""
+        if not self.journal or umo in self._restored_groups:
+            return
+
+        async def restore():
+            if umo in self._restored_groups:
+                return
+            try:
+                messages, active = await self.journal.load(umo)
+            except Exception as e:
+                logger.error(f"恢复群聊缓冲失败: {e}")
+                messages, active = [], False
+            # 恢复的消息早于恢复前已预留位置的消息，放到缓冲区最前面；重启前的图片描述任务已不存在，重新提交
+            self.session_chats.restore(umo, self._localize_captions(messages))
+            if active:
+                self.active_reply_sessions.add(umo)
+            self._restored_groups.add(umo)
+            if messages:
+                logger.info(f"群聊上下文 | {umo} | 从持久化记录恢复了 {len(messages)} 条缓冲消息")
+
+        await self.restore_flight.do(umo, restore)
+
+    def _on_group_evicted(self, umo: str):
+        """空闲群被整体淘汰时，清除其持久化记录和滚动摘要"""
+        self._clear_journal(umo)
+        self.group_summaries.pop(umo, None)
+
+    def _clear_journal(self, umo: str):
+        """缓冲消息被消费或淘汰后，清除对应的持久化记录"""
+        if self.journal:
+            self.journal.clear_group(umo)
+
+    def _mark_active_reply(self, umo: str):
+        """标记会话为主动回复"""
+        self.active_reply_sessions.add(umo)
+        if self.journal:
+            self.journal.set_active(umo, True)
+
+    def _pop_active_reply(self, umo: str) -> bool:
+        """读取并清除会话的主动回复标记"""
+        if umo not in self.active_reply_sessions:
+            return False
+        self.active_reply_sessions.discard(umo)
+        if self.journal:
+            self.journal.set_active(umo, False)
+        return True
+
+    def get_data_dir(self) -> str:
+        """获取插件数据目录"""
+        if StarTools is not None:
+            try:
+                return str(StarTools.get_data_dir("astrbot_plugin_group_context"))
+            except Exception as e:
+                logger.debug(f"获取插件数据目录失败，使用默认目录: {e}")
+        data_dir = os.path.join(os.getcwd(), "data", "plugin_data", "astrbot_plugin_group_context")
+        os.makedirs(data_dir, exist_ok=True)
+        return data_dir
+
     def is_command(self, message: str) -> bool:
         """检测是否为指令消息"""
-        if not self.enable_command_filter or not message:
-            return False
-        message = message.strip()
-        for prefix in self.command_prefixes:
-            if message.startswith(prefix):
-                return True
-        return False
+        return self.message_filter.is_command(message)
 
     def _extract_image_url(self, image_data) -> Optional[str]:
         """从不同格式的图片数据中提取URL
@@ -119,6 +556,49 @@ class GroupContextPlugin(Star):
 
         return None
 
+    @staticmethod
+    def _bot_key(event) -> str:
+        """区分不同机器人账号的缓存键前缀"""
+        try:
+            return str(event.get_self_id())
+        except Exception:
+            return ""
+
+    async def _get_reply_message(self, event, message_id) -> Optional[dict]:
+        """获取被回复的原始消息（get_msg），结果按 message_id 缓存，并发请求合并为一次调用"""
+        key = ("get_msg", self._bot_key(event), str(message_id))
+        cached = self.reply_cache.get(key)
+        if cached is not None:
+            return cached
+
+        async def call():
+            self.metrics.inc("api_calls", action="get_msg")
+            original_msg = await event.bot.api.call_action('get_msg', message_id=message_id)
+            if original_msg:
+                self.reply_cache.set(key, original_msg)
+            return original_msg
+
+        return await self.onebot_flight.do(key, call)
+
+    async def _get_forward_messages(self, event, forward_id: str) -> list:
+        """获取合并转发的消息节点（get_forward_msg），非空结果按 forward_id 缓存，并发请求合并为一次调用"""
+        key = ("get_forward_msg", self._bot_key(event), str(forward_id))
+        cached = self.forward_cache.get(key)
+        if cached is not None:
+            return cached
+
+        async def call():
+            self.metrics.inc("api_calls", action="get_forward_msg")
+            forward_data = await event.bot.api.call_action('get_forward_msg', id=forward_id)
+            messages = (forward_data or {}).get("messages") or []
+            # 只缓存成功取到的节点；失败或空结果可能是暂时的（消息尚未同步等），下次重新获取
+            if messages:
+                self.forward_cache.set(key, messages)
+            return messages
+
+        return await self.onebot_flight.do(key, call)
+
+    @timed("forward_detect")
     async def _detect_forward_message(self, event) -> Optional[str]:
         """检测合并转发消息并返回forward_id"""
         logger.debug(f"_detect_forward_message | IS_AIOCQHTTP={IS_AIOCQHTTP}, isinstance(event, AiocqhttpMessageEvent)={isinstance(event, AiocqhttpMessageEvent) if IS_AIOCQHTTP else 'N/A'}")
@@ -140,76 +620,48 @@ class GroupContextPlugin(Star):
                 break
 
         if reply_seg:
+            # 被回复的消息已经记录过时，直接从本地索引解析，无需调用平台接口
+            indexed = self.message_index.get(event.unified_msg_origin, reply_seg.id)
+            if indexed is not None:
+                return indexed.forward_id
+
             try:
-                client = event.bot
-                original_msg = await client.api.call_action('get_msg', message_id=reply_seg.id)
+                original_msg = await self._get_reply_message(event, reply_seg.id)
                 
                 if original_msg and 'message' in original_msg:
                     original_message_chain = original_msg['message']
                     if isinstance(original_message_chain, list):
+                        forward_id = None
+                        text_parts = []
                         for segment in original_message_chain:
-                            if isinstance(segment, dict) and segment.get("type") == "forward":
-                                return segment.get("data", {}).get("id")
+                            if not isinstance(segment, dict):
+                                continue
+                            if segment.get("type") == "text":
+                                text_parts.append(segment.get("data", {}).get("text", ""))
+                            elif segment.get("type") == "image":
+                                text_parts.append("[图片]")
+                            elif segment.get("type") == "forward" and forward_id is None:
+                                seg_data = segment.get("data", {})
+                                forward_id = seg_data.get("id")
+                                text_parts.append("[合并转发]")
+                                # 部分OneBot实现会在 get_msg 中直接附带合并转发内容，此时无需再调用 get_forward_msg
+                                if forward_id and isinstance(seg_data.get("content"), list) and seg_data["content"]:
+                                    key = ("get_forward_msg", self._bot_key(event), str(forward_id))
+                                    if key not in self.forward_cache:
+                                        self.forward_cache.set(key, seg_data["content"])
+
+                        # 将通过接口获取到的消息也记录到本地索引
+                        self.message_index.put(event.unified_msg_origin, reply_seg.id, IndexedMessage(
+                            original_msg.get("sender", {}).get("nickname", ""),
+                            "".join(text_parts).strip()[:QUOTE_MAX_CHARS],
+                            forward_id,
+                        ))
+                        return forward_id
             except Exception as e:
                 logger.error(f"获取回复消息失败: {e}")
 
         return None
 
-    async def _extract_forward_content(self, event, forward_id: str) -> Tuple[str, List[str]]:
-        """提取合并转发消息的文本内容和图片URL
-
-        返回: (文本内容, 图片URL列表)
-        - 如果 enable_image_recognition = False，返回的图片URL列表为空
-        - 如果 enable_image_recognition = True，返回所有图片URL
-        """
-        if not IS_AIOCQHTTP or not isinstance(event, AiocqhttpMessageEvent):
-            return "", []
-
-        try:
-            # 调用API获取合并转发消息内容
-            client = event.bot
-            forward_data = await client.api.call_action('get_forward_msg', id=forward_id)
-            messages = forward_data.get("messages", [])
-
-            extracted_texts = []
-            image_urls = []
-
-            for message_node in messages:
-                sender_name = message_node.get("sender", {}).get("nickname", "未知用户")
-                raw_content = message_node.get("message") or message_node.get("content", [])
-
-                # 解析消息内容
-                node_text_parts = []
-                for seg in raw_content:
-                    if isinstance(seg, dict):
-                        seg_type = seg.get("type")
-                        seg_data = seg.get("data", {})
-
-                        if seg_type == "text":
-                            node_text_parts.append(seg_data.get("text", ""))
-                        elif seg_type == "image":
-                            if self.enable_image_recognition:
-                                # 提取图片URL，支持多种格式
-                                img_url = self._extract_image_url(seg_data)
-                                if img_url:
-                                    image_urls.append(img_url)
-                                    node_text_parts.append("[图片]")
-                            # 如果未启用图片识别，直接忽略图片
-                        elif seg_type == "at":
-                            node_text_parts.append(f"[At: {seg_data.get('qq', '')}]")
-
-                full_node_text = "".join(node_text_parts).strip()
-                if full_node_text:
-                    extracted_texts.append(f"{sender_name}: {full_node_text}")
-
-            final_text = "\n".join(extracted_texts)
-            return final_text, image_urls
-
-        except Exception as e:
-            logger.error(f"提取合并转发内容失败: {e}")
-            logger.error(traceback.format_exc())
-            return "", []
-
     @filter.platform_adapter_type(filter.PlatformAdapterType.ALL)
     async def on_message(self, event: AstrMessageEvent):
         """处理群聊消息并支持主动回复"""
@@ -223,9 +675,13 @@ class GroupContextPlugin(Star):
             if isinstance(comp, Plain):
                 message_text += comp.text
 
-        # 过滤指令消息
-        if self.is_command(message_text):
-            logger.debug(f"群聊上下文 | {event.unified_msg_origin} | 检测到指令消息，已过滤")
+        # 过滤指令消息，以及按群、发送者、正则忽略的消息
+        reason = self.message_filter.ignore_reason(
+            event.unified_msg_origin, event.get_group_id(), event.get_sender_id(), message_text
+        )
+        if reason:
+            self.metrics.inc("filtered_messages", reason=reason)
+            logger.debug(f"群聊上下文 | {event.unified_msg_origin} | 消息已过滤（{reason}）")
             return
 
         # 检查是否有文本、图片或合并转发内容
@@ -242,24 +698,42 @@ class GroupContextPlugin(Star):
         if not has_valid_content:
             return
 
-        # 检查是否需要主动回复
-        need_active = await self.need_active_reply(event)
+        # 消息到达时立即按顺序预留缓冲位置，保证并发构建的消息不乱序
+        slot = self._reserve_slot(event.unified_msg_origin)
+        self.reply_scheduler.touch(event.unified_msg_origin)
 
-        # 记录对话
+        need_active = False
         try:
-            await self.handle_message(event)
+            # 检查是否需要主动回复（同一个群已有主动回复在等待或进行中，或超出频率限制时不再触发）
+            need_active = await self.need_active_reply(event) and self.reply_scheduler.try_acquire(
+                event.unified_msg_origin
+            )
+
+            # 重启后首次收到该群消息时，从持久化记录中恢复缓冲
+            self._ensure_background_tasks()
+            await self._ensure_restored(event.unified_msg_origin)
+
+            # 记录对话
+            with self.metrics.timer("handle_message"):
+                await self.handle_message(event, slot)
         except BaseException as e:
+            self._release_slot(event.unified_msg_origin, slot, None)
             logger.error(f"记录群聊消息失败: {e}")
 
         # 主动回复逻辑
         if need_active:
-            # 标记当前会话为主动回复
-            self.active_reply_sessions.add(event.unified_msg_origin)
-            provider = self.context.get_using_provider(event.unified_msg_origin)
-            if not provider:
-                logger.error("未找到任何 LLM 提供商。请先配置。无法主动回复")
+            # 等待刷屏结束，整段消息由一次主动回复覆盖
+            if not await self.reply_scheduler.wait_quiet(event.unified_msg_origin):
+                logger.debug(f"群聊上下文 | {event.unified_msg_origin} | 缓冲消息已被其他请求消费，取消本次主动回复")
+                self.reply_scheduler.release(event.unified_msg_origin)
                 return
+            dispatched = False
             try:
+                provider = self.context.get_using_provider(event.unified_msg_origin)
+                if not provider:
+                    logger.error("未找到任何 LLM 提供商。请先配置。无法主动回复")
+                    return
+
                 session_curr_cid = await self.context.conversation_manager.get_curr_conversation_id(
                     event.unified_msg_origin,
                 )
@@ -281,6 +755,11 @@ class GroupContextPlugin(Star):
                     logger.error("未找到对话,无法主动回复")
                     return
 
+                # 标记当前会话为主动回复
+                self._mark_active_reply(event.unified_msg_origin)
+                event.set_extra(ACTIVE_REPLY_EXTRA, True)
+                self.reply_scheduler.dispatch(event.unified_msg_origin)
+                dispatched = True
                 yield event.request_llm(
                     prompt=prompt,
                     func_tool_manager=self.context.get_llm_tool_manager(),
@@ -290,26 +769,133 @@ class GroupContextPlugin(Star):
             except BaseException as e:
                 logger.error(traceback.format_exc())
                 logger.error(f"主动回复失败: {e}")
+            finally:
+                if not dispatched:
+                    self.reply_scheduler.release(event.unified_msg_origin)
 
 
-    async def handle_message(self, event: AstrMessageEvent):
+    async def handle_message(self, event: AstrMessageEvent, slot: Optional[BufferSlot] = None):
         """记录群聊消息到上下文中
 
+        消息到达时即在缓冲区中按顺序预留位置（slot，由 on_message 预留；未传入时在此预留），
+        异步构建完成后再填入，同一个群的多条消息可以并发构建而不会乱序或丢失
+        """
+        umo = event.unified_msg_origin
+        if slot is None:
+            slot = self._reserve_slot(umo)
+        record = None
+        try:
+            segments = await self._build_segments(event)
+            # 只有当有实际内容时才添加到会话历史
+            if segments:
+                message_id = getattr(event.message_obj, "message_id", None)
+                record = MessageRecord(
+                    sender_id=str(event.get_sender_id()),
+                    nickname=event.message_obj.sender.nickname,
+                    ts=slot.ts,
+                    message_id=str(message_id) if message_id is not None else None,
+                    segments=tuple(segments),
+                )
+        finally:
+            self._release_slot(umo, slot, record)
+
+        if record is None:
+            return
+        self._maybe_summarize_overflow(umo)
+
+        # 记录到消息ID索引，后续回复该消息时可直接从本地解析
+        carried_forward_id = next((seg.id for seg in event.message_obj.message if isinstance(seg, Forward)), None)
+        self.message_index.put(
+            umo,
+            record.message_id,
+            IndexedMessage(record.nickname, self._preview_text(event), carried_forward_id),
+        )
+
+        # 调试日志
+        logger.debug(f"群聊上下文 | {umo} | 添加了一条包含 {len(record.segments)} 个消息段的消息")
+        logger.debug(f"群聊缓冲区状态: {self.session_chats.stats()}")
+
+    def _reserve_slot(self, umo: str) -> BufferSlot:
+        """在群缓冲区中按到达顺序预留位置，附加的 Future 在消息填入或放弃后完成"""
+        return self.session_chats.reserve(umo, waiter=asyncio.get_running_loop().create_future())
+
+    def _release_slot(self, umo: str, slot: BufferSlot, record: Optional[MessageRecord]):
+        """填入构建完成的消息（record 为 None 时放弃该位置），并唤醒等待该消息的请求"""
+        if record is None:
+            self.session_chats.cancel(umo, slot)
+        elif self.session_chats.fill(umo, slot, record):
+            if self.journal:
+                self.journal.append(umo, record)
+            self.session_store.push(umo, record)
+        if not slot.waiter.done():
+            slot.waiter.set_result(None)
+
+    async def _take_messages(self, umo: str, with_tokens: bool = False) -> list:
+        """取出并清空该群的缓冲消息（参数与返回值同 GroupMessageBuffer.take_all）
+
+        使用共享存储时，本地缓冲中已填入的消息均已提交写入存储，只以存储中所有实例写入的消息为准：
+        本地缓冲在等待存储之前取出（存储不可用时退回这些消息，存储恢复后不会再次取出它们），等待期间新填入的消息留在本地缓冲，
+        它们同时在写入队列中，由下一次请求从存储取出，不会重复发送；
+        取出的消息按缓冲区规则统一折叠复读、执行上限和计算 token
+        """
+        local = self.session_chats.take_all(umo, with_tokens)
+        self._clear_journal(umo)
+        if not self.session_store.shared:
+            return local
+        try:
+            with self.metrics.timer("store_take"):
+                records = await self.session_store.take_all(umo)
+        except Exception as e:
+            logger.error(f"从共享会话存储读取群聊缓冲失败，仅使用本实例的消息: {e}")
+            return local
+        return self.session_chats.collate(self._localize_captions(records), with_tokens)
+
+    def _localize_captions(self, records: List[MessageRecord]) -> List[MessageRecord]:
+        """重新提交本进程中不存在的图片描述任务（其他实例提交的任务ID为空，重启前提交的任务已随进程消失，
+        任务过多时较早的任务会被淘汰），队列已满时使用[图片]占位符；
+        已获取过的描述按图片内容缓存，重新提交的任务直接命中缓存，不会再次调用提供商
+        """
+        def missing(seg) -> bool:
+            return isinstance(seg, CaptionRef) and not (seg.job and self.caption_workers.has_job(seg.job))
+
+        localized = []
+        for record in records:
+            if any(missing(seg) for seg in record.segments):
+                segments = []
+                for seg in record.segments:
+                    if missing(seg):
+                        seg = self._submit_caption(seg.url, seg.file) or Text(" [图片]")
+                    segments.append(seg)
+                record = record.with_segments(tuple(segments))
+            localized.append(record)
+        return localized
+
+    async def _wait_pending_messages(self, umo: str):
+        """等待该群已到达但仍在构建中的消息，最多等待 ingest_wait_timeout 秒"""
+        waiters = self.session_chats.pending_waiters(umo)
+        if not waiters or self.ingest_wait_timeout <= 0:
+            return
+        with self.metrics.timer("ingest_wait"):
+            _, pending = await asyncio.wait(waiters, timeout=self.ingest_wait_timeout)
+        if pending:
+            logger.debug(f"群聊上下文 | {umo} | {len(pending)} 条消息仍在处理中，将在下一次请求时加入上下文")
+
+    async def _build_segments(self, event: AstrMessageEvent) -> list:
+        """将一条群聊消息解析为消息段
+
         图片处理逻辑：
         1. enable_image_recognition = False: 完全忽略所有图片
-        2. enable_image_recognition = True, image_caption = False: 所有图片以URL形式注入，保留原始位置
-        3. enable_image_recognition = True, image_caption = True: 所有图片使用转述描述，保留原始位置
+        2. enable_image_recognition = True, image_caption = False: 所有图片记录为图片引用，保留原始位置，请求时再编码注入
+        3. enable_image_recognition = True, image_caption = True: 所有图片提交到后台描述队列，保留原始位置，请求时填入描述
 
         注意：指令消息过滤已在 on_message 中完成，这里不需要再次检查
         """
 
-        datetime_str = datetime.datetime.now().strftime("%H:%M:%S")
-        
-        # 创建当前消息的多模态内容列表
-        current_message_content = []
+        # 当前消息的消息段，发送者和时间作为结构化字段单独记录，请求时再渲染
+        segments = []
         
-        # 合并后的完整文本内容，只有遇到图片时才插入image_url块
-        full_text = f"[{event.message_obj.sender.nickname}/{datetime_str}]: "
+        # 合并后的连续文本，只有遇到图片时才拆分为新的消息段
+        full_text = ""
         
         # 1. 检测并处理合并转发消息
         if self.enable_forward_analysis and IS_AIOCQHTTP:
@@ -320,9 +906,8 @@ class GroupContextPlugin(Star):
                 # 提取合并转发的原始消息结构，包括位置信息
                 if IS_AIOCQHTTP and isinstance(event, AiocqhttpMessageEvent):
                     try:
-                        client = event.bot
-                        forward_data = await client.api.call_action('get_forward_msg', id=forward_id)
-                        messages = forward_data.get("messages", [])
+                        with self.metrics.timer("forward_fetch"):
+                            messages = await self._get_forward_messages(event, forward_id)
                         
                         # 添加合并转发前缀
                         full_text += f"\n{self.forward_prefix}\n\t<begin>\n"
@@ -351,27 +936,26 @@ class GroupContextPlugin(Star):
                                         if img_url:
                                             if self.enable_image_recognition:
                                                 if self.image_caption:
-                                                    try:
-                                                        caption = await self.get_image_caption(img_url, self.image_caption_provider_id)
-                                                        # 图片描述作为文本处理
-                                                        full_text += f" [图片描述: {caption}]"
-                                                    except Exception as e:
-                                                        logger.error(f"获取图片描述失败: {e}")
+                                                    # 图片描述由后台队列获取，先记录占位，请求时再填入
+                                                    caption_ref = self._submit_caption(img_url, seg_data.get("file") or "")
+                                                    if caption_ref:
+                                                        if full_text:
+                                                            segments.append(Text(full_text))
+                                                            full_text = ""
+                                                        segments.append(caption_ref)
+                                                    else:
+                                                        self.metrics.inc("image_placeholders", reason="caption_queue_full")
                                                         full_text += " [图片]"
                                                 else:
                                                     # 遇到图片URL时，先将之前的文本添加到列表
                                                     if full_text:
-                                                        current_message_content.append({"type": "text", "text": full_text})
+                                                        segments.append(Text(full_text))
                                                         full_text = ""  # 重置当前文本
-                                                    # 将图片转换为base64编码，使用OpenAI格式
-                                                    image_data = await self._encode_image_bs64(img_url)
-                                                    if image_data:
-                                                        current_message_content.append({"type": "image_url", "image_url": {"url": image_data}})
-                                                    else:
-                                                        # 如果转换失败，使用[图片]占位符
-                                                        full_text += " [图片]"
+                                                    # 仅记录图片引用，在请求时再转换为base64编码
+                                                    segments.append(ImageRef(img_url, seg_data.get("file") or ""))
                                             else:
                                                 # 关闭视觉开关时，使用[图片]占位符，不换行
+                                                self.metrics.inc("image_placeholders", reason="recognition_disabled")
                                                 full_text += " [图片]"
                             
                             # 添加换行
@@ -402,45 +986,206 @@ class GroupContextPlugin(Star):
                 if url:
                     if self.enable_image_recognition:
                         if self.image_caption:
-                            try:
-                                caption = await self.get_image_caption(url, self.image_caption_provider_id)
-                                # 图片描述作为文本处理，保持在同一行
-                                full_text += f" [图片描述: {caption}]"
-                            except Exception as e:
-                                logger.error(f"获取图片描述失败: {e}")
-                                # 图片描述获取失败时，使用[图片]占位符，保持在同一行
+                            # 图片描述由后台队列获取，先记录占位，请求时再填入
+                            caption_ref = self._submit_caption(url, getattr(comp, "file", None) or "")
+                            if caption_ref:
+                                if full_text:
+                                    segments.append(Text(full_text))
+                                    full_text = ""
+                                segments.append(caption_ref)
+                            else:
+                                # 队列已满时使用[图片]占位符，保持在同一行
+                                self.metrics.inc("image_placeholders", reason="caption_queue_full")
                                 full_text += " [图片]"
                         else:
                             # 遇到图片URL时，先将之前的文本添加到列表
                             if full_text:
-                                current_message_content.append({"type": "text", "text": full_text})
+                                segments.append(Text(full_text))
                                 full_text = ""  # 重置当前文本
-                            # 将图片转换为base64编码，使用OpenAI格式
-                            image_data = await self._encode_image_bs64(url)
-                            if image_data:
-                                current_message_content.append({"type": "image_url", "image_url": {"url": image_data}})
-                            else:
-                                # 如果转换失败，使用[图片]占位符
-                                full_text += " [图片]"
+                            # 仅记录图片引用，在请求时再转换为base64编码
+                            segments.append(ImageRef(url, getattr(comp, "file", None) or ""))
                     else:
                         # 关闭视觉开关时，使用[图片]占位符，保持在同一行
+                        self.metrics.inc("image_placeholders", reason="recognition_disabled")
                         full_text += " [图片]"
+            elif isinstance(comp, Reply):
+                # 将被回复的消息内容以引用形式内联
+                if self.reply_quote_inline:
+                    full_text += self._render_reply_quote(event, comp)
             elif isinstance(comp, Forward):
                 # 合并转发消息已在前面处理
                 pass
         
         # 处理最后剩余的文本
         if full_text:
-            current_message_content.append({"type": "text", "text": full_text})
-        
-        # 只有当有实际内容时才添加到会话历史
-        if current_message_content:
-            # 将当前消息的多模态内容添加到会话历史
-            self.session_chats[event.unified_msg_origin].append(current_message_content)
-            
-            # 调试日志
-            logger.debug(f"群聊上下文 | {event.unified_msg_origin} | 添加了一条包含 {len(current_message_content)} 个组件的消息")
+            segments.append(Text(full_text))
+        return segments
+
+    async def _gather_limited(self, coros: list, fallback) -> list:
+        """以有限并发执行一组协程，结果保持原始顺序；单项超时或失败时返回 fallback"""
+        semaphore = asyncio.Semaphore(max(1, self.image_concurrency))
+
+        async def run(coro):
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(coro, self.image_timeout or None)
+                except asyncio.TimeoutError:
+                    logger.error(f"图片处理超时（{self.image_timeout}秒）")
+                except Exception as e:
+                    logger.error(f"图片处理失败: {e}")
+                return fallback
+
+        return await asyncio.gather(*(run(coro) for coro in coros))
+
+    def _preview_text(self, event: AstrMessageEvent) -> str:
+        """生成消息的简短纯文本预览，用于引用回复"""
+        parts = []
+        for comp in event.message_obj.message:
+            if isinstance(comp, Plain):
+                parts.append(comp.text)
+            elif isinstance(comp, Image):
+                parts.append("[图片]")
+            elif isinstance(comp, Forward):
+                parts.append("[合并转发]")
+        return "".join(parts).strip()[:QUOTE_MAX_CHARS]
+
+    def _render_reply_quote(self, event: AstrMessageEvent, reply: Reply) -> str:
+        """渲染被回复消息的引用文本，优先使用本地消息索引"""
+        indexed = self.message_index.get(event.unified_msg_origin, reply.id)
+        if indexed is not None:
+            nickname, text = indexed.nickname, indexed.text
+        else:
+            nickname = getattr(reply, "sender_nickname", "") or ""
+            text = (getattr(reply, "message_str", "") or "").strip()[:QUOTE_MAX_CHARS]
+        if not text:
+            return ""
+        return f" [回复 {nickname}: {text}]" if nickname else f" [回复: {text}]"
+
+    def _submit_caption(self, url: str, file: str = "") -> Optional[CaptionRef]:
+        """提交图片描述任务，返回占位的描述引用；队列已满时返回 None
 
+        file 为平台的图片文件标识（通常为内容 MD5，不随每次发送变化），相同文件复用已提交的任务
+        """
+        if file:
+            job_id = self.caption_jobs_by_file.get(file)
+            if job_id and self.caption_workers.has_job(job_id):
+                return CaptionRef(job_id, url, file)
+        job_id = self.caption_workers.submit(url)
+        if not job_id:
+            return None
+        if file:
+            self.caption_jobs_by_file.set(file, job_id)
+        return CaptionRef(job_id, url, file)
+
+    @staticmethod
+    def _merge_text_items(content: list) -> list:
+        """合并相邻的文本块，只有遇到图片时才拆分"""
+        merged = []
+        for item in content:
+            if item["type"] == "text" and merged and merged[-1]["type"] == "text":
+                merged[-1] = {"type": "text", "text": merged[-1]["text"] + item["text"]}
+            else:
+                merged.append(item)
+        return merged
+
+    @timed("materialize")
+    async def _render_records(self, records: List[MessageRecord], passthrough: bool = False) -> List[list]:
+        """将缓冲的消息记录渲染为 OpenAI 格式的多模态内容：解析图片引用为 base64 编码的图片，并填入后台获取的图片描述
+
+        仅编码本次请求图片窗口内（最新的 request_image_limit 张）的图片，
+        passthrough 为 True 时可直接发送的 HTTP 图片使用原始 URL（见 _resolve_image），
+        窗口外或编码失败的图片转换为[图片]占位符；
+        图片描述最多等待 caption_wait_timeout 秒，未完成的同样使用[图片]占位符。
+        每条消息以发送者和时间开头、以换行结尾，使其始终以文本结束，去除图片时据此区分消息边界
+        """
+        refs = [(i, j) for i, record in enumerate(records) for j, seg in enumerate(record.segments) if isinstance(seg, ImageRef)]
+        skip = max(0, len(refs) - self.request_image_limit) if self.request_image_limit > 0 else 0
+
+        # 并发编码窗口内的图片
+        in_window = refs[skip:] if skip > 0 else refs
+        encoded = await self._gather_limited(
+            [self._resolve_image(records[i].segments[j].url, passthrough) for i, j in in_window],
+            fallback="",
+        )
+        encoded_map = dict(zip(in_window, encoded))
+
+        # 等待仍在后台进行的图片描述（任务已被淘汰的重新提交）
+        records = self._localize_captions(records)
+        caption_jobs = [seg.job for record in records for seg in record.segments if isinstance(seg, CaptionRef)]
+        captions = await self.caption_workers.wait(caption_jobs, self.caption_wait_timeout) if caption_jobs else {}
+
+        rendered = []
+        for i, record in enumerate(records):
+            content = [{"type": "text", "text": record.header()}]
+            for j, seg in enumerate(record.segments):
+                if isinstance(seg, Text):
+                    content.append({"type": "text", "text": seg.text})
+                elif isinstance(seg, CaptionRef):
+                    caption = captions.get(seg.job)
+                    # 图片描述作为文本处理，未完成或失败时使用[图片]占位符，保持在同一行
+                    if not caption:
+                        self.metrics.inc("image_placeholders", reason="caption_unavailable")
+                    text = f" [图片描述: {caption}]" if caption else " [图片]"
+                    content.append({"type": "text", "text": text})
+                else:
+                    image_data = encoded_map.get((i, j))
+                    if image_data:
+                        content.append({"type": "image_url", "image_url": {"url": image_data}})
+                    else:
+                        # 窗口外或转换失败时，使用[图片]占位符
+                        reason = "encode_failed" if (i, j) in encoded_map else "out_of_window"
+                        self.metrics.inc("image_placeholders", reason=reason)
+                        content.append({"type": "text", "text": " [图片]"})
+            content.append({"type": "text", "text": record.repeat_note() + "\n"})
+            rendered.append(self._merge_text_items(content))
+        return rendered
+
+    async def _resolve_image(self, image_url: str, passthrough: bool) -> str:
+        """返回请求中使用的图片地址：可直传时为原始 URL，否则为 base64 编码的图片"""
+        if passthrough:
+            reason = self.url_policy.inline_reason(image_url)
+            if reason is None:
+                self.metrics.inc("image_urls", mode="passthrough")
+                return image_url
+            self.metrics.inc("image_urls", mode="inline", reason=reason)
+        return await self._encode_image_bs64(image_url)
+
+    async def _refresh_history_image_urls(self, req: ProviderRequest, passthrough: bool):
+        """检查历史中保留的 HTTP 图片 URL：当前服务商不支持直传，或 URL 已不适合直传（如即将过期）时改为内联编码，
+        无法编码（如已过期）时替换为[图片]占位符，避免服务商拉取失败导致整个请求被拒绝
+        """
+        targets = []
+        for i, ctx in enumerate(req.contexts):
+            content = ctx.get("content")
+            if not isinstance(content, list):
+                continue
+            for j, item in enumerate(content):
+                if not isinstance(item, dict) or item.get("type") != "image_url":
+                    continue
+                url = (item.get("image_url") or {}).get("url", "")
+                if url.startswith(("http://", "https://")) and (
+                    not passthrough or self.url_policy.inline_reason(url) is not None
+                ):
+                    targets.append((i, j, url))
+        if not targets:
+            return
+
+        encoded = await self._gather_limited([self._encode_image_bs64(url) for _, _, url in targets], fallback="")
+        replaced = {}
+        for (i, j, _), data_uri in zip(targets, encoded):
+            # 不修改原有的上下文对象，复制后替换
+            if i not in replaced:
+                replaced[i] = {**req.contexts[i], "content": list(req.contexts[i]["content"])}
+            if data_uri:
+                replaced[i]["content"][j] = {"type": "image_url", "image_url": {"url": data_uri}}
+                self.metrics.inc("history_image_urls", action="inlined")
+            else:
+                replaced[i]["content"][j] = {"type": "text", "text": " [图片]"}
+                self.metrics.inc("history_image_urls", action="stripped")
+        for i, ctx in replaced.items():
+            req.contexts[i] = ctx
+
+    @timed("image_total")
     async def _encode_image_bs64(self, image_url: str) -> str:
         """将图片转换为 base64 编码
         
@@ -449,35 +1194,133 @@ class GroupContextPlugin(Star):
         2. http/https 开头的网络图片 URL
         3. file:/// 开头的本地文件路径
         4. 直接的本地文件路径
+
+        编码前按配置缩放、重新压缩图片并识别真实格式；
+        编码结果按URL和内容哈希缓存，相同内容的图片共享同一个编码字符串；
+        文件读写、哈希、规范化和编码均在执行器中完成，不阻塞事件循环
         """
         try:
-            import base64
-            
-            if image_url.startswith("base64://"):
-                return image_url.replace("base64://", "data:image/jpeg;base64,")
-            elif image_url.startswith("http"):
-                # 下载网络图片
-                image_path = await download_image_by_url(image_url)
-                with open(image_path, "rb") as f:
-                    image_bs64 = base64.b64encode(f.read()).decode("utf-8")
-                return "data:image/jpeg;base64," + image_bs64
-            elif image_url.startswith("file:///"):
-                # 本地文件路径
-                image_path = image_url.replace("file:///", "")
-                with open(image_path, "rb") as f:
-                    image_bs64 = base64.b64encode(f.read()).decode("utf-8")
-                return "data:image/jpeg;base64," + image_bs64
-            else:
-                # 直接的本地文件路径
-                with open(image_url, "rb") as f:
-                    image_bs64 = base64.b64encode(f.read()).decode("utf-8")
-                return "data:image/jpeg;base64," + image_bs64
+            cached = await self._image_cache_lookup(image_url)
+            if cached:
+                return cached
+
+            if image_url.startswith("base64://") and not self.image_normalize:
+                # 不做规范化时直接复用原始 base64 数据，只识别真实格式
+                payload = image_url[len("base64://"):]
+                key = await self.executor.run_io(base64_hash, payload)
+                cached = await self._image_cache_lookup(image_url, key)
+                if cached:
+                    return cached
+                mime = sniff_mime(base64.b64decode(payload[:32]))
+                return await self._image_cache_store(image_url, key, f"data:{mime};base64," + payload)
+
+            image_bytes = await self._read_image_bytes(image_url)
+            key = await self.executor.run_io(content_hash, image_bytes) + self.image_variant
+            cached = await self._image_cache_lookup(image_url, key)
+            if cached:
+                return cached
+
+            # 缩放、重新压缩、识别真实格式并编码
+            with self.metrics.timer("image_encode"):
+                data_uri = await self.executor.run_cpu(
+                    encode_data_uri,
+                    image_bytes,
+                    normalize=self.image_normalize,
+                    max_edge=self.image_max_edge,
+                    quality=self.image_jpeg_quality,
+                    max_bytes=self.image_max_kb * 1024,
+                )
+            return await self._image_cache_store(image_url, key, data_uri)
         except Exception as e:
             logger.error(f"将图片转换为base64失败: {image_url}, 错误: {e}")
             return ""
 
+    async def _read_image_bytes(self, image_url: str) -> bytes:
+        """读取图片的原始数据（解码 base64、下载网络图片或读取本地文件）"""
+        if image_url.startswith("base64://"):
+            return await self.executor.run_io(base64.b64decode, image_url[len("base64://"):])
+        if image_url.startswith("http"):
+            # 下载网络图片
+            with self.metrics.timer("image_download"):
+                image_path = await download_image_by_url(image_url)
+        elif image_url.startswith("file:///"):
+            # 本地文件路径
+            image_path = image_url.replace("file:///", "")
+        else:
+            # 直接的本地文件路径
+            image_path = image_url
+
+        with self.metrics.timer("image_read"):
+            return await self.executor.run_io(read_file, image_path)
+
+    async def _image_cache_lookup(self, image_url: str, key: Optional[str] = None) -> Optional[str]:
+        """依次查找图片缓存的内存层和磁盘层；未指定内容哈希时按URL查找"""
+        if key is None:
+            cached = self.image_cache.get_by_url(image_url)
+            if cached:
+                return cached
+            key = self.image_cache.key_for_url(image_url)
+            if key is None:
+                return None
+        else:
+            cached = self.image_cache.get_by_hash(image_url, key)
+            if cached:
+                return cached
+
+        if self.image_cache.on_disk(key):
+            data_uri = await self.executor.run_io(self.image_cache.read_disk_file, key)
+            if data_uri:
+                return self.image_cache.promote(image_url, key, data_uri)
+            self.image_cache.forget_disk(key)
+        return None
+
+    async def _image_cache_store(self, image_url: str, key: str, data_uri: str) -> str:
+        """写入图片缓存，启用磁盘缓存时在线程池中写入文件"""
+        data_uri = self.image_cache.put(image_url, key, data_uri)
+        if self.image_cache.disk_dir and not self.image_cache.on_disk(key):
+            if await self.executor.run_io(self.image_cache.write_disk_file, key, data_uri):
+                evicted = self.image_cache.record_disk(key, len(data_uri))
+                if evicted:
+                    await self.executor.run_io(self.image_cache.remove_disk_files, evicted)
+        return data_uri
+
+    async def _load_caption_image(self, image_url: str) -> Tuple[str, str]:
+        """返回 (图片内容哈希, 交给描述提供商的 base64:// 图片)，哈希用于跨URL识别相同的图片
+
+        已编码过的图片复用缓存中的编码结果；否则只读取一次原始数据，按原始数据计算哈希并编码，
+        不做规范化也不写入图片缓存（描述只需获取一次，图片缓存留给请求中发送的图片）。
+        哈希与图片缓存的键一致；无法读取图片时退化为URL本身，由提供商自行获取
+        """
+        try:
+            cached = await self._image_cache_lookup(image_url)
+            if cached:
+                return self.image_cache.key_for_url(image_url), "base64://" + cached.split(",", 1)[1]
+            if image_url.startswith("base64://") and not self.image_normalize:
+                return await self.executor.run_io(base64_hash, image_url[len("base64://"):]), image_url
+            image_bytes = await self._read_image_bytes(image_url)
+            key = await self.executor.run_io(content_hash, image_bytes) + self.image_variant
+            payload = await self.executor.run_cpu(base64.b64encode, image_bytes)
+            return key, "base64://" + payload.decode("ascii")
+        except Exception as e:
+            logger.warning(f"读取待描述的图片失败，交由提供商获取: {image_url}, 错误: {e}")
+            return f"url:{image_url}", image_url
+
+    @staticmethod
+    def _provider_id(provider) -> str:
+        """获取提供商ID"""
+        try:
+            return provider.meta().id
+        except Exception:
+            return getattr(provider, "provider_config", {}).get("id", "")
+
+    @timed("caption")
     async def get_image_caption(self, image_url: str, image_caption_provider_id: str) -> str:
-        """获取图片描述"""
+        """获取图片描述
+
+        描述结果按 (图片内容哈希, 提供商, 提示词) 缓存，修改提示词或提供商后缓存自动失效；
+        同一图片的并发请求合并为一次 LLM 调用；图片只读取一次，计算哈希后以 base64 交给提供商；
+        使用共享存储时描述同时写入存储，多个实例之间共享
+        """
         if not image_caption_provider_id:
             provider = self.context.get_using_provider()
         else:
@@ -489,20 +1332,146 @@ class GroupContextPlugin(Star):
             raise Exception(f"提供商类型错误({type(provider)}),无法获取图片描述")
 
         # 从全局配置获取图片描述提示词
-        image_caption_prompt = self.get_cfg("image_caption_prompt", "请描述这张图片的内容")
+        image_caption_prompt = self.image_caption_prompt
+        provider_id = self._provider_id(provider)
+
+        async def caption_by_content():
+            content_key = self.caption_keys_by_url.get(image_url)
+            if content_key is not None:
+                caption = self.caption_cache.get((content_key, provider_id, image_caption_prompt))
+                if caption is not None:
+                    return caption
+            content_key, image = await self._load_caption_image(image_url)
+            self.caption_keys_by_url.set(image_url, content_key)
+            cache_key = (content_key, provider_id, image_caption_prompt)
+            caption = self.caption_cache.get(cache_key)
+            if caption is not None:
+                return caption
+
+            async def call_provider():
+                shared_key = content_hash(json.dumps(cache_key, ensure_ascii=False).encode("utf-8"))
+                caption = await self._shared_caption(shared_key)
+                if caption:
+                    self.caption_cache.set(cache_key, caption)
+                    return caption
+
+                self.metrics.inc("api_calls", action="caption")
+                response = await provider.text_chat(
+                    prompt=image_caption_prompt,
+                    session_id=uuid.uuid4().hex,
+                    image_urls=[image],
+                    persist=False,
+                )
+                if response.completion_text:
+                    self.caption_cache.set(cache_key, response.completion_text)
+                    await self._share_caption(shared_key, response.completion_text)
+                return response.completion_text
 
-        response = await provider.text_chat(
-            prompt=image_caption_prompt,
-            session_id=uuid.uuid4().hex,
-            image_urls=[image_url],
-            persist=False,
-        )
-        return response.completion_text
+            return await self.caption_flight.do(cache_key, call_provider)
+
+        # 同一URL的并发请求在计算内容哈希前就合并，避免重复下载
+        return await self.caption_flight.do((image_url, provider_id, image_caption_prompt), caption_by_content)
+
+    async def _shared_caption(self, key: str) -> Optional[str]:
+        """使用共享存储时，查找其他实例获取过的图片描述（取出其他实例的消息后重新提交的描述任务即可直接复用）"""
+        if not self.session_store.shared:
+            return None
+        try:
+            return await self.session_store.get_caption(key)
+        except Exception as e:
+            logger.warning(f"从共享会话存储读取图片描述失败: {e}")
+            return None
+
+    async def _share_caption(self, key: str, caption: str):
+        """使用共享存储时，将获取到的图片描述写入存储供其他实例复用"""
+        if not self.session_store.shared:
+            return
+        try:
+            await self.session_store.put_caption(key, caption)
+        except Exception as e:
+            logger.warning(f"写入共享会话存储的图片描述失败: {e}")
+
+    def _maybe_summarize_overflow(self, umo: str):
+        """缓冲消息超过阈值时，将较早的消息交给后台任务并入该群的滚动摘要，只保留最近的消息原文"""
+        if not self.enable_overflow_summary or umo in self._summary_tasks or umo in self.summary_backoff:
+            return
+        count = self.session_chats.count(umo)
+        if count <= self.overflow_threshold:
+            return
+        records = self.session_chats.take_oldest(umo, count - max(0, self.overflow_keep_recent))
+        if not records:
+            return
+        task = asyncio.create_task(self._summarize_overflow(umo, records))
+        self._summary_tasks[umo] = task
+        self._summary_records[umo] = records
+
+        def done(_):
+            self._summary_tasks.pop(umo, None)
+            self._summary_records.pop(umo, None)
+
+        task.add_done_callback(done)
+
+    async def _summarize_overflow(self, umo: str, records: List[MessageRecord]):
+        """将一批较早的消息并入滚动摘要（在已有摘要的基础上扩展），失败时把消息放回缓冲区"""
+        try:
+            with self.metrics.timer("summary"):
+                if self.summary_provider_id:
+                    provider = self.context.get_provider_by_id(self.summary_provider_id)
+                else:
+                    provider = self.context.get_using_provider(umo)
+                if not isinstance(provider, Provider):
+                    raise Exception(f"没有找到可用于摘要的提供商: {self.summary_provider_id or '当前提供商'}")
+
+                history = "\n".join(record.header() + record.plain_text() + record.repeat_note() for record in records)
+                previous = self.group_summaries.get(umo)
+                parts = [self.summary_prompt.replace("{max_chars}", str(self.summary_max_chars))]
+                if previous:
+                    parts.append(f"此前的摘要：\n{previous}\n\n请在此前摘要的基础上，结合以下新的群聊记录进行扩展和更新：")
+                else:
+                    parts.append("群聊记录：")
+                parts.append(history)
+
+                self.metrics.inc("api_calls", action="summary")
+                response = await provider.text_chat(
+                    prompt="\n\n".join(parts),
+                    session_id=uuid.uuid4().hex,
+                    persist=False,
+                )
+                summary = (response.completion_text or "").strip()
+                if not summary:
+                    raise Exception("摘要结果为空")
+                self.group_summaries[umo] = summary
+                logger.info(f"群聊上下文 | {umo} | 已将 {len(records)} 条较早的消息并入摘要")
+        except Exception as e:
+            logger.error(f"群聊消息摘要失败，消息保留在缓冲区中: {e}")
+            self.summary_backoff.set(umo, True)
+            self.session_chats.restore(umo, records)
+
+    async def _wait_summary(self, umo: str):
+        """等待该群仍在进行的摘要任务，避免请求时遗漏正在被摘要的消息
+
+        摘要失败时消息已放回缓冲区；超过 summary_wait_timeout 秒仍未完成时取消摘要，
+        将这些消息的原文放回缓冲区，随本次请求发送
+        """
+        task = self._summary_tasks.get(umo)
+        if task is None:
+            return
+        records = self._summary_records.get(umo, [])
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.summary_wait_timeout or None)
+        except asyncio.TimeoutError:
+            if not task.cancel():
+                # 恰好在超时时完成
+                return
+            self.summary_backoff.set(umo, True)
+            self.session_chats.restore(umo, records)
+            self.metrics.inc("summary_timeouts")
+            logger.warning(f"群聊上下文 | {umo} | 摘要超过 {self.summary_wait_timeout} 秒未完成，本次请求改为发送 {len(records)} 条消息的原文")
 
     async def need_active_reply(self, event: AstrMessageEvent) -> bool:
         """判断是否需要主动回复"""
-        enable_active_reply = bool(self.get_cfg("enable_active_reply", False))
-        if not enable_active_reply:
+        rules = self.message_filter
+        if not rules.enable_active_reply:
             return False
 
         if event.get_message_type() != MessageType.GROUP_MESSAGE:
@@ -513,140 +1482,185 @@ class GroupContextPlugin(Star):
             return False
 
         # 检查白名单
-        ar_whitelist = self.get_cfg("ar_whitelist", [])
-        if ar_whitelist:
-            if (event.unified_msg_origin not in ar_whitelist and
-                (event.get_group_id() and event.get_group_id() not in ar_whitelist)):
-                return False
+        if not rules.active_reply_allowed(event.unified_msg_origin, event.get_group_id()):
+            return False
 
         # 使用概率触发主动回复
-        ar_possibility = float(self.get_cfg("ar_possibility", 0.1))
-        return random.random() < ar_possibility
+        return random.random() < rules.ar_possibility
 
-    def _control_conversation_rounds(self, req: ProviderRequest, rounds_limit: int):
-        """控制对话轮数，保留最近N轮对话"""
-        if not req.contexts or rounds_limit <= 0:
-            return
-            
-        # 使用简单逻辑找到所有轮次的结束位置：当上一条是a而下一条是u/s即意味着轮的分割
-        round_ends = []
-        
-        # 遍历所有消息，找到a->u/s的转换点
-        for i in range(len(req.contexts) - 1):
-            current_role = req.contexts[i].get("role")
-            next_role = req.contexts[i + 1].get("role")
-            
-            # 如果当前是assistant，下一个是user或system，则当前assistant是轮次结束
-            if current_role == "assistant" and next_role in ["user", "system"]:
-                round_ends.append(i)
-        
-        # 处理最后一个消息：如果最后一个是assistant，它也是一个轮次的结束
-        if req.contexts and req.contexts[-1].get("role") == "assistant":
-            round_ends.append(len(req.contexts) - 1)
-        
-        # 如果轮次数量超过限制，找到需要保留的起始位置
-        if len(round_ends) > rounds_limit:
-            # 找到倒数第rounds_limit轮的开始位置
-            keep_start_index = round_ends[-rounds_limit]
-            # 保留从keep_start_index开始的所有消息
-            req.contexts = req.contexts[keep_start_index:]
-    
-    def _control_image_carry_rounds(self, req: ProviderRequest, image_carry_rounds: int):
-        """控制图片携带轮数，只保留最后N轮中的图片"""
-        if not req.contexts or image_carry_rounds <= 0:
-            return
-            
-        # 使用简单逻辑找到所有轮次的结束位置：当上一条是a而下一条是u/s即意味着轮的分割
-        round_ends = []
-        
-        # 遍历所有消息，找到a->u/s的转换点
-        for i in range(len(req.contexts) - 1):
-            current_role = req.contexts[i].get("role")
-            next_role = req.contexts[i + 1].get("role")
-            
-            # 如果当前是assistant，下一个是user或system，则当前assistant是轮次结束
-            if current_role == "assistant" and next_role in ["user", "system"]:
-                round_ends.append(i)
-        
-        # 处理最后一个消息：如果最后一个是assistant，它也是一个轮次的结束
-        if req.contexts and req.contexts[-1].get("role") == "assistant":
-            round_ends.append(len(req.contexts) - 1)
-        
-        # 如果轮次数量超过限制，找到需要保留图片的起始轮次
-        if len(round_ends) > image_carry_rounds:
-            # 找到倒数第image_carry_rounds轮的开始位置
-            keep_start_index = round_ends[-image_carry_rounds]
-            
-            # 遍历所有消息，将keep_start_index之前的user消息中的图片替换为[图片]占位符
-            for i, ctx in enumerate(req.contexts):
-                if i < keep_start_index and ctx.get("role") == "user":
-                    if isinstance(ctx.get("content"), list):
-                        # 创建新的content列表
-                        new_content = []
-                        current_text = None
-                        
-                        for item in ctx["content"]:
-                            if item["type"] == "text":
-                                text = item["text"]
-                                
-                                # 检查是否为新的时间戳（以[开头）
-                                if text.startswith("["):
-                                    # 如果是新的时间戳，保存当前文本（如果有）
-                                    if current_text:
-                                        new_content.append({"type": "text", "text": current_text})
-                                    # 开始新的文本块
-                                    current_text = text
-                                else:
-                                    # 如果不是新的时间戳，合并到当前文本
-                                    if current_text:
-                                        current_text += text
-                                    else:
-                                        # 如果没有当前文本，直接创建新的
-                                        current_text = text
-                            elif item["type"] == "image_url":
-                                # 如果是图片，将[图片]追加到当前文本
-                                if current_text:
-                                    current_text += " [图片]"
-                                else:
-                                    # 如果没有当前文本，创建一个新的
-                                    current_text = " [图片]"
-                        
-                        # 保存最后一个文本块
-                        if current_text:
-                            new_content.append({"type": "text", "text": current_text})
-                        
-                        # 更新为新的content列表
-                        ctx["content"] = new_content
+    def _control_context_rounds(self, req: ProviderRequest, rounds_limit: int, image_carry_rounds: int, chunk: int = 1):
+        """控制对话轮数和图片携带轮数：保留最近N轮对话，只保留最后M轮中的图片
+
+        轮次索引每次请求只计算一次，裁剪与图片替换在同一次遍历中完成；chunk > 1 时按整块裁剪
+        """
+        req.contexts = compact_contexts(req.contexts, rounds_limit, image_carry_rounds, chunk)
+
+    def _report_stable_prefix(self, event: AstrMessageEvent, req: ProviderRequest):
+        """统计本次请求与该群上一次请求相同的前缀（消息条数和估算 token 数），即服务商前缀缓存可命中的部分"""
+        umo = event.unified_msg_origin
+        fingerprints = [message_fingerprint(ctx) for ctx in req.contexts]
+        prefix = common_prefix(self.sent_fingerprints.get(umo, (), count=False), fingerprints)
+        self.sent_fingerprints.set(umo, fingerprints)
+
+        tokens = [self._estimate_tokens(ctx.get("content")) for ctx in req.contexts]
+        prefix_tokens = sum(tokens[:prefix])
+        self.metrics.inc("stable_prefix_messages", prefix)
+        self.metrics.inc("context_messages", len(fingerprints))
+        self.metrics.inc("stable_prefix_tokens", prefix_tokens)
+        self.metrics.inc("context_tokens", sum(tokens))
+        event.set_extra("group_context_stable_prefix", {
+            "messages": prefix,
+            "total_messages": len(fingerprints),
+            "tokens": prefix_tokens,
+            "total_tokens": sum(tokens),
+        })
+        logger.debug(f"群聊上下文 | {umo} | 稳定前缀 {prefix}/{len(fingerprints)} 条消息，约 {prefix_tokens}/{sum(tokens)} tokens")
+
+    def _image_tokens(self, url: str) -> int:
+        """估算一张图片的 token 数，能获取到尺寸时按尺寸估算"""
+        if not url.startswith("data:"):
+            # 尚未编码的图片引用，若已在缓存中则按缓存的编码结果估算
+            url = self.image_cache.get_by_url(url) or ""
+            if not url:
+                return self.default_image_tokens
+        fingerprint = (len(url), url[-64:])
+        size = self.image_size_memo.get(fingerprint, count=False)
+        if size is None:
+            size = data_uri_image_size(url) or ()
+            self.image_size_memo.set(fingerprint, size)
+        return estimate_image_tokens(size, self.default_image_tokens)
+
+    def _estimate_tokens(self, content) -> int:
+        """估算一条消息内容的 token 数"""
+        return estimate_content_tokens(content, self._image_tokens)
+
+    def _estimate_record_tokens(self, record: MessageRecord) -> Tuple[int, Tuple[int, ...]]:
+        """估算一条缓冲消息渲染后的 token 数，以及其中各图片的份额"""
+        return estimate_record_tokens(record, self._image_tokens)
+
+    def _apply_token_budget(
+        self, req: ProviderRequest, entries: List[Tuple[MessageRecord, int, Tuple[int, ...]]], fixed_text: str
+    ) -> List[MessageRecord]:
+        """按 token 预算裁剪上下文，替代按轮数的裁剪
+
+        优先保留最新的内容：超出预算时先从最早的图片开始替换为[图片]占位符，
+        仍超出时从最早的历史轮次开始整轮丢弃，最后从最早的群聊缓冲消息开始丢弃（至少保留最新一条）。
+        entries 为 (缓冲消息记录, 追加时计算好的 token 数, 其中各图片的份额)，返回裁剪后的缓冲消息记录；
+        fixed_text 为不参与裁剪的文本（system 消息和滚动摘要），计入总数；
+        图片降级时扣除追加时记下的份额，与总数的估算口径保持一致
+        """
+        budget = self.token_budget
+        history_tokens = [self._estimate_tokens(ctx.get("content")) for ctx in req.contexts]
+        buffer_tokens = [tokens for _, tokens, _ in entries]
+        total = estimate_text_tokens(fixed_text) + sum(history_tokens) + sum(buffer_tokens)
+        if total <= budget:
+            return [record for record, _, _ in entries]
+
+        messages = [record for record, _, _ in entries]
+
+        # 1. 从最早的图片开始降级为占位符（先历史，再缓冲消息）
+        for i, ctx in enumerate(req.contexts):
+            if total <= budget:
+                break
+            if ctx.get("role") == "user" and has_images(ctx):
+                strip_message_images(ctx)
+                saved = history_tokens[i] - self._estimate_tokens(ctx["content"])
+                history_tokens[i] -= saved
+                total -= saved
+        for i, record in enumerate(messages):
+            if total <= budget:
+                break
+            segments = list(record.segments)
+            image_shares = iter(entries[i][2])
+            for j, seg in enumerate(segments):
+                if total <= budget:
+                    break
+                if isinstance(seg, ImageRef):
+                    saved = next(image_shares, 0) - PLACEHOLDER_TOKENS
+                    segments[j] = Text(" [图片]")
+                    buffer_tokens[i] -= saved
+                    total -= saved
+            messages[i] = record.with_segments(tuple(segments))
+
+        # 2. 从最早的历史轮次开始整轮丢弃
+        if total > budget:
+            cut = 0
+            for end in find_round_ends(req.contexts):
+                if total <= budget:
+                    break
+                total -= sum(history_tokens[cut:end + 1])
+                cut = end + 1
+            req.contexts = req.contexts[cut:]
+
+        # 3. 从最早的缓冲消息开始丢弃，至少保留最新一条
+        drop = 0
+        while total > budget and drop < len(messages) - 1:
+            total -= buffer_tokens[drop]
+            drop += 1
+        if drop:
+            logger.info(f"群聊上下文 | 超出 token 预算 {budget}，丢弃了最早的 {drop} 条群聊消息")
+        return messages[drop:]
 
     @filter.on_llm_request()
     async def on_req_llm(self, event: AstrMessageEvent, req: ProviderRequest):
         """当触发 LLM 请求前,调用此方法修改 req（群聊场景）"""
-        if event.unified_msg_origin not in self.session_chats:
+        if event.get_message_type() == MessageType.GROUP_MESSAGE:
+            await self._ensure_restored(event.unified_msg_origin)
+        if event.unified_msg_origin not in self.session_chats and not (
+            # 共享存储中可能有其他实例记录的消息
+            self.session_store.shared and event.get_message_type() == MessageType.GROUP_MESSAGE
+        ):
             return
+        start = time.perf_counter()
+        self._note_history_session(event.unified_msg_origin, private=False)
+
+        # 等待请求前已到达、仍在构建中的消息（如正在获取合并转发内容），以及正在进行的摘要
+        await self._wait_pending_messages(event.unified_msg_origin)
+        await self._wait_summary(event.unified_msg_origin)
 
         # 获取群聊的会话轮数限制
-        rounds_limit = int(self.get_cfg("conversation_rounds_limit", 10))
+        rounds_limit = self.conversation_rounds_limit
         
-        # 首先，清洗掉先前已经嵌入的system字段
-        req.contexts = [
-            ctx for ctx in req.contexts 
-            if not (ctx.get("role") == "system" and (ctx.get("content", "").startswith(self.active_reply_prompt[:30]) or ctx.get("content", "").startswith(self.normal_reply_prompt[:30])))
-        ]
-
-        # 控制对话轮数
-        self._control_conversation_rounds(req, rounds_limit)
-        
-        # 控制图片携带轮数
-        self._control_image_carry_rounds(req, self.image_carry_rounds)
-        
-        # 获取配置的提示词
-        is_active_reply = event.unified_msg_origin in self.active_reply_sessions
+        # 首先，清洗掉先前已经嵌入的system字段（稳定前缀模式下历史不再改写，保留原位）
+        if not self.enable_stable_prefix:
+            req.contexts = [
+                ctx for ctx in req.contexts 
+                if not (ctx.get("role") == "system" and (ctx.get("content", "").startswith(self.active_reply_prompt[:30]) or ctx.get("content", "").startswith(self.normal_reply_prompt[:30])))
+            ]
+
+        # 获取配置的提示词（同时清除主动回复标记）
+        is_active_reply = self._pop_active_reply(event.unified_msg_origin)
         if is_active_reply:
             system_message = self.active_reply_prompt
-            # 清除主动回复标记
-            self.active_reply_sessions.discard(event.unified_msg_origin)
         else:
             system_message = self.normal_reply_prompt
+            # 缓冲消息由本次请求消费，正在防抖等待的主动回复随之取消
+            self.reply_scheduler.supersede(event.unified_msg_origin)
+
+        # 较早消息的滚动摘要随本次请求一并消费
+        summary = self.group_summaries.pop(event.unified_msg_origin, None)
+        summary = f"{SUMMARY_PREFIX}\n{summary}\n" if summary else ""
+
+        if self.token_budget > 0:
+            # 按 token 预算裁剪历史和群聊缓冲消息，取出并清空该会话的缓冲消息
+            entries = await self._take_messages(event.unified_msg_origin, with_tokens=True)
+            with self.metrics.timer("context_trim"):
+                messages = self._apply_token_budget(req, entries, system_message + summary)
+        else:
+            # 控制对话轮数和图片携带轮数
+            with self.metrics.timer("context_trim"):
+                chunk = self.stable_prefix_chunk if self.enable_stable_prefix else 1
+                self._control_context_rounds(req, rounds_limit, self.image_carry_rounds, chunk)
+
+            # 取出并清空该会话的缓冲消息，只保留上一次请求过后的群聊消息
+            messages = await self._take_messages(event.unified_msg_origin)
+
+        # 历史中此前直传的图片 URL 可能已临近过期，或当前服务商不支持直传
+        passthrough = False
+        if self.url_policy.providers:
+            provider = self.context.get_using_provider(event.unified_msg_origin)
+            passthrough = provider is not None and self.url_policy.enabled_for(self._provider_id(provider))
+            await self._refresh_history_image_urls(req, passthrough)
 
         # 将 system 消息添加到上下文
         req.contexts.append({"role": "system", "content": system_message})
@@ -656,7 +1670,14 @@ class GroupContextPlugin(Star):
         # 同时构建纯文本prompt，图片用[图片]占位
         text_prompt_parts = []
         
-        for message in self.session_chats[event.unified_msg_origin]:
+        # 缓冲区中只保存消息记录和图片引用，此时才渲染并解析编码
+        messages = await self._render_records(messages, passthrough)
+
+        # 较早消息的滚动摘要放在最前面
+        if summary:
+            messages.insert(0, [{"type": "text", "text": summary}])
+
+        for message in messages:
             combined_content.extend(message)
             
             # 构建纯文本prompt部分
@@ -685,9 +1706,9 @@ class GroupContextPlugin(Star):
         
         # 将用户消息添加到上下文
         req.contexts.append(user_message)
-        
-        # 清空该会话的历史记录，只保留上一次请求过后的群聊消息
-        self.session_chats[event.unified_msg_origin].clear()
+        if self.enable_stable_prefix:
+            self._report_stable_prefix(event, req)
+        self.metrics.observe("on_req_llm", time.perf_counter() - start)
 
     @filter.on_llm_request()
     async def on_req_llm_private(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -697,15 +1718,14 @@ class GroupContextPlugin(Star):
                 event.get_message_type() == MessageType.FRIEND_MESSAGE):
             return
 
+        self._note_history_session(event.unified_msg_origin, private=True)
+
         # 使用私聊场景的配置
         rounds_limit = self.private_conversation_rounds_limit
         image_carry_rounds = self.private_image_carry_rounds
 
-        # 控制对话轮数
-        self._control_conversation_rounds(req, rounds_limit)
-        
-        # 控制图片携带轮数
-        self._control_image_carry_rounds(req, image_carry_rounds)
+        # 控制对话轮数和图片携带轮数
+        self._control_context_rounds(req, rounds_limit, image_carry_rounds)
     
     @filter.on_llm_request(priority=-10000)
     async def on_req_llm_clear_prompt(self, event: AstrMessageEvent, req: ProviderRequest):
@@ -740,7 +1760,42 @@ class GroupContextPlugin(Star):
         if req is not None:
             req.prompt = ""
 
+        # 主动回复已收到回复，该群可以再次触发（同一群中其他请求的回复不释放，避免主动回复重叠）
+        if event.get_extra(ACTIVE_REPLY_EXTRA):
+            event.set_extra(ACTIVE_REPLY_EXTRA, False)
+            self.reply_scheduler.release(event.unified_msg_origin, inflight_only=True)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("gc_metrics")
+    async def show_metrics(self, event: AstrMessageEvent, action: str = ""):
+        """查看群聊上下文插件的运行指标；参数 prom 输出 Prometheus 文本格式"""
+        if action == "prom":
+            yield event.plain_result(self.metrics.render_prometheus())
+        else:
+            yield event.plain_result(self.metrics.summary())
 
     async def terminate(self):
         """插件卸载时的清理工作"""
+        logger.info(f"群聊缓冲区状态: {self.session_chats.stats()}")
+        logger.info(f"图片缓存状态: {self.image_cache.stats()}")
+        logger.info(f"图片描述缓存状态: {self.caption_cache.stats()}")
+        logger.info(f"图片描述队列状态: {self.caption_workers.stats()}")
+        logger.info(f"合并转发缓存状态: {self.forward_cache.stats()}, 回复消息缓存状态: {self.reply_cache.stats()}")
+        logger.info(f"消息索引状态: {self.message_index.stats()}")
+        logger.info(f"阻塞任务执行器状态: {self.executor.stats()}")
+        for task in self._background_tasks:
+            task.cancel()
+        if self.metrics_file_interval > 0:
+            try:
+                self.metrics.write_prometheus(self.metrics_file)
+            except Exception as e:
+                logger.error(f"写入运行指标文件失败: {e}")
+        self.executor.shutdown()
+        await self.caption_workers.stop()
+        if self.journal:
+            logger.info(f"群聊缓冲持久化状态: {self.journal.stats()}")
+            await self.journal.close()
+        if self.session_store.shared:
+            logger.info(f"共享会话存储状态: {self.session_store.stats()}")
+        await self.session_store.close()
         logger.info("群聊上下文感知插件已卸载")
@@ -0,0 +1,208 @@
+"""
+运行指标
+按阶段记录耗时直方图，统计 API 调用、缓存命中、[图片] 占位回退等计数，并通过采集函数汇总缓冲区等的当前大小；
+可输出为简短的文本摘要（管理员指令查看），或 Prometheus 文本格式（定期写入本地文件）
+"""
+import bisect
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+PREFIX = "group_context"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""耗时直方图的分桶上界（秒）"""
+
+Sample = Tuple[str, Dict[str, str], float]
+"""采集函数返回的样本：(指标名, 标签, 值)"""
+
+
+class Histogram:
+    """固定分桶的耗时直方图"""
+
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """按分桶线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+
+def _labels_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _number(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = labels.items() if isinstance(labels, dict) else labels
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    """插件运行指标的注册表"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._stages: Dict[str, Histogram] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self.started = time.time()
+
+    def observe(self, stage: str, seconds: float):
+        """记录一个阶段的耗时"""
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            histogram = self._stages[stage] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """记录 with 代码块的耗时（可包含 await）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """累加计数"""
+        key = (name, _labels_key(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """注册采集函数，导出时调用以获取当前值（如缓冲区大小）"""
+        self._collectors.append(collector)
+
+    def _collect(self) -> List[Sample]:
+        samples = []
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception:
+                continue
+        return samples
+
+    def summary(self, top_groups: int = 10) -> str:
+        """生成便于阅读的文本摘要"""
+        lines = [f"运行时长: {int(time.time() - self.started)} 秒", "", "阶段耗时（毫秒）:"]
+        for stage, h in sorted(self._stages.items()):
+            lines.append(
+                f"  {stage}: {h.count} 次, 平均 {h.sum / h.count * 1000:.1f}, "
+                f"p50 {h.quantile(0.5) * 1000:.1f}, p95 {h.quantile(0.95) * 1000:.1f}, 最大 {h.max * 1000:.1f}"
+            )
+        if not self._stages:
+            lines.append("  （暂无数据）")
+
+        lines += ["", "计数:"]
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(f"  {name}{_format_labels(labels)}: {_number(value)}")
+        if not self._counters:
+            lines.append("  （暂无数据）")
+
+        groups = {}
+        others = []
+        for name, labels, value in self._collect():
+            if "group" in labels:
+                groups.setdefault(labels["group"], {})[name] = value
+            else:
+                others.append((name, labels, value))
+        if others:
+            lines += ["", "当前状态:"]
+            for name, labels, value in others:
+                lines.append(f"  {name}{_format_labels(labels)}: {_number(value)}")
+        if groups:
+            lines += ["", f"缓冲消息最多的 {min(top_groups, len(groups))} 个群（共 {len(groups)} 个）:"]
+            ranked = sorted(groups.items(), key=lambda item: item[1].get("buffer_messages", 0), reverse=True)
+            for umo, values in ranked[:top_groups]:
+                detail = ", ".join(f"{k.replace('buffer_', '')} {_number(v)}" for k, v in sorted(values.items()))
+                lines.append(f"  {umo}: {detail}")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = []
+        if self._stages:
+            name = f"{PREFIX}_stage_seconds"
+            lines += [f"# HELP {name} Time spent in each processing stage.", f"# TYPE {name} histogram"]
+            for stage, h in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+
+        typed = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {_number(value)}")
+
+        for name, labels, value in sorted(self._collect(), key=lambda s: s[0]):
+            metric = f"{PREFIX}_{name}"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{_format_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """原子地写入 Prometheus 文本格式文件（供 node_exporter textfile collector 等读取）"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+
+def timed(stage: str, attr: str = "metrics"):
+    """记录异步方法耗时的装饰器，指标注册表取自实例的 attr 属性"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            metrics: Optional[Metrics] = getattr(self, attr, None)
+            if metrics is None:
+                return await func(self, *args, **kwargs)
+            with metrics.timer(stage):
+                return await func(self, *args, **kwargs)
+        return wrapper
+
+    return decorator
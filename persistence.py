@@ -0,0 +1,156 @@
+"""
+群聊缓冲持久化
+使用 SQLite（WAL 模式）以追加方式记录缓冲中的群聊消息和主动回复标记，插件重启后按群懒加载恢复；
+所有数据库操作都在单独的单线程执行器中按提交顺序执行，不阻塞事件循环
+"""
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from astrbot.api import logger
+
+from .records import MessageRecord
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    umo TEXT NOT NULL,
+    ts REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_umo_seq ON messages (umo, seq);
+CREATE TABLE IF NOT EXISTS active_reply (
+    umo TEXT PRIMARY KEY
+);
+"""
+
+_CHECKPOINT_EVERY = 100
+"""每清除多少次缓冲后执行一次 WAL checkpoint"""
+
+
+class BufferJournal:
+    """群聊缓冲的 SQLite 追加日志"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="group_context_journal")
+        self._conn: sqlite3.Connection = None
+        self._deletes = 0
+
+        self.appended = 0
+        self.restored = 0
+        self.compacted = 0
+
+    # ---------- 在数据库线程中执行 ----------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _append(self, umo: str, ts: float, payload: str):
+        self._connect().execute("INSERT INTO messages (umo, ts, payload) VALUES (?, ?, ?)", (umo, ts, payload))
+
+    def _load(self, umo: str) -> Tuple[List[Tuple[float, str]], bool]:
+        conn = self._connect()
+        rows = conn.execute("SELECT ts, payload FROM messages WHERE umo = ? ORDER BY ts, seq", (umo,)).fetchall()
+        active = conn.execute("SELECT 1 FROM active_reply WHERE umo = ?", (umo,)).fetchone() is not None
+        return rows, active
+
+    def _delete_group(self, umo: str):
+        conn = self._connect()
+        cursor = conn.execute("DELETE FROM messages WHERE umo = ?", (umo,))
+        self.compacted += cursor.rowcount
+        self._deletes += 1
+        if self._deletes % _CHECKPOINT_EVERY == 0:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _set_active(self, umo: str, active: bool):
+        if active:
+            self._connect().execute("INSERT OR IGNORE INTO active_reply (umo) VALUES (?)", (umo,))
+        else:
+            self._connect().execute("DELETE FROM active_reply WHERE umo = ?", (umo,))
+
+    def _prune(self, max_messages: int, max_age: float) -> int:
+        """清除超出每群条数上限和时长上限的记录（与内存缓冲区的淘汰规则一致）"""
+        conn = self._connect()
+        removed = 0
+        if max_age:
+            removed += conn.execute("DELETE FROM messages WHERE ts < ?", (time.time() - max_age,)).rowcount
+        if max_messages:
+            removed += conn.execute(
+                """
+                DELETE FROM messages WHERE seq IN (
+                    SELECT seq FROM (
+                        SELECT seq, ROW_NUMBER() OVER (PARTITION BY umo ORDER BY seq DESC) AS rn FROM messages
+                    ) WHERE rn > ?
+                )
+                """,
+                (max_messages,),
+            ).rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.compacted += removed
+        return removed
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+            self._conn = None
+
+    # ---------- 事件循环中调用 ----------
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _submit(self, func, *args):
+        """提交写操作，不等待完成；单线程执行器保证按提交顺序执行"""
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        exc = future.exception()
+        if exc is not None:
+            logger.error(f"群聊缓冲持久化失败: {exc}")
+
+    def append(self, umo: str, record: MessageRecord):
+        """追加一条缓冲消息"""
+        self.appended += 1
+        self._submit(self._append, umo, record.ts, json.dumps(record.to_dict(), ensure_ascii=False))
+
+    def clear_group(self, umo: str):
+        """该群的缓冲消息已被请求消费或整体淘汰，清除其记录"""
+        self._submit(self._delete_group, umo)
+
+    def set_active(self, umo: str, active: bool):
+        self._submit(self._set_active, umo, active)
+
+    async def load(self, umo: str) -> Tuple[List[MessageRecord], bool]:
+        """读取一个群的缓冲消息和主动回复标记，无法解析的记录会被跳过"""
+        rows, active = await self._run(self._load, umo)
+        messages = []
+        for _, payload in rows:
+            try:
+                messages.append(MessageRecord.from_dict(json.loads(payload)))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                continue
+        self.restored += len(messages)
+        return messages, active
+
+    async def prune(self, max_messages: int, max_age: float) -> int:
+        return await self._run(self._prune, max_messages, max_age)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"appended": self.appended, "restored": self.restored, "compacted": self.compacted}
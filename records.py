@@ -0,0 +1,136 @@
+"""
+群聊消息记录
+缓冲区中的每条群聊消息以紧凑的 MessageRecord 保存：发送者、时间、消息ID 等结构化字段加上按顺序排列的消息段，
+只有在组装 LLM 请求时才渲染为 OpenAI 格式的多模态内容
+"""
+import datetime
+import re
+import unicodedata
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+
+class Text(NamedTuple):
+    """文本段"""
+    text: str
+
+
+class ImageRef(NamedTuple):
+    """图片引用，请求时再下载编码"""
+    url: str
+    file: str = ""
+
+
+class CaptionRef(NamedTuple):
+    """图片描述引用，描述由后台队列获取，请求时再填入"""
+    job: str
+    url: str
+    file: str = ""
+
+
+Segment = Union[Text, ImageRef, CaptionRef]
+
+_SEGMENT_TYPES = {"text": Text, "image": ImageRef, "caption": CaptionRef}
+_SEGMENT_NAMES = {cls: name for name, cls in _SEGMENT_TYPES.items()}
+
+REPEAT_NOTE_MAX_SENDERS = 10
+"""复读标注中最多列出的发送者数量"""
+_IGNORED_CHARS = re.compile(r"[\s!！?？。.,，~～、…]+")
+
+
+class MessageRecord:
+    """一条缓冲中的群聊消息"""
+
+    __slots__ = ("sender_id", "nickname", "ts", "message_id", "segments", "repeaters")
+
+    def __init__(
+        self,
+        sender_id: str,
+        nickname: str,
+        ts: float,
+        message_id: Optional[str],
+        segments: Tuple[Segment, ...],
+        repeaters: Tuple[str, ...] = (),
+    ):
+        self.sender_id = sender_id
+        self.nickname = nickname
+        self.ts = ts
+        self.message_id = message_id
+        self.segments = segments
+        self.repeaters = repeaters
+        """之后连续发送了相同内容的发送者昵称（折叠后的复读）"""
+
+    def header(self) -> str:
+        """消息开头的发送者和时间，如 [昵称/12:00:00]: """
+        return f"[{self.nickname}/{datetime.datetime.fromtimestamp(self.ts).strftime('%H:%M:%S')}]: "
+
+    def plain_text(self) -> str:
+        """不含发送者和时间的纯文本，图片以[图片]占位"""
+        return "".join(seg.text if isinstance(seg, Text) else " [图片]" for seg in self.segments)
+
+    def repeat_note(self) -> str:
+        """复读标注，如 （×3，发送者：甲、乙），未折叠过复读时为空"""
+        if not self.repeaters:
+            return ""
+        senders = list(dict.fromkeys((self.nickname,) + self.repeaters))
+        names = "、".join(senders[:REPEAT_NOTE_MAX_SENDERS])
+        if len(senders) > REPEAT_NOTE_MAX_SENDERS:
+            names += f" 等 {len(senders)} 人"
+        return f" （×{len(self.repeaters) + 1}，发送者：{names}）"
+
+    def with_segments(self, segments: Tuple[Segment, ...]) -> "MessageRecord":
+        return MessageRecord(self.sender_id, self.nickname, self.ts, self.message_id, segments, self.repeaters)
+
+    def with_repeat(self, nickname: str) -> "MessageRecord":
+        """追加一个发送了相同内容的发送者"""
+        return MessageRecord(
+            self.sender_id, self.nickname, self.ts, self.message_id, self.segments, self.repeaters + (nickname,)
+        )
+
+    def to_dict(self) -> dict:
+        """转换为可 JSON 序列化的字典（用于持久化）"""
+        return {
+            "sender_id": self.sender_id,
+            "nickname": self.nickname,
+            "ts": self.ts,
+            "message_id": self.message_id,
+            "segments": [[_SEGMENT_NAMES[type(seg)], *seg] for seg in self.segments],
+            "repeaters": list(self.repeaters),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MessageRecord":
+        return cls(
+            data["sender_id"],
+            data["nickname"],
+            data["ts"],
+            data.get("message_id"),
+            tuple(_SEGMENT_TYPES[name](*fields) for name, *fields in data["segments"]),
+            tuple(data.get("repeaters", ())),
+        )
+
+
+def dedupe_key(record: MessageRecord) -> Optional[tuple]:
+    """判断复读用的内容键：文本经 NFKC 规范化、忽略大小写、空白和常见标点，图片按文件标识（通常为内容 MD5）或 URL
+
+    发送者、时间不参与比较；没有内容时返回 None
+    """
+    key = []
+    for seg in record.segments:
+        if isinstance(seg, Text):
+            text = _IGNORED_CHARS.sub("", unicodedata.normalize("NFKC", seg.text).casefold())
+            if text:
+                key.append(text)
+        else:
+            key.append(("image", seg.file or seg.url))
+    return tuple(key) or None
+
+
+def estimate_record_bytes(record: MessageRecord) -> int:
+    """估算一条消息占用的字节数（文本按UTF-8计算，图片引用按URL等字符串长度计算）"""
+    size = len(record.nickname.encode("utf-8")) + sum(len(name.encode("utf-8")) for name in record.repeaters)
+    for seg in record.segments:
+        if isinstance(seg, Text):
+            size += len(seg.text.encode("utf-8"))
+        else:
+            size += sum(len(field) for field in seg)
+    return size
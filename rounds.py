@@ -0,0 +1,140 @@
+"""
+对话轮次工具
+按 assistant -> user/system 的切换点划分对话轮次，一次遍历完成轮数裁剪和图片剥离
+"""
+import json
+from typing import Hashable, List, Tuple
+
+
+def find_round_ends(contexts: List[dict]) -> List[int]:
+    """返回所有轮次结束位置（assistant 消息的下标）
+
+    使用简单逻辑找到所有轮次的结束位置：当上一条是a而下一条是u/s即意味着轮的分割；
+    最后一条是assistant时，它也是一个轮次的结束
+    """
+    round_ends = []
+    for i in range(len(contexts) - 1):
+        if contexts[i].get("role") == "assistant" and contexts[i + 1].get("role") in ["user", "system"]:
+            round_ends.append(i)
+    if contexts and contexts[-1].get("role") == "assistant":
+        round_ends.append(len(contexts) - 1)
+    return round_ends
+
+
+def has_images(ctx: dict) -> bool:
+    """消息中是否仍包含图片
+
+    去除过图片的消息不再包含 image_url，据此识别已规范化的消息并跳过重建
+    """
+    content = ctx.get("content")
+    return isinstance(content, list) and any(item.get("type") == "image_url" for item in content)
+
+
+def chunked_cut(total: int, keep: int, chunk: int = 1) -> int:
+    """需要从前面移除的轮数：超出 keep 轮的部分按 chunk 的整数倍向下取整
+
+    chunk 为 1 时即为逐轮滑动；chunk 更大时裁剪位置每 chunk 轮才移动一次，期间保留的前缀保持不变
+    """
+    if keep <= 0 or total <= keep:
+        return 0
+    chunk = max(1, chunk)
+    return (total - keep) // chunk * chunk
+
+
+def compact_contexts(contexts: List[dict], rounds_limit: int, image_carry_rounds: int, chunk: int = 1) -> List[dict]:
+    """只计算一次轮次索引，同时完成对话轮数裁剪和图片携带轮数控制
+
+    - rounds_limit > 0 时只保留最近 rounds_limit 轮对话
+    - image_carry_rounds > 0 时只保留保留部分中最后 image_carry_rounds 轮的图片，
+      更早的 user 消息中的图片替换为[图片]占位符；已去除过图片的消息直接跳过
+    - chunk > 1 时两者都按 chunk 轮整块推进（见 chunked_cut），保留的轮数在 limit 到 limit+chunk-1 之间
+    返回裁剪后的列表（未裁剪时返回原列表）
+    """
+    if not contexts:
+        return contexts
+    round_ends = find_round_ends(contexts)
+
+    # 找到需要保留的第一轮的开始位置
+    start = 0
+    cut = chunked_cut(len(round_ends), rounds_limit, chunk)
+    if cut:
+        start = round_ends[cut]
+        round_ends = round_ends[cut:]
+
+    # 找到保留图片的第一轮的开始位置，此前的user消息去除图片
+    if chunk > 1 and rounds_limit > 0 and image_carry_rounds > 0:
+        # 图片轮数向上对齐到与轮数上限同余，使图片剥离与轮数裁剪在同一次请求中推进
+        image_carry_rounds += (rounds_limit - image_carry_rounds) % chunk
+    cut = chunked_cut(len(round_ends), image_carry_rounds, chunk)
+    if cut:
+        image_keep_start = round_ends[cut]
+        for i in range(start, image_keep_start):
+            ctx = contexts[i]
+            if ctx.get("role") == "user" and has_images(ctx):
+                strip_message_images(ctx)
+
+    return contexts[start:] if start else contexts
+
+
+def compact_history_json(
+    history: str, rounds_limit: int, image_carry_rounds: int, chunk: int = 1
+) -> Tuple[list, int, int]:
+    """解析已保存的对话历史并按与请求时相同的规则压缩（见 compact_contexts）
+
+    返回 (压缩后的历史, 压缩前字节数, 压缩后字节数)，字节数按 UTF-8 JSON 计算
+    """
+    contexts = json.loads(history)
+    before = len(json.dumps(contexts, ensure_ascii=False).encode("utf-8"))
+    compacted = compact_contexts(contexts, rounds_limit, image_carry_rounds, chunk)
+    after = len(json.dumps(compacted, ensure_ascii=False).encode("utf-8"))
+    return compacted, before, after
+
+
+def strip_message_images(ctx: dict):
+    """将一条 user 消息中的图片替换为[图片]占位符，并合并同一条群聊消息内被图片拆开的文本
+
+    渲染群聊消息时，同一条消息内相邻的文本已合并、且每条消息都以文本结尾，
+    因此图片之后的文本一定属于同一条消息，紧跟在文本之后的文本则是新的一条消息
+    """
+    if not isinstance(ctx.get("content"), list):
+        return
+    new_content = []
+    after_image = False
+
+    for item in ctx["content"]:
+        if item["type"] == "text":
+            if after_image and new_content:
+                # 图片之后的文本与图片前的文本属于同一条消息，合并
+                new_content[-1] = {"type": "text", "text": new_content[-1]["text"] + item["text"]}
+            else:
+                new_content.append({"type": "text", "text": item["text"]})
+            after_image = False
+        elif item["type"] == "image_url":
+            # 图片转换为[图片]追加到当前文本
+            if new_content:
+                new_content[-1] = {"type": "text", "text": new_content[-1]["text"] + " [图片]"}
+            else:
+                new_content.append({"type": "text", "text": " [图片]"})
+            after_image = True
+
+    ctx["content"] = new_content
+
+
+def common_prefix(previous: List[Hashable], current: List[Hashable]) -> int:
+    """两次请求的消息指纹列表的公共前缀长度"""
+    n = 0
+    for a, b in zip(previous, current):
+        if a != b:
+            break
+        n += 1
+    return n
+
+
+def message_fingerprint(ctx: dict) -> Tuple:
+    """消息的指纹，内容完全相同的消息指纹相同（用于统计与上一次请求相同的前缀）"""
+    content = ctx.get("content")
+    if isinstance(content, list):
+        content = tuple(
+            (item.get("type"), item.get("text") or (item.get("image_url") or {}).get("url")) for item in content
+        )
+    return ctx.get("role"), hash(content) if isinstance(content, (str, tuple)) else repr(content)
@@ -0,0 +1,148 @@
+"""
+主动回复调度
+按群限制主动回复的频率（令牌桶），并对刷屏进行防抖：触发后等待群聊安静下来再发起一次请求，
+覆盖整段刷屏的消息；同一个群在等待或请求进行中时，后续触发直接忽略
+"""
+import asyncio
+import time
+from typing import Dict
+
+IDLE = 0
+DEBOUNCING = 1
+INFLIGHT = 2
+
+
+class _GroupState:
+    """单个群的调度状态"""
+
+    __slots__ = ("tokens", "refilled_at", "last_message", "phase", "since", "superseded")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.refilled_at = now
+        self.last_message = now
+        self.phase = IDLE
+        self.since = now
+        """进入当前阶段的时间"""
+        self.superseded = False
+        """防抖期间缓冲消息已被其他请求（如 @ 机器人）消费"""
+
+
+class ActiveReplyScheduler:
+    """按群调度主动回复
+
+    - capacity 为令牌桶容量（短时间内最多连续主动回复的次数），每 refill_seconds 秒恢复一个，0 表示不限制
+    - 触发后等待群聊连续 debounce 秒没有新消息，最长等待 max_delay 秒，0 表示不等待
+    - 请求发出后超过 inflight_timeout 秒仍未收到回复时视为结束，避免请求失败后该群再也无法主动回复
+    """
+
+    def __init__(
+        self,
+        capacity: int = 0,
+        refill_seconds: float = 0,
+        debounce: float = 0,
+        max_delay: float = 0,
+        inflight_timeout: float = 120,
+    ):
+        self.capacity = max(0, int(capacity))
+        self.refill_seconds = max(0.0, float(refill_seconds))
+        self.debounce = max(0.0, float(debounce))
+        self.max_delay = max(self.debounce, float(max_delay))
+        self.inflight_timeout = max(0.0, float(inflight_timeout))
+        self._groups: Dict[str, _GroupState] = {}
+
+        self.scheduled = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+        self.superseded = 0
+
+    def _state(self, umo: str, now: float) -> _GroupState:
+        state = self._groups.get(umo)
+        if state is None:
+            state = self._groups[umo] = _GroupState(self.capacity, now)
+        return state
+
+    def _refill(self, state: _GroupState, now: float):
+        if self.refill_seconds:
+            state.tokens = min(self.capacity, state.tokens + (now - state.refilled_at) / self.refill_seconds)
+        state.refilled_at = now
+
+    def touch(self, umo: str):
+        """记录群内有新消息到达，重新开始防抖计时（只记录已触发过主动回复的群）"""
+        state = self._groups.get(umo)
+        if state is not None:
+            state.last_message = time.time()
+
+    def try_acquire(self, umo: str) -> bool:
+        """主动回复被触发时调用，返回 True 表示由调用方负责本次主动回复"""
+        now = time.time()
+        state = self._state(umo, now)
+        if state.phase == INFLIGHT and self.inflight_timeout and now - state.since > self.inflight_timeout:
+            state.phase = IDLE
+        if state.phase != IDLE:
+            self.suppressed += 1
+            return False
+        if self.capacity:
+            self._refill(state, now)
+            if state.tokens < 1:
+                self.rate_limited += 1
+                return False
+            state.tokens -= 1
+        state.phase = DEBOUNCING
+        state.since = now
+        state.last_message = now
+        state.superseded = False
+        self.scheduled += 1
+        return True
+
+    async def wait_quiet(self, umo: str) -> bool:
+        """等待群聊安静下来；防抖期间缓冲消息已被其他请求消费时返回 False，调用方应放弃本次主动回复"""
+        state = self._groups.get(umo)
+        if state is None:
+            return False
+        deadline = state.since + self.max_delay
+        while True:
+            now = time.time()
+            remaining = min(state.last_message + self.debounce, deadline) - now
+            if remaining <= 0 or state.superseded:
+                break
+            await asyncio.sleep(remaining)
+        if state.superseded:
+            self.superseded += 1
+            return False
+        return True
+
+    def dispatch(self, umo: str):
+        """主动回复请求即将发出"""
+        state = self._groups.get(umo)
+        if state is not None:
+            state.phase = INFLIGHT
+            state.since = time.time()
+
+    def supersede(self, umo: str):
+        """该群的缓冲消息被非主动回复的请求消费，正在防抖的主动回复不再需要"""
+        state = self._groups.get(umo)
+        if state is not None and state.phase == DEBOUNCING:
+            state.superseded = True
+
+    def release(self, umo: str, inflight_only: bool = False):
+        """主动回复结束（放弃或收到回复）；inflight_only 为 True 时只释放已发出的请求"""
+        state = self._groups.get(umo)
+        if state is None or (inflight_only and state.phase != INFLIGHT):
+            return
+        state.phase = IDLE
+        if self.capacity:
+            self._refill(state, time.time())
+        if not self.capacity or state.tokens >= self.capacity:
+            # 令牌已满且空闲的群不再需要保留状态
+            del self._groups[umo]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "groups": len(self._groups),
+            "busy": sum(1 for state in self._groups.values() if state.phase != IDLE),
+            "scheduled": self.scheduled,
+            "suppressed": self.suppressed,
+            "rate_limited": self.rate_limited,
+            "superseded": self.superseded,
+        }
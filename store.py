@@ -0,0 +1,457 @@
+"""
+群聊缓冲的会话存储
+默认的内存存储即插件自身的 GroupMessageBuffer，不做任何额外工作；
+共享存储（KVSessionStore）将缓冲消息写入兼容 Redis 协议（RESP）的键值服务，多个机器人实例处理同一个群时共享缓冲：
+- 消息先在本地排队，按 flush_interval 批量以流水线（pipeline）写入，每个群一次 RPUSH + LTRIM + EXPIRE
+- 请求时以 MULTI/EXEC 原子地读取并删除整个列表（LRANGE + DEL），同一条消息只会被一个实例取出
+- 超过 BLOB_MIN_BYTES 的图片地址（通常为 base64 数据）按内容哈希单独存放一次，消息中只保存引用
+- 读取失败时调用方改用本地缓冲中的消息，这些消息之后不再写入，已写入的在下一次取出时按消息ID跳过
+- 获取到的图片描述按缓存键共享，其他实例取出消息后重新提交的描述任务直接复用，不再调用提供商
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import unquote, urlsplit
+
+from astrbot.api import logger
+
+from .records import MessageRecord
+
+BLOB_MIN_BYTES = 4096
+"""超过该长度的图片地址单独存放，消息中只保存引用"""
+BLOB_REF_PREFIX = "kvblob:"
+MAX_PENDING = 10000
+"""写入失败时保留待重试的消息上限，超出后丢弃最早的消息"""
+_URL_FIELDS = {"image": 1, "caption": 2}
+"""序列化后的消息段中图片地址所在的位置"""
+
+
+class RespError(Exception):
+    """键值服务返回的错误"""
+
+
+def encode_command(*args) -> bytes:
+    """按 RESP 协议编码一条命令"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """读取一条 RESP 回复；错误回复以 RespError 对象返回而不抛出，便于流水线中逐条处理"""
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("键值服务连接已关闭")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        return RespError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"无法解析键值服务的回复: {line[:50]!r}")
+
+
+class RespClient:
+    """最小化的 RESP 客户端（Redis / Valkey / KeyDB 等）
+
+    单个连接，命令按发送顺序读取回复；调用失败或被取消时断开连接，下一次调用自动重连。
+    url 格式为 redis://[用户名:密码@]主机[:端口][/库编号]
+    """
+
+    def __init__(self, url: str, timeout: float = 5):
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"不支持的键值服务地址: {url}")
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self.roundtrips = 0
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for reply in await self._roundtrip(setup) if setup else ():
+            if isinstance(reply, RespError):
+                raise reply
+
+    async def _roundtrip(self, commands: Sequence[tuple]) -> list:
+        self._writer.write(b"".join(encode_command(*command) for command in commands))
+        await self._writer.drain()
+        self.roundtrips += 1
+        return [await read_reply(self._reader) for _ in commands]
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def pipeline(self, commands: Sequence[tuple]) -> list:
+        """一次发送多条命令，按顺序返回各自的回复"""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await asyncio.wait_for(self._connect(), self.timeout or None)
+                return await asyncio.wait_for(self._roundtrip(commands), self.timeout or None)
+            except BaseException:
+                # 回复未读完时连接状态未知，只能丢弃
+                self._disconnect()
+                raise
+
+    async def execute(self, *args):
+        reply = (await self.pipeline([args]))[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    async def close(self):
+        async with self._lock:
+            writer = self._writer
+            self._disconnect()
+            if writer is not None:
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+
+
+class SessionStore:
+    """会话存储接口
+
+    - push 在消息填入本地缓冲后调用，不等待写入完成
+    - take_all 原子地取出并清空该群在存储中的全部消息
+    """
+
+    shared = False
+    """为 True 时缓冲消息以存储为准，本地缓冲只负责按到达顺序暂存"""
+
+    def push(self, umo: str, record: MessageRecord):
+        pass
+
+    async def take_all(self, umo: str) -> List[MessageRecord]:
+        return []
+
+    async def flush(self):
+        pass
+
+    async def get_caption(self, key: str) -> Optional[str]:
+        """返回其他实例获取过的图片描述"""
+        return None
+
+    async def put_caption(self, key: str, caption: str):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+
+class MemorySessionStore(SessionStore):
+    """默认的内存存储：缓冲消息只保存在本地的 GroupMessageBuffer 中，无需额外读写"""
+
+
+class KVSessionStore(SessionStore):
+    """基于 RESP 键值服务的共享会话存储
+
+    - 每个群的缓冲消息为一个列表 {prefix}:buf:{umo}，保留最新的 max_messages 条，空闲 idle_ttl 秒后过期
+    - 大图片地址存放在 {prefix}:blob:{sha1}，过期时间同样为 idle_ttl（为 0 时使用 blob_ttl）
+    - 图片描述任务只存在于提交它的实例中，其他实例取出时任务ID为空，由调用方重新提交
+    - take_all 失败时，本实例写入、尚未取出的该群消息视为已由调用方从本地缓冲交付
+    - 图片描述存放在 {prefix}:caption:{key}，过期时间为 caption_ttl
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        url: str,
+        prefix: str = "group_context",
+        max_messages: int = 0,
+        idle_ttl: float = 0,
+        flush_interval: float = 0.05,
+        blob_ttl: float = 86400,
+        caption_ttl: float = 86400,
+        client: Optional[RespClient] = None,
+    ):
+        self.client = client or RespClient(url)
+        self.prefix = prefix
+        self.max_messages = max(0, int(max_messages))
+        self.idle_ttl = max(0, int(idle_ttl))
+        self.blob_ttl = self.idle_ttl or max(1, int(blob_ttl))
+        self.caption_ttl = max(1, int(caption_ttl))
+        self.flush_interval = max(0.0, float(flush_interval))
+        self.instance_id = uuid.uuid4().hex[:12]
+        """本实例的标识，用于区分图片描述任务的来源"""
+
+        self._ids = itertools.count(1)
+        self._pending: List[Tuple[str, str, bytes, Dict[str, str]]] = []
+        """待写入的 (群, 消息ID, 消息, 大图片)"""
+        self._unclaimed: Dict[str, Deque[str]] = {}
+        """每个群本实例写入、尚未被本实例的请求取出的消息ID"""
+        self._delivered: "OrderedDict[str, None]" = OrderedDict()
+        """已由本地缓冲交付的消息ID，从存储取出时跳过"""
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        self.pushed = 0
+        self.taken = 0
+        self.flushes = 0
+        self.blobs = 0
+        self.blob_bytes = 0
+        """以引用代替的图片地址字节数"""
+        self.failures = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.caption_hits = 0
+        self.captions_stored = 0
+
+    def _buffer_key(self, umo: str) -> str:
+        return f"{self.prefix}:buf:{umo}"
+
+    def _blob_key(self, digest: str) -> str:
+        return f"{self.prefix}:blob:{digest}"
+
+    def _caption_key(self, key: str) -> str:
+        return f"{self.prefix}:caption:{key}"
+
+    # ---------- 序列化 ----------
+
+    def _encode(self, record: MessageRecord, rid: str) -> Tuple[bytes, Dict[str, str]]:
+        data = record.to_dict()
+        data["rid"] = rid
+        blobs = {}
+        for seg in data["segments"]:
+            if seg[0] == "caption":
+                seg[1] = f"{self.instance_id}/{seg[1]}"
+            index = _URL_FIELDS.get(seg[0])
+            if index is not None and len(seg[index]) >= BLOB_MIN_BYTES:
+                digest = hashlib.sha1(seg[index].encode("utf-8")).hexdigest()
+                blobs[digest] = seg[index]
+                seg[index] = BLOB_REF_PREFIX + digest
+        return json.dumps(data, ensure_ascii=False).encode("utf-8"), blobs
+
+    def _decode(self, payloads: List[bytes]) -> Tuple[List[dict], List[str]]:
+        """解析消息并收集其中引用的大图片，无法解析的消息会被跳过"""
+        messages, digests = [], []
+        for payload in payloads:
+            try:
+                data = json.loads(payload)
+                if data.get("rid") in self._delivered:
+                    del self._delivered[data["rid"]]
+                    self.skipped += 1
+                    continue
+                for seg in data["segments"]:
+                    if seg[0] == "caption":
+                        origin, _, job = seg[1].partition("/")
+                        seg[1] = job if origin == self.instance_id else ""
+                    index = _URL_FIELDS.get(seg[0])
+                    if index is not None and seg[index].startswith(BLOB_REF_PREFIX):
+                        digests.append(seg[index][len(BLOB_REF_PREFIX):])
+            except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+                continue
+            messages.append(data)
+        return messages, digests
+
+    def _resolve(self, messages: List[dict], blobs: Dict[str, Optional[bytes]]) -> List[MessageRecord]:
+        """填入大图片并转换为消息记录；引用的图片已过期时该消息段改为[图片]占位文本"""
+        records = []
+        for data in messages:
+            segments = []
+            for seg in data["segments"]:
+                index = _URL_FIELDS.get(seg[0])
+                if index is not None and seg[index].startswith(BLOB_REF_PREFIX):
+                    blob = blobs.get(seg[index][len(BLOB_REF_PREFIX):])
+                    if blob is None:
+                        seg = ["text", " [图片]"]
+                    else:
+                        seg[index] = blob.decode("utf-8")
+                segments.append(seg)
+            data["segments"] = segments
+            try:
+                records.append(MessageRecord.from_dict(data))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                continue
+        # 多个实例写入的消息按到达时间排序
+        records.sort(key=lambda record: record.ts)
+        return records
+
+    # ---------- 写入 ----------
+
+    def push(self, umo: str, record: MessageRecord):
+        rid = f"{self.instance_id}-{next(self._ids)}"
+        payload, blobs = self._encode(record, rid)
+        self._pending.append((umo, rid, payload, blobs))
+        unclaimed = self._unclaimed.get(umo)
+        if unclaimed is None:
+            unclaimed = self._unclaimed[umo] = deque(maxlen=self.max_messages or MAX_PENDING)
+        unclaimed.append(rid)
+        self.pushed += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        if self.flush_interval:
+            await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"写入共享会话存储失败: {e}")
+
+    async def flush(self):
+        """立即写入所有排队的消息；写入失败时消息留待下一次重试"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            commands = []
+            blobs = {}
+            for _, _, _, record_blobs in batch:
+                blobs.update(record_blobs)
+            # 大图片先于引用它的消息写入；已存在时只刷新过期时间
+            for digest, data in blobs.items():
+                commands.append(("SET", self._blob_key(digest), data, "EX", self.blob_ttl, "NX"))
+                commands.append(("EXPIRE", self._blob_key(digest), self.blob_ttl))
+            groups: Dict[str, List[bytes]] = {}
+            for umo, _, payload, _ in batch:
+                groups.setdefault(umo, []).append(payload)
+            for umo, payloads in groups.items():
+                key = self._buffer_key(umo)
+                commands.append(("RPUSH", key, *payloads))
+                if self.max_messages:
+                    commands.append(("LTRIM", key, -self.max_messages, -1))
+                if self.idle_ttl:
+                    commands.append(("EXPIRE", key, self.idle_ttl))
+            try:
+                replies = await self.client.pipeline(commands)
+            except BaseException:
+                self.failures += 1
+                self._pending[:0] = batch
+                overflow = len(self._pending) - MAX_PENDING
+                if overflow > 0:
+                    del self._pending[:overflow]
+                    self.dropped += overflow
+                raise
+            self.flushes += 1
+            for reply in replies:
+                if isinstance(reply, RespError):
+                    logger.error(f"写入共享会话存储失败: {reply}")
+                    break
+            for _, _, _, record_blobs in batch:
+                self.blobs += len(record_blobs)
+                self.blob_bytes += sum(len(data) for data in record_blobs.values())
+
+    # ---------- 读取 ----------
+
+    async def take_all(self, umo: str) -> List[MessageRecord]:
+        """先写入本实例排队的消息，再原子地取出并删除该群的全部消息；连接失败时抛出异常，
+        此时本实例此前写入的该群消息视为已由调用方从本地缓冲发送
+        """
+        # 与调用方取出本地缓冲在同一时刻记下，此后写入的消息属于下一次请求
+        unclaimed = self._unclaimed.pop(umo, ())
+        key = self._buffer_key(umo)
+        try:
+            await self.flush()
+            replies = await self.client.pipeline([("MULTI",), ("LRANGE", key, 0, -1), ("DEL", key), ("EXEC",)])
+            result = replies[-1]
+            if isinstance(result, RespError):
+                raise result
+        except BaseException:
+            self._release_unclaimed(unclaimed)
+            raise
+        if not result or isinstance(result[0], RespError):
+            return []
+        messages, digests = self._decode(result[0])
+        blobs = {}
+        if digests:
+            digests = list(dict.fromkeys(digests))
+            try:
+                values = await self.client.execute("MGET", *(self._blob_key(digest) for digest in digests))
+                blobs = dict(zip(digests, values))
+            except Exception as e:
+                # 消息已从存储中删除，不能再失败，引用的图片改为[图片]占位符
+                logger.error(f"从共享会话存储读取图片失败: {e}")
+        records = self._resolve(messages, blobs)
+        self.taken += len(records)
+        return records
+
+    def _release_unclaimed(self, rids):
+        """读取失败时，调用方改用本地缓冲中的消息：尚未写入的不再写入；
+        可能已经写入的（包括写入结果未知的）在之后从存储取出时跳过，避免同一条消息被发送两次
+        """
+        if not rids:
+            return
+        rids = set(rids)
+        self._pending = [entry for entry in self._pending if entry[1] not in rids]
+        for rid in rids:
+            self._delivered[rid] = None
+        while len(self._delivered) > MAX_PENDING:
+            self._delivered.popitem(last=False)
+
+    # ---------- 图片描述 ----------
+
+    async def get_caption(self, key: str) -> Optional[str]:
+        value = await self.client.execute("GET", self._caption_key(key))
+        if value is None:
+            return None
+        self.caption_hits += 1
+        return value.decode("utf-8")
+
+    async def put_caption(self, key: str, caption: str):
+        await self.client.execute("SET", self._caption_key(key), caption, "EX", self.caption_ttl)
+        self.captions_stored += 1
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"关闭前写入共享会话存储失败，{len(self._pending)} 条消息未写入: {e}")
+        await self.client.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pushed": self.pushed,
+            "taken": self.taken,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "roundtrips": self.client.roundtrips,
+            "blobs": self.blobs,
+            "blob_bytes": self.blob_bytes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+            "caption_hits": self.caption_hits,
+            "captions_stored": self.captions_stored,
+        }
@@ -0,0 +1,74 @@
+"""
+Token 估算
+按字符类别粗略估算文本 token 数，按图片尺寸估算图片 token 数（参照 OpenAI 的分块计费规则），
+用于按 token 预算组装上下文，无需依赖具体模型的分词器
+"""
+import math
+from typing import Callable, Optional, Tuple, Union
+
+from .records import CaptionRef, ImageRef, MessageRecord, Text
+
+DEFAULT_IMAGE_TOKENS = 765
+"""无法获知图片尺寸时的估算值（约等于一张 1024x1024 图片）"""
+PLACEHOLDER_TOKENS = 3
+"""[图片] 占位符的估算值"""
+CAPTION_TOKENS = 100
+"""尚未获取到的图片描述的估算值"""
+
+
+def estimate_text_tokens(text: str) -> int:
+    """估算文本 token 数：中日韩等非 ASCII 字符约 1 个 token，ASCII 字符约 4 个一个 token"""
+    if not text:
+        return 0
+    chars = len(text)
+    # 非ASCII字符在UTF-8中多为3字节，由字节数反推其数量，避免逐字符遍历
+    wide = min(chars, (len(text.encode("utf-8")) - chars) // 2)
+    return wide + (chars - wide + 3) // 4
+
+
+def estimate_image_tokens(size: Optional[Tuple[int, int]], default: int = DEFAULT_IMAGE_TOKENS) -> int:
+    """按图片尺寸估算 token 数：先缩放到 2048x2048 以内、短边不超过 768，再按 512x512 分块计费"""
+    if not size or not size[0] or not size[1]:
+        return default
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_content_tokens(content: Union[str, list], image_tokens: Callable[[str], int]) -> int:
+    """估算一条消息内容的 token 数，image_tokens 根据图片 URL 返回其估算值"""
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    if not isinstance(content, list):
+        return 0
+    total = 0
+    for item in content:
+        item_type = item.get("type")
+        if item_type == "text":
+            total += estimate_text_tokens(item.get("text", ""))
+        elif item_type == "image_url":
+            total += image_tokens(item.get("image_url", {}).get("url", ""))
+    return total
+
+
+def estimate_record_tokens(
+    record: MessageRecord, image_tokens: Callable[[str], int]
+) -> Tuple[int, Tuple[int, ...]]:
+    """估算一条缓冲消息渲染后的 token 数（含发送者和时间），image_tokens 根据图片 URL 返回其估算值
+
+    返回 (总 token 数, 各图片片段按出现顺序的 token 数)
+    """
+    total = estimate_text_tokens(record.header()) + estimate_text_tokens(record.repeat_note())
+    images = []
+    for seg in record.segments:
+        if isinstance(seg, Text):
+            total += estimate_text_tokens(seg.text)
+        elif isinstance(seg, ImageRef):
+            images.append(image_tokens(seg.url))
+            total += images[-1]
+        elif isinstance(seg, CaptionRef):
+            total += CAPTION_TOKENS
+    return total, tuple(images)